@@ -17,11 +17,44 @@ try:
     import ujson as json
 except:
     import json
+# the standard library's, for JSONDecoder.raw_decode, which ujson doesn't have
+import json as _json
+import codecs
+import re
 import threading
+import collections
+import gc
+import heapq
+import multiprocessing
+import array
+import binascii
+import hashlib
+import mmap
+import struct
 try:
     from queue import Queue
 except:
     from Queue import Queue
+try:
+    # python 3.8+
+    from multiprocessing import shared_memory
+except:
+    shared_memory = None
+try:
+    # python 3.4+
+    import selectors
+except:
+    selectors = None
+try:
+    # python 3.4+
+    import tracemalloc
+except:
+    tracemalloc = None
+try:
+    # unix only
+    import resource
+except:
+    resource = None
 
 # pylint: disable = too-many-instance-attributes, invalid-name
 
@@ -38,11 +71,17 @@ PICKUP_DELAY = 0
 THROW_DELAY = 10
 MOVEMENT_DELAY = 1
 BUILD_DELAY = 10
+# how long a pickup keeps the thrower from acting, and so from throwing what
+# it picked up, whatever PICKUP_DELAY says
+_HOLD_DELAY = 10
 
 # terminal formatting
 _TERM_RED = '\033[31m'
 _TERM_END = '\033[0m'
 
+# highest resolution wall clock available (python 2 doesn't have perf_counter)
+_clock = getattr(time, 'perf_counter', time.time)
+
 
 class Direction(object):
     ''' This is an enum for direction '''
@@ -191,6 +230,10 @@ Direction.EAST = Direction(1, 0)
 '''The direction (-1,  0).'''
 Direction.WEST = Direction(-1,  0)
 
+# Direction.directions(), and (dx, dy): place in it
+_DIRECTIONS = Direction.directions()
+_DIRECTION_INDEX = dict(((d.dx, d.dy), i) for i, d in enumerate(_DIRECTIONS))
+
 class Entity(object):
     '''
     An entity in the world: a Thrower, Hedge, or Statue.
@@ -265,45 +308,88 @@ class Entity(object):
     def __ne__(self, other):
         return not (self == other)
 
-    def _update(self, data):
-        if self.location in self._state.map._occupied and \
-            self._state.map._occupied[self.location].id == self.id:
-            del self._state.map._occupied[self.location]
-
-        if __debug__:
-            if self.id is not None:
-                assert data['id'] == self.id
-            if self.type is not None:
-                assert data['type'] == self.type
-            if self.team is not None:
-                assert data['teamID'] == self.team.id
-
-        self.id = data['id']
-        self.type = data['type']
-        self.team = self._state.teams[data['teamID']]
-        self.hp = data['hp']
-        self.location = Location(data['location']['x'], data['location']['y'])
-
-        if 'cooldownEnd' in data:
-            self.cooldown_end = data['cooldownEnd']
-        else:
-            self.cooldown_end = None
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, which are the fields
+        # of an entity whose server data hasn't been read yet.
+        if name not in _LAZY_FIELDS or '_raw' not in self.__dict__:
+            raise AttributeError(name)
+        self._materialize()
+        return self.__dict__[name]
 
-        if 'holdingEnd' in data:
-            self.holding_end = data['holdingEnd']
+    def _set_raw(self, data):
+        '''
+        Take new server data for this entity. Its fields are only filled in
+        from data when one of them is read; see _materialize. held_by and
+        holding aren't among them: State._update_entities links them to the
+        other entity as the data arrives.
+        '''
+        fields = self.__dict__
+        if '_raw' in fields:
+            # nothing has been read since the last data arrived
+            fields.pop('location', None)
         else:
-            self.holding_end = None
-
-        if 'heldBy' in data:
-            self.held_by = self._state.entities[data['heldBy']]
+            for name in _LAZY_FIELDS:
+                fields.pop(name, None)
+        fields['_raw'] = data
+
+    def _materialize(self):
+        fields = self.__dict__
+        data = fields.pop('_raw')
+
+        # fields set since the data arrived, by speculation, win
+        if 'location' not in fields:
+            fields['location'] = Location(data['location']['x'], data['location']['y'])
+        if 'hp' not in fields:
+            fields['hp'] = data['hp']
+        if 'cooldown_end' not in fields:
+            fields['cooldown_end'] = data.get('cooldownEnd')
+        if 'holding_end' not in fields:
+            fields['holding_end'] = data.get('holdingEnd')
+
+    def _matches(self, data, tally):
+        '''True if server data for this entity says nothing new. tally is
+        its entry in State._tallies.'''
+        fields = self.__dict__
+        if fields.get('_raw') is data or fields.get('_raw') == data:
+            return True
+        x, y, held = self._position()
+        location = data['location']
+        if x != location['x'] or y != location['y'] or held != ('heldBy' in data) or \
+                tally is None or tally[4] != data['hp']:
+            return False
+        holding = self.holding
+        return self.cooldown_end == data.get('cooldownEnd') and \
+            self.holding_end == data.get('holdingEnd') and \
+            (self.held_by.id if held else None) == data.get('heldBy') and \
+            (holding.id if holding is not None else None) == data.get('holding')
+
+    def _peek(self, name, key):
+        '''The field name, or what the data says under key if it hasn't been
+        filled in, without filling in the others.'''
+        fields = self.__dict__
+        if name in fields:
+            return fields[name]
+        data = fields.get('_raw')
+        return data.get(key) if data is not None else None
+
+    def _position(self):
+        '''
+        Returns:
+            (int, int, bool): x, y and whether this entity is held, without
+                              filling in its fields
+        '''
+        fields = self.__dict__
+        data = fields.get('_raw')
+        if 'location' in fields:
+            x, y = fields['location']
         else:
-            self.held_by = None
-            self._state.map._occupied[self.location] = self
-
-        if 'holding' in data:
-            self.holding = self._state.entities[data['holding']]
+            x = data['location']['x']
+            y = data['location']['y']
+        if 'held_by' in fields:
+            held = fields['held_by'] is not None
         else:
-            self.holding = None
+            held = 'heldBy' in data
+        return x, y, held
 
     @property
     def cooldown(self):
@@ -392,14 +478,11 @@ class Entity(object):
         if not self.is_holding or not self.can_act:
             return
 
-        held = self.holding
-        initial = self.location
-        target_loc = Location(initial.x+direction.dx, \
-                initial.y+direction.dy)
-        on_map = self._state.map.location_on_map(target_loc)
-        is_occupied = target_loc in self._state.map._occupied
-
-        if ((not on_map) or is_occupied):
+        map = self._state.map
+        x = self.location.x + direction.dx
+        y = self.location.y + direction.dy
+        on_map = 0 <= x < map.width and 0 <= y < map.height
+        if not on_map or map._occupancy[y * map.width + x]:
             return False
         return True
 
@@ -414,12 +497,11 @@ class Entity(object):
         if not self.can_act:
             return False
 
-        location = self.location.adjacent_location_in_direction(direction)
-        on_map = self._state.map.location_on_map(location)
-        is_occupied = location in self._state.map._occupied
-
-
-        if ((not on_map) or is_occupied):
+        map = self._state.map
+        x = self.location.x + direction.dx
+        y = self.location.y + direction.dy
+        on_map = 0 <= x < map.width and 0 <= y < map.height
+        if not on_map or map._occupancy[y * map.width + x]:
             return False
 
         return True
@@ -492,12 +574,18 @@ class Entity(object):
 
         if self._state.speculate:
             if self.can_move(direction):
-                del self._state.map._occupied[self.location]
-                self.location = self.location.adjacent_location_in_direction(direction)
-                if self.holding != None:
-                    self.holding.location = self.location
-                self._state.map._occupied[self.location] = self
-                self.cooldown_end = self._state.turn + 1
+                self._speculate_move(direction)
+
+    def _speculate_move(self, direction):
+        self._state.map._remove(self.location)
+        self.location = self.location.adjacent_location_in_direction(direction)
+        if self.holding != None:
+            self.holding.location = self.location
+            self._state._tally(self.holding)
+        self._state.map._place(self.location, self)
+        self.cooldown_end = self._state.turn + MOVEMENT_DELAY
+        self._state._tally(self)
+        self._state._schedule(self)
 
     def queue_build(self, direction):
         '''
@@ -524,8 +612,12 @@ class Entity(object):
 
         if self._state.speculate:
             if self.can_build(direction):
-                self.cooldown_end = self._state.turn + 10
-                self._state._build_statue(location)
+                self._speculate_build(location)
+
+    def _speculate_build(self, location):
+        self.cooldown_end = self._state.turn + BUILD_DELAY
+        self._state._schedule(self)
+        self._state._build_statue(location)
 
     def _deal_damage(self, damage):
         if self._disintegrated:
@@ -533,17 +625,23 @@ class Entity(object):
 
         self.hp -= damage
         if(self.hp>0):
+            self._state._tally(self)
             return
 
         if self.held_by == None:
-            del self._state.map._occupied[self.location]
+            self._state.map._remove(self.location)
+        else:
+            self._state.map._touch(self.location)
 
-        if self.holding != None:
+        # a held unit that died first stays linked, but isn't dropped
+        if self.holding != None and not self.holding._disintegrated:
             self.holding.held_by = None
-            self._state.map._occupied[self.location] = self.holding
+            self._state.map._place(self.location, self.holding)
+            self._state._schedule(self.holding)
 
         self._disintegrated = True
         del self._state.entities[self.id]
+        self._state._untally(self.id)
 
     def queue_disintegrate(self):
         '''
@@ -587,44 +685,47 @@ class Entity(object):
         })
 
         if self._state.speculate:
-            if not self.can_throw(direction):
-                return
-
-            held = self.holding
-            self.holding = None
-            self.holding_end = None
-            initial = self.location
-            target_loc = Location(initial.x+direction.dx, \
-                    initial.y+direction.dy)
-
-            for i in range(THROW_RANGE+1):
-                on_map = self._state.map.location_on_map(target_loc)
-                is_occupied = target_loc in self._state.map._occupied
-
-                if ((not on_map) or is_occupied):
-                    break
-
-                target_loc = Location(target_loc.x + direction.dx, \
-                        target_loc.y + direction.dy)
+            if self.can_throw(direction):
+                self._speculate_throw(direction)
 
-            target = self._state.map._occupied.get(target_loc, None)
-            if(target != None):
-                if(target.type == Entity.HEDGE):
-                    target._deal_damage(THROW_HEDGE_DAMAGE)
-                else:
-                    target._deal_damage(THROW_ENTITY_DAMAGE)
-                held._deal_damage(THROW_ENTITY_RECOIL)
-
-            landing_location = Location(target_loc.x - direction.dx, \
-                                        target_loc.y - direction.dy)
-            held.location = landing_location
-            if self._state.map.tile_at(landing_location)  == DIRT:
-                held._deal_damage(THROW_ENTITY_DIRT)
-            if not held._disintegrated:
-                self._state.map._occupied[landing_location] = held
-            held.held_by = None
-
-            self.cooldown_end = self._state.turn + 10
+    def _speculate_throw(self, direction):
+        held = self.holding
+        self.holding = None
+        self.holding_end = None
+        initial = self.location
+        map = self._state.map
+        map._touch(initial)
+        x = initial.x + direction.dx
+        y = initial.y + direction.dy
+
+        for i in range(THROW_RANGE+1):
+            on_map = 0 <= x < map.width and 0 <= y < map.height
+            if not on_map or map._occupancy[y * map.width + x]:
+                break
+
+            x += direction.dx
+            y += direction.dy
+
+        target = map.occupant_at(x, y)
+        if(target != None):
+            if(target.type == Entity.HEDGE):
+                target._deal_damage(THROW_HEDGE_DAMAGE)
+            else:
+                target._deal_damage(THROW_ENTITY_DAMAGE)
+            held._deal_damage(THROW_ENTITY_RECOIL)
+
+        landing_location = Location(x - direction.dx, y - direction.dy)
+        held.location = landing_location
+        if self._state.map.tile_at(landing_location)  == DIRT:
+            held._deal_damage(THROW_ENTITY_DIRT)
+        if not held._disintegrated:
+            self._state.map._place(landing_location, held)
+            self._state._tally(held)
+        held.held_by = None
+
+        self.cooldown_end = self._state.turn + THROW_DELAY
+        self._state._schedule(held)
+        self._state._schedule(self)
 
     def queue_pickup(self, entity):
         '''
@@ -648,12 +749,19 @@ class Entity(object):
 
         if self._state.speculate:
             if self.can_pickup(entity):
-                del self._state.map._occupied[entity.location]
-                self.holding = entity
-                entity.held_by = self
-                entity.location = self.location
-                self.holding_end = self._state.turn + 10
-                self.cooldown_end = self._state.turn + 10
+                self._speculate_pickup(entity)
+
+    def _speculate_pickup(self, entity):
+        self._state.map._remove(entity.location)
+        self._state.map._touch(self.location)
+        self.holding = entity
+        entity.held_by = self
+        entity.location = self.location
+        self._state._tally(entity)
+        self.holding_end = self._state.turn + _HOLD_DELAY
+        self.cooldown_end = self._state.turn + _HOLD_DELAY
+        self._state._schedule(self)
+        self._state._schedule(entity)
     def entities_within_adjacent_distance(self, distance, include_held=False,
             iterator=None):
         '''
@@ -676,6 +784,11 @@ class Entity(object):
             [Entities]: Returns a generator for the entities within distance of
                         of this robot
         '''
+        if iterator is None and self._state.memoize:
+            return self._state._memoized_within(self, 'adjacent', distance, include_held)
+        return self._within_adjacent_distance(distance, include_held, iterator)
+
+    def _within_adjacent_distance(self, distance, include_held, iterator):
 
         if iterator != None:
             for entity in iterator:
@@ -719,6 +832,11 @@ class Entity(object):
             [Entities]: Returns a generator for the entities within distance of
                         of this robot
         '''
+        if iterator is None and self._state.memoize:
+            return self._state._memoized_within(self, 'euclidean', distance, include_held)
+        return self._within_euclidean_distance(distance, include_held, iterator)
+
+    def _within_euclidean_distance(self, distance, include_held, iterator):
 
         if iterator != None:
             for entity in iterator:
@@ -743,6 +861,14 @@ Entity.THROWER = 'thrower'
 Entity.HEDGE = 'hedge'
 Entity.STATUE = 'statue'
 
+# the planes of State.to_tensor, in order
+TENSOR_CHANNELS = ('dirt', 'my_thrower', 'my_statue', 'enemy_thrower',
+                   'enemy_statue', 'hedge', 'hp', 'cooldown', 'holding',
+                   'held_mine', 'my_sector', 'enemy_sector')
+
+# Entity fields filled in from server data when they're first read
+_LAZY_FIELDS = frozenset(['location', 'hp', 'cooldown_end', 'holding_end'])
+
 
 class Location(tuple):
     '''
@@ -816,7 +942,7 @@ class Location(tuple):
         Returns:
             float: Distance squared to the location
         '''
-        return max(abs(self.x-location.x), abs(self.x-location.y))
+        return max(abs(self.x-location.x), abs(self.y-location.y))
 
     def direction_to(self, location):
         '''
@@ -882,7 +1008,14 @@ class Sector(object):
             assert self.top_left.y == data['topLeft']['y']
 
         assert data['controllingTeamID']!=-1, "We Done goof"
+        controlled = self._state._sectors_controlled
+        old = self.team
+        if old is not None:
+            controlled[old.id] -= 1
         self.team = self._state.teams[data['controllingTeamID']]
+        controlled[self.team.id] = controlled.get(self.team.id, 0) + 1
+        if old is None or old.id != self.team.id:
+            self._state.map._sector_version += 1
 
     def __eq__(self, other):
         if not isinstance(other, Sector):
@@ -904,6 +1037,31 @@ class Sector(object):
                continue
             yield entity
 
+    def count(self, team=None, entity_type=None):
+        '''
+        Count the entities in this sector without scanning them. Held
+        entities are counted where their holder is.
+        Args:
+            team (Team): only count entities on this team
+            entity_type (string): only count entities of this type
+        Returns:
+            int: the number of matching entities in this sector
+        '''
+        return self._state._count(self._state._sector_counts, tuple(self.top_left),
+                                  team, entity_type)
+
+
+# byte maps for Map's occupancy layers: 0 and 1 swapped, and 1 to 1 << slot
+_FLIP_BYTES = bytes(bytearray([1, 0]) + bytearray(254))
+_BIT_BYTES = [bytes(bytearray([0, 1 << slot]) + bytearray(254)) for slot in range(8)]
+
+def _bytes_int(data):
+    '''A byte layer as one int, byte i in bits 8 * i up, to combine whole layers.'''
+    return int(binascii.hexlify(bytes(data[::-1])), 16) if data else 0
+
+def _int_bytes(value, size):
+    '''The inverse of _bytes_int.'''
+    return binascii.unhexlify('%0*x' % (2 * size, value))[::-1]
 
 class Map(object):
     '''
@@ -924,7 +1082,23 @@ class Map(object):
         self._sectors = {}
 
         # occupied maps Location to Entity
+        # only change it through _place and _remove, which keep track of
+        # when every tile last changed, and of the same as a dense grid:
+        # the id of the entity on every tile (y * width + x) or -1, and a byte
+        # per tile that's 1 where there's an entity, then the same for each
+        # team id and entity type. See occupancy().
         self._occupied = {}
+        self._occupant = array.array('i', [-1]) * (width * height)
+        self._occupancy = bytearray(width * height)
+        self._team_layers = {}
+        self._type_layers = {}
+        self._version = 0
+        self._tile_versions = [0] * (width * height)
+        # bumped whenever a sector changes hands, which _version doesn't see
+        self._sector_version = 0
+        # (tile index, direction slot) to (version, path, landing), see _throw_edge
+        self._throw_edges = {}
+        self._analysis_key = None
         for x in range(0, self.width, self.sector_size):
             for y in range(0, self.height, self.sector_size):
                 top_left = Location(x, y)
@@ -975,6 +1149,248 @@ class Map(object):
         )
         return self._sectors[loc]
 
+    def occupant_at(self, x, y):
+        '''
+        The entity on a tile, without making a Location to look it up.
+        Args:
+            x (int): the tile's x coordinate
+            y (int): the tile's y coordinate
+        Returns:
+            Entity: the entity there, or None if the tile is empty or off the map
+        '''
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        id = self._occupant[y * self.width + x]
+        return None if id < 0 else self._state.entities[id]
+
+    def is_occupied(self, x, y):
+        '''
+        Args:
+            x (int): the tile's x coordinate
+            y (int): the tile's y coordinate
+        Returns:
+            bool: True if there's an entity on the tile. Tiles off the map
+                  aren't occupied, though nothing can go there either.
+        '''
+        return 0 <= x < self.width and 0 <= y < self.height and \
+            self._occupancy[y * self.width + x] == 1
+
+    def occupancy(self, team=None, type=None):
+        '''
+        The whole map's occupancy, to work on at once rather than a tile at a
+        time.
+        Args:
+            team (Team): only count this team's entities
+            type (str): only count entities of this type, e.g. Entity.THROWER
+        Returns:
+            bytearray: a byte per tile, y * width + x, that's 1 where there's
+                       such an entity and 0 elsewhere
+        '''
+        area = self.width * self.height
+        if team is None and type is None:
+            return bytearray(self._occupancy)
+        if team is None:
+            return bytearray(self._type_layers.get(type) or area)
+        result = self._team_layers.get(team.id) or bytearray(area)
+        if type is None:
+            return bytearray(result)
+        layer = self._type_layers.get(type)
+        if layer is None:
+            return bytearray(area)
+        both = _bytes_int(result) & _bytes_int(layer)
+        return bytearray(_int_bytes(both, area))
+
+    def free_neighbours(self):
+        '''
+        Where every tile's neighbours are free, for the whole map at once.
+        Returns:
+            bytearray: a byte per tile, y * width + x, with bit d set if the
+                tile next to it in Direction.directions()[d] is on the map
+                and empty
+        '''
+        width = self.width
+        area = width * self.height
+        free = bytearray(self._occupancy.translate(_FLIP_BYTES))
+        # neighbours across the left and right edges aren't on the map
+        left_edge = bytearray(area)
+        left_edge[::width] = bytearray(b'\x01') * self.height
+        right_edge = bytearray(area)
+        right_edge[width - 1::width] = bytearray(b'\x01') * self.height
+        left_edge = _bytes_int(left_edge)
+        right_edge = _bytes_int(right_edge)
+
+        result = 0
+        for slot, direction in enumerate(_DIRECTIONS):
+            offset = direction.dy * width + direction.dx
+            # neighbour[i] = free[i + offset], or 0 past the top or bottom
+            if offset > 0:
+                neighbour = free[offset:] + bytearray(offset)
+            else:
+                neighbour = bytearray(-offset) + free[:area + offset]
+            neighbour = _bytes_int(neighbour.translate(_BIT_BYTES[slot]))
+            if direction.dx < 0:
+                neighbour &= ~(left_edge << slot)
+            elif direction.dx > 0:
+                neighbour &= ~(right_edge << slot)
+            result |= neighbour
+        return bytearray(_int_bytes(result, area))
+
+    def sector_counts(self, team=None, type=None):
+        '''
+        How many tiles of each sector are occupied.
+        Args:
+            team (Team): only count this team's entities
+            type (str): only count entities of this type
+        Returns:
+            {Location: int}: the count for each sector, by its top left corner
+        '''
+        layer = self.occupancy(team, type)
+        width = self.width
+        size = self.sector_size
+        counts = {}
+        for top_left in self._sectors:
+            x, y = top_left
+            right = min(x + size, width)
+            count = 0
+            for row in range(y, min(y + size, self.height)):
+                count += layer.count(b'\x01', row * width + x, row * width + right)
+            counts[top_left] = count
+        return counts
+
+    def _place(self, location, entity):
+        index = location[1] * self.width + location[0]
+        old = self._occupied.get(location)
+        if old is not None:
+            self._team_layers[old.team.id][index] = 0
+            self._type_layers[old.type][index] = 0
+        self._occupied[location] = entity
+        self._occupant[index] = entity.id
+        self._occupancy[index] = 1
+        layer = self._team_layers.get(entity.team.id)
+        if layer is None:
+            layer = self._team_layers[entity.team.id] = bytearray(len(self._occupancy))
+        layer[index] = 1
+        layer = self._type_layers.get(entity.type)
+        if layer is None:
+            layer = self._type_layers[entity.type] = bytearray(len(self._occupancy))
+        layer[index] = 1
+        self._version += 1
+        self._tile_versions[index] = self._version
+
+    def _remove(self, location):
+        index = location[1] * self.width + location[0]
+        entity = self._occupied.pop(location)
+        self._occupant[index] = -1
+        self._occupancy[index] = 0
+        self._team_layers[entity.team.id][index] = 0
+        self._type_layers[entity.type][index] = 0
+        self._version += 1
+        self._tile_versions[index] = self._version
+
+    def _touch(self, location):
+        '''Mark a tile as changed when a held unit there comes or goes.'''
+        self._version += 1
+        self._tile_versions[location[1] * self.width + location[0]] = self._version
+
+    def _region(self, location, radius):
+        '''Indices of the tiles within radius tiles of location.'''
+        x, y = location
+        radius = int(radius)
+        left = max(x - radius, 0)
+        right = min(x + radius, self.width - 1)
+        result = []
+        for row in range(max(y - radius, 0), min(y + radius, self.height - 1) + 1):
+            result.extend(range(row * self.width + left, row * self.width + right + 1))
+        return result
+
+    def _changed_since(self, indices, version):
+        '''True if any of the tiles at these indices changed after version'''
+        tile_versions = self._tile_versions
+        for index in indices:
+            if tile_versions[index] > version:
+                return True
+        return False
+
+    def _throw_path(self, location, direction):
+        '''
+        Walk a throw from location in direction the way queue_throw does.
+        Returns:
+            ([int], [int], Entity): the indices of every tile the throw
+                looks at, the indices of the tiles where a unit would be hit
+                by it, and the entity it would hit, if any. Nothing can be hit
+                if the adjacent tile is blocked.
+        '''
+        width = self.width
+        height = self.height
+        occupant = self._occupant
+        x, y = location
+        dx = direction.dx
+        dy = direction.dy
+
+        path = []
+        for distance in range(THROW_RANGE + 2):
+            x += dx
+            y += dy
+            if not (0 <= x < width and 0 <= y < height):
+                break
+            index = y * width + x
+            path.append(index)
+            if occupant[index] >= 0:
+                if distance == 0:
+                    return path, [], None
+                return path, path[1:], self._state.entities[occupant[index]]
+        return path, path[1:], None
+
+    def _throw_edge(self, index, slot, vacant=-1):
+        '''
+        Where a unit thrown from the tile at index lands, by the rules of
+        queue_throw, starting from the map's throw_rays and cutting them
+        short at the first unit in the way. Results are kept until a tile
+        along the ray changes.
+        Args:
+            index (int): the thrower's tile, y * width + x
+            slot (int): the direction's place in Direction.directions()
+            vacant (int): a tile index to treat as empty, or -1
+        Returns:
+            (int, bool, bool): the landing tile's index, whether the unit hits
+                another on the way down, and whether it lands on dirt; None
+                if the tile next to the thrower is blocked
+        '''
+        key = (index, slot)
+        cached = self._throw_edges.get(key)
+        if cached is not None:
+            version, path, landing = cached
+            if not self._changed_since(path, version) and vacant not in path:
+                return landing
+
+        width = self.width
+        occupancy = self._occupancy
+        x = index % width
+        y = index // width
+        direction = _DIRECTIONS[slot]
+        length, dirt = self.analysis().throw_ray(Location(x, y), direction)
+        path = []
+        free = 0
+        blocked = False
+        for _ in range(min(length, THROW_RANGE + 2)):
+            x += direction.dx
+            y += direction.dy
+            tile = y * width + x
+            path.append(tile)
+            if tile != vacant and occupancy[tile]:
+                blocked = True
+                break
+            free += 1
+
+        steps = min(free, THROW_RANGE + 1)
+        if steps == 0:
+            landing = None
+        else:
+            landing = (path[steps - 1], blocked, bool(dirt >> (steps - 1) & 1))
+        if vacant not in path:
+            self._throw_edges[key] = (self._version, path, landing)
+        return landing
+
     def _update_sectors(self, data):
         for sector_data in data:
             top_left = Location(sector_data['topLeft']['x'], sector_data['topLeft']['y'])
@@ -983,6 +1399,420 @@ class Map(object):
                 assert top_left.y % self.sector_size == 0
             self._sectors[top_left]._update(sector_data)
 
+    def analysis(self, cache_dir=None):
+        '''
+        Returns the MapAnalysis for this map. The first time a map is seen
+        it's computed and saved in cache_dir; after that it's loaded from
+        there, which is much faster.
+        Args:
+            cache_dir (str): where to keep analyses. Defaults to the
+                BATTLECODE_CACHE environment variable, or ~/.cache/battlecode.
+                False keeps it in memory only.
+        Returns:
+            MapAnalysis: the analysis, shared with every copy of the state
+        '''
+        key = self._analysis_key
+        if key is None:
+            key = self._analysis_key = MapAnalysis._key(self)
+        result = _map_analyses.get(key)
+        if result is None:
+            result = MapAnalysis._load_or_build(self, key, cache_dir)
+            _map_analyses[key] = result
+        return result
+
+# analysis key: MapAnalysis, kept out of Map so state copies don't copy them
+_map_analyses = {}
+
+class MapAnalysis(object):
+    '''
+    Facts about a map's tiles that stay the same for the whole match. Get
+    one with Map.analysis().
+
+    Per-tile sequences are indexed y*width+x.
+    Attributes:
+        key (str): hash of the map's size, tiles and the cache file format
+        width (int), height (int), sector_size (int): as for the Map
+        dirt: 1 for dirt tiles, 0 for grass
+        dirt_around: the number of dirt tiles among the 8 around each tile
+        sector_dirt: the number of dirt tiles in each sector, indexed by
+            (top_left.y // sector_size) * sectors_wide + top_left.x // sector_size
+        throw_rays: indexed tile*8 + the Direction's place in
+            Direction.directions(); see throw_ray()
+    '''
+
+    _MAGIC = b'BCMA'
+    _FORMAT = 1
+    _HEADER = struct.Struct('<4sIIII')
+
+    def __init__(self, key, width, height, sector_size, dirt, dirt_around,
+                 sector_dirt, throw_rays):
+        self.key = key
+        self.width = width
+        self.height = height
+        self.sector_size = sector_size
+        self.sectors_wide = -(-width // sector_size)
+        self.dirt = dirt
+        self.dirt_around = dirt_around
+        self.sector_dirt = sector_dirt
+        self.throw_rays = throw_rays
+
+    def is_dirt(self, location):
+        '''
+        Args:
+            location (Location): a location on the map
+        Returns:
+            bool: True if the tile there is dirt
+        '''
+        return self.dirt[location[1] * self.width + location[0]] == 1
+
+    def throw_ray(self, location, direction):
+        '''
+        The tiles a throw from location in direction could reach, ignoring
+        other units.
+        Args:
+            location (Location): where the thrower stands
+            direction (Direction): the way it throws
+        Returns:
+            (int, int): how many tiles along the ray are on the map, and a
+                bitmask where bit i is set if the tile i+1 steps away is dirt
+        '''
+        ray = self.throw_rays[(location[1] * self.width + location[0]) * 8 +
+                              _DIRECTION_INDEX[direction.dx, direction.dy]]
+        return ray & 15, ray >> 4
+
+    def sector_centroid(self, sector):
+        '''
+        Args:
+            sector (Sector): a sector of this map
+        Returns:
+            (float, float): the middle of the sector's tiles; sectors on the
+                right and top edges may be cut short by the map
+        '''
+        x, y = sector.top_left
+        right = min(x + self.sector_size, self.width)
+        top = min(y + self.sector_size, self.height)
+        return ((x + right - 1) / 2.0, (y + top - 1) / 2.0)
+
+    def sector_dirt_count(self, sector):
+        '''
+        Args:
+            sector (Sector): a sector of this map
+        Returns:
+            int: the number of dirt tiles in it
+        '''
+        x, y = sector.top_left
+        return self.sector_dirt[(y // self.sector_size) * self.sectors_wide +
+                                x // self.sector_size]
+
+    @staticmethod
+    def _key(game_map):
+        digest = hashlib.sha1()
+        digest.update('{} {} {} {} {} {}\n'.format(
+            MapAnalysis._FORMAT, sys.byteorder, THROW_RANGE,
+            game_map.width, game_map.height, game_map.sector_size).encode())
+        for row in game_map.tiles:
+            digest.update(row.encode())
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    @staticmethod
+    def _load_or_build(game_map, key, cache_dir):
+        if cache_dir is None:
+            cache_dir = os.environ.get('BATTLECODE_CACHE',
+                os.path.join(os.path.expanduser('~'), '.cache', 'battlecode'))
+        if cache_dir is False:
+            return MapAnalysis._build(game_map, key)
+
+        path = os.path.join(cache_dir, key + '.map')
+        result = MapAnalysis._load(path, key)
+        if result is None:
+            result = MapAnalysis._build(game_map, key)
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                result._save(path)
+            except (IOError, OSError) as e:
+                sys.stderr.write('Battlecode warning: could not cache map analysis: {}\n'.format(e))
+        return result
+
+    @staticmethod
+    def _build(game_map, key):
+        width = game_map.width
+        height = game_map.height
+        sector_size = game_map.sector_size
+        size = width * height
+
+        dirt = array.array('B', [0]) * size
+        for row, line in enumerate(game_map.tiles):
+            base = (height - row - 1) * width
+            for x, tile in enumerate(line):
+                if tile == DIRT:
+                    dirt[base + x] = 1
+
+        sectors_wide = -(-width // sector_size)
+        sectors_high = -(-height // sector_size)
+        sector_dirt = array.array('I', [0]) * (sectors_wide * sectors_high)
+        dirt_around = array.array('B', [0]) * size
+        throw_rays = array.array('H', [0]) * (size * 8)
+        deltas = [(d.dx, d.dy) for d in Direction.directions()]
+        steps = range(THROW_RANGE + 2)
+
+        for y in range(height):
+            for x in range(width):
+                index = y * width + x
+                if dirt[index]:
+                    sector_dirt[(y // sector_size) * sectors_wide + x // sector_size] += 1
+                around = 0
+                for slot, (dx, dy) in enumerate(deltas):
+                    length = 0
+                    mask = 0
+                    cx = x
+                    cy = y
+                    for step in steps:
+                        cx += dx
+                        cy += dy
+                        if not (0 <= cx < width and 0 <= cy < height):
+                            break
+                        length += 1
+                        if dirt[cy * width + cx]:
+                            mask |= 1 << step
+                    around += mask & 1
+                    throw_rays[index * 8 + slot] = length | mask << 4
+                dirt_around[index] = around
+
+        return MapAnalysis(key, width, height, sector_size, dirt, dirt_around,
+                           sector_dirt, throw_rays)
+
+    def _save(self, path):
+        # write a temp file and rename it, so readers never see half a file
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(MapAnalysis._HEADER.pack(MapAnalysis._MAGIC, MapAnalysis._FORMAT,
+                                             self.width, self.height, self.sector_size))
+            for data in (self.sector_dirt, self.throw_rays, self.dirt, self.dirt_around):
+                f.write(data.tobytes() if hasattr(data, 'tobytes') else data.tostring())
+        try:
+            os.rename(temp, path)
+        except OSError:
+            # windows won't replace a file another bot saved meanwhile
+            os.remove(temp)
+
+    @staticmethod
+    def _load(path, key):
+        try:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        header = MapAnalysis._HEADER
+        if len(data) < header.size:
+            return None
+        magic, version, width, height, sector_size = header.unpack_from(data)
+        if magic != MapAnalysis._MAGIC or version != MapAnalysis._FORMAT:
+            return None
+        size = width * height
+        sectors = -(-width // sector_size) * -(-height // sector_size)
+
+        offset = header.size
+        parts = []
+        for typecode, count in (('I', sectors), ('H', size * 8), ('B', size), ('B', size)):
+            end = offset + count * array.array(typecode).itemsize
+            if end > len(data):
+                return None
+            parts.append(_typed_view(data, typecode, offset, end))
+            offset = end
+        sector_dirt, throw_rays, dirt, dirt_around = parts
+        return MapAnalysis(key, width, height, sector_size, dirt, dirt_around,
+                           sector_dirt, throw_rays)
+
+def _typed_view(data, typecode, start, end):
+    '''data[start:end] as a sequence of typecode, without copying if we can'''
+    if hasattr(memoryview, 'cast'):
+        return memoryview(data)[start:end].cast(typecode)
+    result = array.array(typecode)
+    result.fromstring(data[start:end])
+    return result
+
+class DistanceField(object):
+    '''
+    How many king moves it takes to get from every tile to the nearest
+    source: a unit of some team or type, or any tile of a sector some team
+    controls. Units don't block the way. Get one from
+    State.distance_field(); it keeps itself up to date as sources come, go
+    and move, repairing only the tiles around the ones that changed.
+    Attributes:
+        width (int): the width of the map
+        height (int): the height of the map
+    '''
+
+    # the distance of every tile while there are no sources
+    FAR = 1 << 30
+
+    def __init__(self, map, team_id, entity_type, sector_team_id):
+        self._map = map
+        self.width = map.width
+        self.height = map.height
+        self._team_id = team_id
+        self._entity_type = entity_type
+        self._sector_team_id = sector_team_id
+        self._distances = array.array('i', [DistanceField.FAR]) * (map.width * map.height)
+        self._sources = set()
+        self._version = -1
+
+    @property
+    def distances(self):
+        '''
+        Returns:
+            array.array: the distance for every tile, indexed by
+                         y * width + x. Don't modify it.
+        '''
+        self._refresh()
+        return self._distances
+
+    def at(self, location):
+        '''
+        Args:
+            location (Location): a tile on the map
+        Returns:
+            int: the distance from location to the nearest source, or
+                 DistanceField.FAR if there aren't any
+        '''
+        self._refresh()
+        return self._distances[location.y * self.width + location.x]
+
+    def _current_sources(self):
+        '''The tile indices of the sources right now.'''
+        map = self._map
+        width = self.width
+        if self._sector_team_id is not None:
+            size = map.sector_size
+            sources = set()
+            for top_left, sector in map._sectors.items():
+                if sector.team is None or sector.team.id != self._sector_team_id:
+                    continue
+                for y in range(top_left.y, min(top_left.y + size, self.height)):
+                    row = y * width
+                    sources.update(range(row + top_left.x,
+                                         row + min(top_left.x + size, width)))
+            return sources
+        team_id = self._team_id
+        entity_type = self._entity_type
+        return set(location[1] * width + location[0]
+                   for location, entity in map._occupied.items()
+                   if (team_id is None or entity.team.id == team_id) and
+                   (entity_type is None or entity.type == entity_type))
+
+    def _refresh(self):
+        map = self._map
+        if self._sector_team_id is None:
+            version = map._version
+        else:
+            version = map._sector_version
+        if self._version == version:
+            return
+        self._version = version
+        sources = self._current_sources()
+        removed = self._sources - sources
+        added = sources - self._sources
+        if not removed and not added:
+            return
+        self._sources = sources
+        if len(removed) + len(added) > len(sources) // 2:
+            # about as cheap to start over
+            self._distances[:] = array.array('i', [DistanceField.FAR]) * len(self._distances)
+            self._spread(list(sources))
+            return
+        if removed:
+            self._repair(removed)
+        if added:
+            self._spread(list(added))
+
+    def _neighbour_table(self):
+        '''For every tile index, the indices of the tiles around it.'''
+        key = (self.width, self.height)
+        table = _neighbour_tables.get(key)
+        if table is None:
+            width, height = key
+            table = []
+            for y in range(height):
+                for x in range(width):
+                    table.append(tuple(ny * width + nx
+                                       for ny in (y - 1, y, y + 1) if 0 <= ny < height
+                                       for nx in (x - 1, x, x + 1) if 0 <= nx < width
+                                       if nx != x or ny != y))
+            table = _neighbour_tables[key] = tuple(table)
+        return table
+
+    def _spread(self, sources):
+        '''Breadth-first search out from new sources, lowering distances.'''
+        distances = self._distances
+        neighbours = self._neighbour_table()
+        frontier = []
+        for index in sources:
+            if distances[index] != 0:
+                distances[index] = 0
+                frontier.append(index)
+        distance = 0
+        while frontier:
+            distance += 1
+            next_frontier = []
+            for index in frontier:
+                for neighbour in neighbours[index]:
+                    if distances[neighbour] > distance:
+                        distances[neighbour] = distance
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+
+    def _repair(self, removed):
+        '''
+        Fix the distances after sources went away. The tiles whose nearest
+        source may have been one of them are the ones reached by walking
+        away from it one step further at a time; they're forgotten and
+        filled back in from the tiles around them.
+        '''
+        distances = self._distances
+        neighbours = self._neighbour_table()
+        far = DistanceField.FAR
+
+        affected = set(removed)
+        frontier = list(removed)
+        while frontier:
+            next_frontier = []
+            for index in frontier:
+                farther = distances[index] + 1
+                for neighbour in neighbours[index]:
+                    if distances[neighbour] == farther and neighbour not in affected:
+                        affected.add(neighbour)
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        for index in affected:
+            distances[index] = far
+
+        # the closest any untouched neighbour gets each tile, then spread
+        # those out in order of distance
+        buckets = {}
+        for index in affected:
+            best = far
+            for neighbour in neighbours[index]:
+                if distances[neighbour] < best:
+                    best = distances[neighbour]
+            if best < far:
+                distances[index] = best + 1
+                buckets.setdefault(best + 1, []).append(index)
+        while buckets:
+            distance = min(buckets)
+            for index in buckets.pop(distance):
+                if distances[index] != distance:
+                    continue
+                for neighbour in neighbours[index]:
+                    if distances[neighbour] > distance + 1:
+                        distances[neighbour] = distance + 1
+                        buckets.setdefault(distance + 1, []).append(neighbour)
+
+# (width, height): neighbour indices of every tile, see DistanceField
+_neighbour_tables = {}
+
 class Team(object):
     '''
     Information about the teams
@@ -1016,8 +1846,12 @@ class State(object):
         teams ([Teams]): An array of teams indexed by id
         my_team (Team): My team
         my_team_id (int): The id of my team
+        changes (Changes): What happened since our last turn
         speculate (bool): Pretends that the engine is running locally so it
                           makes sure the code is good. Don't teach.
+        memoize (bool): Remember the results of get_entities and
+                        entities_within_* for the rest of the turn. They're
+                        recomputed when something they depend on changes.
     '''
 
     def __init__(self, game, teams, my_team_id, initialState):
@@ -1047,9 +1881,48 @@ class State(object):
 
         self._action_queue = []
 
+        # aggregates kept up to date by _tally and Sector._update
+        # _tallies maps entity id to what it was counted as:
+        # (team id, type, sector x, sector y, hp)
+        self._tallies = {}
+        # (team id, type) to count
+        self._unit_counts = {}
+        # (sector x, sector y, team id, type) to count
+        self._sector_counts = {}
+        # team id to summed hp
+        self._team_hp = {}
+        # team id to number of sectors controlled
+        self._sectors_controlled = {}
+
+        # team id to (damage grid, {thrower id: contribution}), see _influence
+        self._influence_cache = {}
+
+        # (team id, entity type, sector team id) to DistanceField
+        self._distance_fields = {}
+
+        # the tiles to_tensor last wrote a cooldown to, by index
+        self._cooling_tiles = set()
+
+        # when every thrower can next act, see _schedule_values: id to
+        # (turn, held), and a heap of (turn, id) entries that are out of date
+        # once the id's turn is different
+        self._ready_keys = {}
+        self._ready_heap = []
+        # the turn the heap has been emptied up to: team id to the ids that
+        # can act then, and the held ids whose hold has run out by then
+        self._ready_turn = None
+        self._ready = {}
+        self._ready_held = set()
+
         self._update_entities(initialState['entities'])
         self.map._update_sectors(initialState['sectors'])
 
+        self.changes = Changes()
+
+        # query key: (result, what it was computed from), see _memoized_*
+        self.memoize = False
+        self._memo = {}
+
         self.speculate = True
 
     @property
@@ -1061,13 +1934,95 @@ class State(object):
     def _queue(self, action):
         self._game._queue(action)
 
+    def _queue_all(self, actions):
+        self._game._queue_all(actions)
+
     def _update_entities(self, data):
-        for entity in data:
-            id = entity['id']
-            self._max_id = max(self._max_id, id)
-            if id not in self.entities:
-                self.entities[id] = Entity(self)
-            self.entities[id]._update(entity)
+        '''
+        Apply a list of entity data from the server in one pass. The
+        occupancy, aggregates and held_by and holding links are updated
+        straight from the data; the other Entity fields are only read from
+        it when the bot looks at them.
+        '''
+        entities = self.entities
+        teams = self.teams
+        map = self.map
+        occupied = map._occupied
+        max_id = self._max_id
+        ready_keys = self._ready_keys
+        # held units, whose turn to act depends on their holder's data
+        held_ids = []
+        # entities holding or held by one that may come later in the list
+        linked = []
+
+        for entity_data in data:
+            id = entity_data['id']
+            location = entity_data['location']
+            x = location['x']
+            y = location['y']
+            held = 'heldBy' in entity_data
+
+            entity = entities.get(id)
+            if entity is None:
+                if id > max_id:
+                    max_id = id
+                entity = Entity(self)
+                entity.id = id
+                entity.type = entity_data['type']
+                entity.team = teams[entity_data['teamID']]
+                entities[id] = entity
+                moved = True
+                old_x = old_y = None
+                old_held = True
+            else:
+                if __debug__:
+                    assert entity_data['type'] == entity.type
+                    assert entity_data['teamID'] == entity.team.id
+                old_x, old_y, old_held = entity._position()
+                moved = old_held or held or old_x != x or old_y != y
+
+            old_location = entity.__dict__.get('location')
+            entity._set_raw(entity_data)
+            if held or 'holding' in entity_data:
+                linked.append((entity, entity_data))
+            else:
+                entity.held_by = None
+                entity.holding = None
+
+            if moved:
+                if not old_held:
+                    old_location = Location(old_x, old_y)
+                    if occupied.get(old_location) is entity:
+                        map._remove(old_location)
+                if not held:
+                    location = Location(x, y)
+                    map._place(location, entity)
+                    entity.location = location
+            elif old_location is not None:
+                entity.location = old_location
+
+            self._tally_values(id, entity_data['teamID'], entity_data['type'], x, y,
+                               entity_data['hp'])
+            if entity_data['type'] == Entity.THROWER:
+                if held:
+                    held_ids.append(id)
+                else:
+                    cooldown_end = entity_data.get('cooldownEnd')
+                    if ready_keys.get(id) != (cooldown_end or 0, False):
+                        self._schedule_values(id, entity_data['teamID'], cooldown_end, False, None)
+                if 'holding' in entity_data:
+                    held_ids.append(entity_data['holding'])
+
+        self._max_id = max_id
+        for entity, entity_data in linked:
+            held_by = entity_data.get('heldBy')
+            holding = entity_data.get('holding')
+            entity.held_by = None if held_by is None else entities.get(held_by)
+            entity.holding = None if holding is None else entities.get(holding)
+        for id in held_ids:
+            entity = entities.get(id)
+            if entity is not None:
+                self._schedule(entity)
 
     def _build_statue(self, location):
         ''' Build a statue in this state at locatiion location '''
@@ -1083,24 +2038,399 @@ class State(object):
             },
             'hp': 1
         }
-        self.entities[self._max_id] = Entity(self)
-        self.entities[self._max_id]._update(data)
+        self._update_entities([data])
 
     def _kill_entities(self, entities):
         for dead in entities:
             if dead in self.entities:
+                self._untally(dead)
                 ent = self.entities[dead]
-                if(ent.held_by == None):
-                    if self.map._occupied[ent.location].id == ent.id:
-                        if ent.location in self.map._occupied:
-                            del self.map._occupied[ent.location]
+                x, y, held = ent._position()
+                if not held:
+                    location = Location(x, y)
+                    if self.map._occupied.get(location) is ent:
+                        self.map._remove(location)
                 del self.entities[dead]
 
+    def _tally(self, entity):
+        ''' Recount entity in the aggregates after it changed '''
+        if entity._disintegrated:
+            self._untally(entity.id)
+            return
+
+        x, y = entity.location
+        self._tally_values(entity.id, entity.team.id, entity.type, x, y, entity.hp)
+
+    def _tally_values(self, id, team_id, type, x, y, hp):
+        size = self.map.sector_size
+        tally = (team_id, type, x - x % size, y - y % size, hp)
+        old = self._tallies.get(id)
+        if old == tally:
+            return
+        if old is not None:
+            self._add_tally(old, -1)
+        self._tallies[id] = tally
+        self._add_tally(tally, 1)
+
+    def _untally(self, id):
+        ''' Remove the entity with this id from the aggregates '''
+        tally = self._tallies.pop(id, None)
+        if tally is not None:
+            self._add_tally(tally, -1)
+        if self._ready_keys.pop(id, None) is not None:
+            self._ready_held.discard(id)
+            for ready in self._ready.values():
+                ready.discard(id)
+
+    def _schedule(self, entity):
+        ''' Recompute when entity can next act after its cooldown or hold changed '''
+        if entity._disintegrated or not entity.is_thrower:
+            return
+        # peek rather than read the fields, which would fill them all in
+        held_by = entity.held_by
+        holding_end = None
+        if held_by is not None:
+            holding_end = held_by._peek('holding_end', 'holdingEnd')
+        self._schedule_values(entity.id, entity.team.id,
+                              entity._peek('cooldown_end', 'cooldownEnd'),
+                              held_by is not None, holding_end)
+
+    def _schedule_values(self, id, team_id, cooldown_end, held, holding_end):
+        '''
+        A thrower can act from its cooldown_end on, and a held one from when
+        its holder's hold runs out at the earliest; it goes in the heap until
+        then.
+        '''
+        turn = cooldown_end or 0
+        if held:
+            turn = max(turn, holding_end if holding_end is not None else float('inf'))
+        entry = (turn, held)
+        keys = self._ready_keys
+        old = keys.get(id)
+        if old == entry:
+            return
+        keys[id] = entry
+        ready_turn = self._ready_turn
+        if ready_turn is not None:
+            if old is not None and old[0] <= ready_turn:
+                # it was taken out of the heap already
+                if old[1]:
+                    self._ready_held.discard(id)
+                else:
+                    self._ready[team_id].discard(id)
+            if turn <= ready_turn:
+                if held:
+                    self._ready_held.add(id)
+                else:
+                    ready = self._ready.get(team_id)
+                    if ready is None:
+                        ready = self._ready[team_id] = set()
+                    ready.add(id)
+                return
+        heap = self._ready_heap
+        heapq.heappush(heap, (turn, id))
+        if len(heap) > 2 * len(keys) + 64:
+            # too many out of date entries
+            self._ready_heap = [(key, id) for id, (key, _) in keys.items()
+                                if ready_turn is None or key > ready_turn]
+            heapq.heapify(self._ready_heap)
+
+    def _drain_ready(self, turn):
+        '''Move everything that can act by turn out of the heap.'''
+        keys = self._ready_keys
+        if self._ready_turn is None or turn < self._ready_turn:
+            self._ready = {}
+            self._ready_held = set()
+            self._ready_heap = [(key, id) for id, (key, _) in keys.items()]
+            heapq.heapify(self._ready_heap)
+        heap = self._ready_heap
+        entities = self.entities
+        ready = self._ready
+        while heap and heap[0][0] <= turn:
+            key, id = heapq.heappop(heap)
+            entry = keys.get(id)
+            if entry is None or entry[0] != key:
+                continue
+            if entry[1]:
+                self._ready_held.add(id)
+                continue
+            team_id = entities[id].team.id
+            team_ready = ready.get(team_id)
+            if team_ready is None:
+                team_ready = ready[team_id] = set()
+            team_ready.add(id)
+        self._ready_turn = turn
+
+    def ready_units(self, team=None):
+        '''
+        The units that can act this turn, the same ones as checking can_act
+        on all of them, but found without looking at the units that are
+        cooling down or held.
+        Args:
+            team (Team): whose units; defaults to my team
+        Returns:
+            [Entity]: the units, by id
+        '''
+        self._drain_ready(self.turn)
+        team_id = (team or self.my_team).id
+        entities = self.entities
+        return [entities[id] for id in sorted(self._ready.get(team_id, ()))]
+
+    def units_ready_at(self, turn, team=None):
+        '''
+        The units that will be able to act on turn if nothing else happens:
+        their cooldowns are over by then, and a held unit is counted from when
+        its holder's hold runs out (holding_end).
+        Args:
+            turn (int): a turn from now on
+            team (Team): whose units; defaults to my team
+        Returns:
+            [Entity]: the units, by id
+        '''
+        self._drain_ready(self.turn)
+        team_id = (team or self.my_team).id
+        entities = self.entities
+        ids = set(self._ready.get(team_id, ()))
+        for id in self._ready_held:
+            if entities[id].team.id == team_id:
+                ids.add(id)
+
+        # the heap entries due by turn are its root and those below them
+        keys = self._ready_keys
+        heap = self._ready_heap
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i >= len(heap) or heap[i][0] > turn:
+                continue
+            key, id = heap[i]
+            entry = keys.get(id)
+            if entry is not None and entry[0] == key and entities[id].team.id == team_id:
+                ids.add(id)
+            stack.append(2 * i + 1)
+            stack.append(2 * i + 2)
+        return [entities[id] for id in sorted(ids)]
+
+    def _add_tally(self, tally, sign):
+        team_id, type, sector_x, sector_y, hp = tally
+        counts = self._unit_counts
+        key = (team_id, type)
+        counts[key] = counts.get(key, 0) + sign
+        counts = self._sector_counts
+        key = (sector_x, sector_y, team_id, type)
+        counts[key] = counts.get(key, 0) + sign
+        self._team_hp[team_id] = self._team_hp.get(team_id, 0) + sign * hp
+
+    def _count(self, counts, prefix, team, entity_type):
+        if team is None:
+            team_ids = self.teams
+        else:
+            team_ids = (team.id,)
+        if entity_type is None:
+            types = (Entity.THROWER, Entity.STATUE, Entity.HEDGE)
+        else:
+            types = (entity_type,)
+
+        total = 0
+        for team_id in team_ids:
+            for type in types:
+                total += counts.get(prefix + (team_id, type), 0)
+        return total
+
+    def count(self, team=None, entity_type=None):
+        '''
+        Count entities without scanning them.
+        Args:
+            team (Team): only count entities on this team
+            entity_type (string): only count entities of this type
+        Returns:
+            int: the number of matching entities, held ones included
+        '''
+        return self._count(self._unit_counts, (), team, entity_type)
+
+    def total_hp(self, team):
+        '''
+        Args:
+            team (Team): the team to sum up
+        Returns:
+            int: the summed hp of every entity on this team
+        '''
+        return self._team_hp.get(team.id, 0)
+
+    def sectors_controlled(self, team):
+        '''
+        Args:
+            team (Team): the team to count sectors for
+        Returns:
+            int: the number of sectors controlled by this team
+        '''
+        return self._sectors_controlled.get(team.id, 0)
+
+    def influence_map(self, team):
+        '''
+        How much throw damage team could deal to each tile this turn. Every
+        thrower on the team that is holding a unit and can act adds its
+        damage to each tile it could hit with a throw. Empty tiles count as
+        if a unit stood on them, and a hedge blocking a throw takes hedge
+        damage.
+        Args:
+            team (Team): the throwing team
+        Returns:
+            [int]: the damage for every tile, indexed by y * map.width + x
+        '''
+        return list(self._influence(team.id))
+
+    def threat_map(self, team):
+        '''
+        How much throw damage the other teams could deal to each tile this
+        turn. This is the sum of the influence maps of every other team.
+        Args:
+            team (Team): the team being thrown at
+        Returns:
+            [int]: the damage for every tile, indexed by y * map.width + x
+        '''
+        result = None
+        for team_id in self.teams:
+            if team_id == team.id:
+                continue
+            grid = self._influence(team_id)
+            if result is None:
+                result = list(grid)
+            elif self._influence_cache[team_id][1]:
+                result = [a + b for a, b in zip(result, grid)]
+        if result is None:
+            result = [0] * (self.map.width * self.map.height)
+        return result
+
+    def distance_field(self, team=None, entity_type=None, sector_team=None):
+        '''
+        The distance from every tile to the nearest unit on team of
+        entity_type, or with sector_team, to the nearest tile of a sector
+        sector_team controls. The field is kept from turn to turn, and only
+        the part around sources that changed is recomputed.
+        Args:
+            team (Team): only count this team's units; any team if None
+            entity_type: only count units of this type; any type if None
+            sector_team (Team): count sectors instead of units
+        Returns:
+            DistanceField: the distances
+        '''
+        if __debug__ and sector_team is not None:
+            assert team is None and entity_type is None, \
+                'a distance field is to units or to sectors, not both'
+        key = (team.id if team is not None else None, entity_type,
+               sector_team.id if sector_team is not None else None)
+        field = self._distance_fields.get(key)
+        if field is None:
+            field = DistanceField(self.map, *key)
+            self._distance_fields[key] = field
+            # keep it in the game's own state too, so the copies made for
+            # later turns start from an up to date field
+            game_state = getattr(self._game, 'state', None)
+            if isinstance(game_state, State) and game_state is not self and \
+                    key not in game_state._distance_fields:
+                game_state.distance_field(team, entity_type, sector_team)
+        return field
+
+    def _influence(self, team_id):
+        '''
+        Bring the cached damage grid of team_id up to date and return it.
+        Each thrower's contribution is kept along with its location, the
+        tiles its throws looked at and the map version it was computed at,
+        and is only recomputed when one of those changed.
+        '''
+        map = self.map
+        cache = self._influence_cache.get(team_id)
+        if cache is None:
+            cache = ([0] * (map.width * map.height), {})
+            self._influence_cache[team_id] = cache
+            # keep it in the game's own state too, like distance_field
+            game_state = getattr(self._game, 'state', None)
+            if isinstance(game_state, State) and game_state is not self and \
+                    team_id not in game_state._influence_cache:
+                game_state._influence(team_id)
+        grid, contributions = cache
+
+        throwers = set()
+        for entity in self.entities.values():
+            if entity.team.id != team_id or entity.holding is None or \
+                    not entity.can_act:
+                continue
+            throwers.add(entity.id)
+
+            old = contributions.get(entity.id)
+            if old is not None:
+                location, version, path, hits = old
+                if location == entity.location and \
+                        not map._changed_since(path, version):
+                    continue
+                for index, damage in hits:
+                    grid[index] -= damage
+
+            path = []
+            hits = []
+            for direction in Direction.directions():
+                looked, hit, target = map._throw_path(entity.location, direction)
+                path.extend(looked)
+                for index in hit:
+                    hits.append((index, THROW_ENTITY_DAMAGE))
+                if target is not None and target.type == Entity.HEDGE:
+                    hits[-1] = (hits[-1][0], THROW_HEDGE_DAMAGE)
+            for index, damage in hits:
+                grid[index] += damage
+            contributions[entity.id] = (entity.location, map._version, path, hits)
+
+        for id in list(contributions):
+            if id not in throwers:
+                for index, damage in contributions.pop(id)[3]:
+                    grid[index] -= damage
+
+        return grid
+
     def _validate(self):
         for ent in self.entities.values():
             if not ent.is_held:
                 assert self.map._occupied[ent.location] == ent
 
+        tallies = self._tallies
+        self._tallies = {}
+        counts = (self._unit_counts, self._sector_counts, self._team_hp)
+        self._unit_counts, self._sector_counts, self._team_hp = {}, {}, {}
+        for ent in self.entities.values():
+            self._tally(ent)
+        for old, new in zip(counts, (self._unit_counts, self._sector_counts, self._team_hp)):
+            for key in set(old) | set(new):
+                assert old.get(key, 0) == new.get(key, 0), (key, old.get(key), new.get(key))
+        assert tallies == self._tallies
+
+    def _keyframe_delta(self, keyframe_state):
+        '''
+        Returns:
+            dict: the changed, dead and changedSectors lists of a nextTurn
+                  message that would bring this state in line with
+                  keyframe_state
+        '''
+        entities = self.entities
+        tallies = self._tallies
+        changed = []
+        seen = set()
+        for data in keyframe_state['entities']:
+            id = data['id']
+            seen.add(id)
+            entity = entities.get(id)
+            if entity is None or not entity._matches(data, tallies.get(id)):
+                changed.append(data)
+        dead = [id for id in entities if id not in seen]
+
+        sectors = self.map._sectors
+        changed_sectors = []
+        for data in keyframe_state['sectors']:
+            sector = sectors[Location(data['topLeft']['x'], data['topLeft']['y'])]
+            if sector.team is None or sector.team.id != data['controllingTeamID']:
+                changed_sectors.append(data)
+
+        return {'changed': changed, 'dead': dead, 'changedSectors': changed_sectors}
+
     def _validate_keyframe(self, keyframe):
         altstate = State(self._game, self.teams, self.my_team.id, keyframe['state'])
         for id in self.entities:
@@ -1124,6 +2454,11 @@ class State(object):
                 entity_type filters to only entities of a given type
                 team filters all entities are part of a given team'''
 
+        if self.memoize:
+            return self._memoized_entities(entity_id, entity_type, location, team)
+        return self._get_entities(entity_id, entity_type, location, team)
+
+    def _get_entities(self, entity_id, entity_type, location, team):
         for i in range(self._max_id+1):
             entity = self.entities.get(i)
             if entity == None:
@@ -1138,33 +2473,1957 @@ class State(object):
                 continue
             yield entity
 
-if 'BATTLECODE_IP' not in os.environ:
-    DEFAULT_SERVER = ('localhost', 6147)
-else:
-    print('Connecting to', (os.environ['BATTLECODE_IP'], 6147))
-    DEFAULT_SERVER = (os.environ['BATTLECODE_IP'], 6147)
-
-class Game(object):
-    '''
-    This is the game that is being played.
-    Running the init connects your code to the engine to play the game
-    Create a for loop which iterates through game.turns to play the game. It
-    will give a state for each turn with which you can see and perform
-    actions.
-    '''
+    def _memoized_entities(self, entity_id, entity_type, location, team):
+        key = ('get', entity_id, entity_type, location, None if team is None else team.id)
+        map = self.map
+        if location is not None:
+            # only entities on that tile can match
+            if not map.location_on_map(location):
+                return iter(())
+            index = location[1] * map.width + location[0]
+            cached = self._memo.get(key)
+            if cached is not None and map._tile_versions[index] <= cached[1]:
+                return iter(cached[0])
+            check = map._version
+        else:
+            # only creations and deaths matter
+            cached = self._memo.get(key)
+            check = (len(self.entities), self._max_id)
+            if cached is not None and cached[1] == check:
+                return iter(cached[0])
+
+        result = list(self._get_entities(entity_id, entity_type, location, team))
+        self._memo[key] = (result, check)
+        return iter(result)
+
+    def _memoized_within(self, entity, kind, distance, include_held):
+        key = (kind, entity.id, distance, include_held)
+        map = self.map
+        location = entity.location
+        cached = self._memo.get(key)
+        if cached is not None:
+            result, (center, version, region) = cached
+            if center == location and (version == map._version or (
+                    region is not None and not map._changed_since(region, version))):
+                return iter(result)
+
+        region = map._region(location, distance)
+        if len(region) > 4 * len(self.entities):
+            # cheaper to look again than to check this many tiles
+            region = None
+        if kind == 'adjacent':
+            result = entity._within_adjacent_distance(distance, include_held, None)
+        else:
+            result = entity._within_euclidean_distance(distance, include_held, None)
+        result = list(result)
+        self._memo[key] = (result, (location, map._version, region))
+        return iter(result)
 
-    def __init__(self, name, server=DEFAULT_SERVER):
-        '''Connect to the server and wait for the first turn.
-        name is the name this bot would like to be called; it will be ignored on the
-        scrimmage server.
-        Server is the address to connect to. Leave it as None to connect to a default local
-        server; you shouldn't need to mess with it unless you're making custom matchmaking stuff.'''
+    def action_masks(self, team=None):
+        '''
+        Work out everything a team's units can do this turn in one pass,
+        instead of calling can_move, can_build, can_throw and can_pickup
+        for every unit and direction.
+        Args:
+            team (Team): whose units; defaults to my team
+        Returns:
+            ActionMasks: the legal actions, exactly as the can_* methods
+                         would report them
+        '''
+        if team is None:
+            team = self.my_team
+        map = self.map
+        width = map.width
+        stride = width + 2
+
+        # the occupancy layer with a blocked border, so neighbours never
+        # fall off it
+        occupancy = map._occupancy
+        blocked = bytearray(b'\x01') * (stride * (map.height + 2))
+        for row in range(map.height):
+            start = (row + 1) * stride + 1
+            blocked[start:start + width] = occupancy[row * width:(row + 1) * width]
+        directions = Direction.directions()
+        offsets = [d.dy * stride + d.dx for d in directions]
+
+        units = list(self.get_entities(team=team))
+        move = bytearray(8 * len(units))
+        throw = bytearray(8 * len(units))
+        pickup = [None] * (8 * len(units))
+        free = bytearray(8)
+
+        for unit, entity in enumerate(units):
+            if not entity.can_act:
+                continue
+            x, y = entity.location
+            center = (y + 1) * stride + x + 1
+            start = unit * 8
+            for slot in range(8):
+                free[slot] = blocked[center + offsets[slot]] ^ 1
+            move[start:start + 8] = free
+            if entity.holding is not None:
+                throw[start:start + 8] = free
+                continue
+            for slot in range(8):
+                if not free[slot]:
+                    direction = directions[slot]
+                    other = map.occupant_at(x + direction.dx, y + direction.dy)
+                    if other is not None and other.type == Entity.THROWER and \
+                            other.holding is None and not other._disintegrated:
+                        pickup[start + slot] = other
 
-        assert isinstance(name, str) \
-               and len(name) > 5 and len(name) < 100, \
-               'invalid team name: '+unicode(name)
+        return ActionMasks(units, move, bytearray(move), throw, pickup)
+
+    def queue_actions(self, actions):
+        '''
+        Queue many actions at once. Each is checked against the state as the
+        actions before it leave it, so two units can't move onto the same
+        tile, and the accepted ones are applied in order when speculating,
+        like the queue_* methods. Unlike them, an invalid action is left
+        out rather than asserted on. Without speculation, damage done by
+        throws earlier in the batch isn't taken into account.
+        Args:
+            actions: (entity, kind, arg) tuples, where kind is 'move',
+                     'build' or 'throw' with a Direction, 'pickup' with the
+                     Entity to pick up, or 'disintegrate' with None
+        Returns:
+            [str]: for each action, None if it was queued, else why not
+        '''
+        map = self.map
+        occupancy = map._occupancy
+        width = map.width
+        height = map.height
+        my_team = self.my_team
+        speculate = self.speculate
+
+        # without speculation the state doesn't change, so keep track of
+        # what the batch has done so far here
+        claimed = {}
+        vacated = set()
+        acted = set()
+        positions = {}
+        picked = set()
+        holders = set()
+        thrown = set()
+        threw = set()
+        gone = set()
+
+        def free(location):
+            x, y = location
+            if not (0 <= x < width and 0 <= y < height):
+                return False
+            if location in claimed:
+                return False
+            return not occupancy[y * width + x] or location in vacated
+
+        def held(entity):
+            return entity.id in picked or \
+                (entity.held_by is not None and entity.id not in thrown)
+
+        def holding(entity):
+            return entity.id in holders or \
+                (entity.holding is not None and entity.id not in threw)
+
+        def can_act(entity):
+            if entity.id in acted or entity.id in gone or held(entity):
+                return False
+            if entity.id in thrown:
+                # still held as far as the state knows
+                return entity.cooldown == 0 and not entity._disintegrated
+            return entity.can_act
+
+        def vacate(entity):
+            location = positions.get(entity.id, entity.location)
+            claimed.pop(location, None)
+            if occupancy[location[1] * width + location[0]]:
+                vacated.add(location)
+
+        queued = []
+        reasons = []
+        for entity, kind, arg in actions:
+            reason = None
+            if entity.team != my_team:
+                reason = 'not my unit'
+            elif kind == 'disintegrate':
+                if entity._disintegrated or entity.id in gone:
+                    reason = 'already gone'
+            elif not can_act(entity):
+                reason = 'cannot act'
+            elif kind == 'pickup':
+                target = arg
+                location = positions.get(entity.id, entity.location)
+                if holding(entity):
+                    reason = 'already holding'
+                elif target is entity or not target.is_thrower or target._disintegrated or \
+                        target.id in gone or held(target) or holding(target):
+                    reason = 'cannot be picked up'
+                elif location.distance_to_squared(
+                        positions.get(target.id, target.location)) > 2:
+                    reason = 'too far'
+            elif kind in ('move', 'build', 'throw'):
+                location = positions.get(entity.id, entity.location)
+                target = Location(location.x + arg.dx, location.y + arg.dy)
+                if kind == 'throw' and not holding(entity):
+                    reason = 'not holding'
+                elif not free(target):
+                    reason = 'blocked'
+            else:
+                reason = 'unknown action'
+
+            reasons.append(reason)
+            if reason is not None:
+                continue
+
+            if kind == 'pickup':
+                queued.append({'action': 'pickup', 'id': entity.id, 'pickupID': arg.id})
+            elif kind == 'disintegrate':
+                queued.append({'action': 'disintegrate', 'id': entity.id})
+            else:
+                queued.append({'action': kind, 'id': entity.id, 'dx': arg.dx, 'dy': arg.dy})
+
+            if speculate:
+                if kind == 'move':
+                    entity._speculate_move(arg)
+                elif kind == 'build':
+                    entity._speculate_build(target)
+                elif kind == 'throw':
+                    entity._speculate_throw(arg)
+                elif kind == 'pickup':
+                    entity._speculate_pickup(arg)
+                else:
+                    entity._deal_damage(entity.hp + 1)
+                continue
+
+            acted.add(entity.id)
+            if kind == 'move':
+                vacate(entity)
+                claimed[target] = entity
+                positions[entity.id] = target
+            elif kind == 'build':
+                claimed[target] = None
+            elif kind == 'throw':
+                # a unit that picked up in this batch can't act again, so
+                # this is what it held at the start
+                held_unit = entity.holding
+                threw.add(entity.id)
+                thrown.add(held_unit.id)
+                for _ in range(THROW_RANGE + 1):
+                    if not free(target):
+                        break
+                    target = Location(target.x + arg.dx, target.y + arg.dy)
+                landing = Location(target.x - arg.dx, target.y - arg.dy)
+                claimed[landing] = held_unit
+                positions[held_unit.id] = landing
+            elif kind == 'pickup':
+                vacate(arg)
+                picked.add(arg.id)
+                holders.add(entity.id)
+                positions[arg.id] = location
+            else:
+                if not held(entity):
+                    vacate(entity)
+                    # whatever it holds is dropped where it stood
+                    if entity.holding is not None and entity.id not in threw:
+                        location = positions.get(entity.id, entity.location)
+                        claimed[location] = entity.holding
+                        thrown.add(entity.holding.id)
+                gone.add(entity.id)
+
+        if queued:
+            self._queue_all(queued)
+        return reasons
+
+    def to_tensor(self, out=None, incremental=False):
+        '''
+        Encode the state as an observation for a model: TENSOR_CHANNELS
+        planes of height x width, flattened as out[(channel * height + y) *
+        width + x]. Throwers and statues are split into mine and the
+        enemy's; hp and cooldown are the plain numbers; held_mine is 1 where
+        the unit being held on that tile is mine.
+        Args:
+            out: a writable flat buffer of len(TENSOR_CHANNELS) * height *
+                 width numbers to fill in, e.g. an array.array('f') or
+                 numpy_array.reshape(-1). A new array.array('f') if None.
+            incremental (bool): only rewrite what state.changes says may have
+                 changed. out must hold what this returned on our previous
+                 turn, before any actions were queued.
+        Returns:
+            the buffer
+        '''
+        map = self.map
+        width = map.width
+        height = map.height
+        plane = width * height
+        size = len(TENSOR_CHANNELS) * plane
+        if out is None:
+            out = array.array('f', [0]) * size
+            incremental = False
+        elif __debug__:
+            assert len(out) == size, 'to_tensor needs a buffer of {} numbers'.format(size)
+
+        occupied = map._occupied
+        if incremental:
+            tiles = set(y * width + x for x, y in self.changes._tiles
+                        if 0 <= x < width and 0 <= y < height)
+            # cooldowns count down without the server saying anything
+            tiles.update(self._cooling_tiles)
+            self._encode_tiles(out, [(index, map.occupant_at(index % width, index // width))
+                                     for index in tiles])
+            for top_left in self.changes.sectors:
+                self._encode_sector(out, map._sectors[top_left])
+            self._keep_cooling_tiles()
+            return out
+
+        zeros = array.array('f', [0]) * plane
+        for channel in range(len(TENSOR_CHANNELS)):
+            out[channel * plane:(channel + 1) * plane] = zeros
+        for row, line in enumerate(map.tiles):
+            base = (height - row - 1) * width
+            for x, tile in enumerate(line):
+                if tile == DIRT:
+                    out[base + x] = 1
+        self._cooling_tiles = set()
+        self._encode_tiles(out, [(location[1] * width + location[0], entity)
+                                 for location, entity in occupied.items()])
+        for sector in map._sectors.values():
+            self._encode_sector(out, sector)
+        self._keep_cooling_tiles()
+        return out
+
+    def _keep_cooling_tiles(self):
+        # in the game's own state too, so next turn's copy knows which tiles
+        # of the buffer to count down
+        game_state = getattr(self._game, 'state', None)
+        if isinstance(game_state, State) and game_state is not self:
+            game_state._cooling_tiles = set(self._cooling_tiles)
+
+    def _encode_tiles(self, out, tiles):
+        '''Rewrite the unit channels of tiles, a list of (index, Entity or None)'''
+        # channel numbers are places in TENSOR_CHANNELS
+        plane = self.map.width * self.map.height
+        cleared = [channel * plane for channel in range(1, 10)]
+        my_team_id = self.my_team.id
+        kinds = {
+            (Entity.THROWER, True): plane, (Entity.THROWER, False): 3 * plane,
+            (Entity.STATUE, True): 2 * plane, (Entity.STATUE, False): 4 * plane,
+            (Entity.HEDGE, True): 5 * plane, (Entity.HEDGE, False): 5 * plane,
+        }
+        hp = 6 * plane
+        cooldown = 7 * plane
+        holding = 8 * plane
+        held_mine = 9 * plane
+        cooling = self._cooling_tiles
+        for index, entity in tiles:
+            for offset in cleared:
+                out[offset + index] = 0
+            if entity is None:
+                cooling.discard(index)
+                continue
+            out[kinds[entity.type, entity.team.id == my_team_id] + index] = 1
+            out[hp + index] = entity.hp
+            out[cooldown + index] = entity.cooldown
+            if entity.cooldown:
+                cooling.add(index)
+            else:
+                cooling.discard(index)
+            held = entity.holding
+            if held is not None:
+                out[holding + index] = 1
+                if held.team.id == my_team_id:
+                    out[held_mine + index] = 1
+
+    def _encode_sector(self, out, sector):
+        map = self.map
+        width = map.width
+        plane = width * map.height
+        x, y = sector.top_left
+        right = min(x + map.sector_size, width)
+        mine = 1 if sector.team == self.my_team else 0
+        enemy = 1 if sector.team == self.other_team else 0
+        for row in range(y, min(y + map.sector_size, map.height)):
+            start = row * width
+            out[10 * plane + start + x:10 * plane + start + right] = \
+                array.array('f', [mine]) * (right - x)
+            out[11 * plane + start + x:11 * plane + start + right] = \
+                array.array('f', [enemy]) * (right - x)
+
+    def plan_moves(self, preferences):
+        '''
+        Move many units at once without them getting in each other's way.
+        Each unit is given a list of directions it would like to move in, best
+        first, or a Location it would like to get closer to. Units are then
+        matched to tiles so that as many of them as possible get to move,
+        preferring earlier units and earlier directions, and the moves are
+        queued with queue_move in an order that works.
+
+        When speculating, a unit may move into a tile another planned unit is
+        leaving, so units can follow each other in chains. Units can't swap
+        places or move in a circle, since moves happen one after another.
+
+        Args:
+            preferences (dict or [(Entity, [Direction] or Location)]): what
+                each unit wants. Units that can't act or aren't on my team are
+                ignored.
+        Returns:
+            [(Entity, Direction)]: the moves that were queued, in order
+        '''
+        if isinstance(preferences, dict):
+            preferences = list(preferences.items())
+
+        map = self.map
+        width = map.width
+        height = map.height
+        occupant = map._occupant
+
+        units = []
+        unit_index = {}
+        for entity, wanted in preferences:
+            if entity.team != self.my_team or not entity.can_act or \
+                    entity.id in unit_index:
+                continue
+            unit_index[entity.id] = len(units)
+            units.append((entity, wanted))
+
+        # every unit's options as [(tile index, direction, occupant unit index)]
+        # occupant unit index is None for free tiles
+        options = []
+        for entity, wanted in units:
+            x, y = entity.location
+            if isinstance(wanted, Location):
+                distance = entity.location.distance_to_squared(wanted)
+                closer = []
+                for direction in Direction.directions():
+                    new = (x + direction.dx - wanted[0]) ** 2 + \
+                        (y + direction.dy - wanted[1]) ** 2
+                    if new < distance:
+                        closer.append((new, len(closer), direction))
+                wanted = [direction for _, _, direction in sorted(closer)]
+
+            unit_options = []
+            for direction in wanted:
+                nx = x + direction.dx
+                ny = y + direction.dy
+                if not (0 <= nx < width and 0 <= ny < height):
+                    continue
+                occupant_id = occupant[ny * width + nx]
+                if occupant_id < 0:
+                    unit_options.append((ny * width + nx, direction, None))
+                elif self.speculate and occupant_id in unit_index:
+                    unit_options.append((ny * width + nx, direction,
+                                         unit_index[occupant_id]))
+            options.append(unit_options)
+
+        all_options = [list(unit_options) for unit_options in options]
+
+        # assigned[unit] is an index into options[unit], owner[tile] a unit
+        assigned = [None] * len(units)
+        owner = {}
+
+        def augment(start):
+            # Kuhn's augmenting path search, with an explicit stack so long
+            # chains of displaced units don't hit the recursion limit.
+            # frames are [unit, index of the next option to try]
+            visited = set()
+            stack = [[start, 0]]
+            while stack:
+                frame = stack[-1]
+                unit, i = frame
+                unit_options = options[unit]
+                while i < len(unit_options) and unit_options[i][0] in visited:
+                    i += 1
+                if i == len(unit_options):
+                    stack.pop()
+                    continue
+                tile = unit_options[i][0]
+                visited.add(tile)
+                frame[1] = i + 1
+                holder = owner.get(tile)
+                if holder is not None:
+                    stack.append([holder, 0])
+                    continue
+                # every unit on the stack takes the tile it was trying
+                for unit, i in stack:
+                    assigned[unit] = i - 1
+                    owner[options[unit][i - 1][0]] = unit
+                return True
+            return False
+
+        for unit in range(len(units)):
+            augment(unit)
+
+        # a unit moving into another unit's tile needs that unit to move away
+        # first; drop options that would need a unit that stays or a cycle
+        while True:
+            bad = None
+            for unit in range(len(units)):
+                if assigned[unit] is None:
+                    continue
+                occupant = options[unit][assigned[unit]][2]
+                if occupant is None:
+                    continue
+                if assigned[occupant] is None:
+                    bad = unit
+                    break
+                chain = [unit]
+                while occupant is not None and assigned[occupant] is not None:
+                    if occupant in chain:
+                        # drop the lowest priority unit's move in the cycle
+                        bad = max(chain[chain.index(occupant):])
+                        break
+                    chain.append(occupant)
+                    occupant = options[occupant][assigned[occupant]][2]
+                if bad is not None:
+                    break
+            if bad is None:
+                break
+            del owner[options[bad][assigned[bad]][0]]
+            del options[bad][assigned[bad]]
+            assigned[bad] = None
+            augment(bad)
+
+        # options dropped above may work now that other units have moved;
+        # give units that still aren't moving any tile that is free or being
+        # left, as long as that doesn't close a cycle
+        changed = True
+        while changed:
+            changed = False
+            for unit in range(len(units)):
+                if assigned[unit] is not None:
+                    continue
+                for option in all_options[unit]:
+                    tile, _, occupant = option
+                    if tile in owner:
+                        continue
+                    while occupant is not None and occupant != unit and \
+                            assigned[occupant] is not None:
+                        occupant = options[occupant][assigned[occupant]][2]
+                    if occupant is not None:
+                        continue
+                    options[unit] = [option]
+                    assigned[unit] = 0
+                    owner[tile] = unit
+                    changed = True
+                    break
+
+        # queue units leaving a tile before the units moving into it
+        waiting = {}
+        order = []
+        for unit in range(len(units)):
+            if assigned[unit] is None:
+                continue
+            occupant = options[unit][assigned[unit]][2]
+            if occupant is None:
+                order.append(unit)
+            else:
+                waiting[occupant] = unit
+
+        queued = []
+        for unit in order:
+            while unit is not None:
+                entity = units[unit][0]
+                direction = options[unit][assigned[unit]][1]
+                entity.queue_move(direction)
+                queued.append((entity, direction))
+                unit = waiting.get(unit)
+        return queued
+
+    def plan_relay(self, entity, target, helpers=None):
+        '''
+        The fastest way to get a unit to target, walking and being thrown
+        along by other throwers on my team. Helpers stay where they are: one
+        picks the unit up once it's next to it and throws it as soon as it
+        can act again, which is _HOLD_DELAY turns after the pickup, and it
+        then can't act for another THROW_DELAY. A step takes MOVEMENT_DELAY.
+        The teams take turns, so a unit that moves on this turn can move
+        again in two.
+
+        Landing on dirt or hitting a unit on the way down hurts the thrown
+        unit, so plans that would kill it are left out, and of the fastest
+        plans the one that hurts it least is returned. Where throws land is
+        kept by the map from call to call, until the tiles along them change.
+        Args:
+            entity (Entity): the unit to get there, a thrower on my team
+            target (Location): where it should end up; must be empty
+            helpers ([Entity]): the throwers that may throw it. Defaults to
+                every other thrower on my team that isn't holding or held.
+        Returns:
+            [(int, Entity, str, object)]: (turn, entity, kind, arg) for every
+                step, in the order to queue them; kind is 'move' or 'throw'
+                with a Direction, or 'pickup' with the Entity to pick up.
+                On each turn, give the (entity, kind, arg) of that turn's
+                steps to queue_actions. None if entity can't get there.
+        '''
+        map = self.map
+        width = map.width
+        height = map.height
+        now = self.turn
+
+        def own_turn(turn):
+            # the first of our turns at or after turn
+            return turn + (turn - now) % 2
+
+        if entity.held_by is not None or not entity.is_thrower or entity._disintegrated:
+            return None
+        x, y = entity.location
+        start = y * width + x
+        if not map.location_on_map(target):
+            return None
+        goal = target[1] * width + target[0]
+        if goal != start and map._occupancy[goal]:
+            return None
+        blocked = bytearray(map._occupancy)
+        blocked[start] = 0
+        goal_x = target[0]
+        goal_y = target[1]
+        # A* needs a lower bound on the turns left: walking takes step turns
+        # a tile, and a throw takes the unit at most THROW_RANGE + 2 tiles
+        # (from next to the helper) for at least _HOLD_DELAY - step turns
+        step = own_turn(now + MOVEMENT_DELAY) - now
+        rate = min(step, float(_HOLD_DELAY - step) / (THROW_RANGE + 2))
+
+        if helpers is None:
+            helpers = self.get_entities(entity_type=Entity.THROWER, team=self.my_team)
+        helpers = [helper for helper in helpers
+                   if helper.id != entity.id and helper.holding is None and
+                   helper.held_by is None and not helper._disintegrated]
+        # tile index to the helpers that can pick up a unit standing there
+        reachable = {}
+        helper_tiles = []
+        helper_ready = []
+        if entity.holding is None:
+            for helper in helpers:
+                hx, hy = helper.location
+                helper_tiles.append(hy * width + hx)
+                helper_ready.append(own_turn(max(now, helper.cooldown_end or 0)))
+                for direction in _DIRECTIONS:
+                    nx = hx + direction.dx
+                    ny = hy + direction.dy
+                    if 0 <= nx < width and 0 <= ny < height:
+                        reachable.setdefault(ny * width + nx, []).append(len(helper_tiles) - 1)
+
+        # labels[i] is (tile, parent label, steps taken from the parent);
+        # best[tile] is the (ready, arrived, damage) of its best label so far,
+        # where arrived is the turn the unit got there and ready the first
+        # turn it can act there
+        labels = []
+        best = {}
+        heap = []
+
+        def push(tile, ready, arrived, damage, parent, steps):
+            key = (ready, arrived, damage)
+            old = best.get(tile)
+            if old is not None and old <= key:
+                return
+            best[tile] = key
+            labels.append((tile, parent, steps))
+            distance = max(abs(tile % width - goal_x), abs(tile // width - goal_y))
+            heapq.heappush(heap, (ready + int(distance * rate),) + key + (len(labels) - 1,))
+
+        push(start, own_turn(max(now, entity.cooldown_end or 0)), now, 0, -1, ())
+        while heap:
+            _, ready, arrived, damage, label = heapq.heappop(heap)
+            tile = labels[label][0]
+            if best[tile] != (ready, arrived, damage):
+                continue
+
+            if tile == goal:
+                plan = []
+                while label != -1:
+                    _, label, steps = labels[label]
+                    plan.extend(reversed(steps))
+                plan.reverse()
+                return plan
+
+            x = tile % width
+            y = tile // width
+            moved = own_turn(ready + MOVEMENT_DELAY)
+            for direction in _DIRECTIONS:
+                nx = x + direction.dx
+                ny = y + direction.dy
+                if not (0 <= nx < width and 0 <= ny < height):
+                    continue
+                next_tile = ny * width + nx
+                if blocked[next_tile]:
+                    continue
+                push(next_tile, moved, ready, damage, label,
+                     ((ready, entity, 'move', direction),))
+
+            for h in reachable.get(tile, ()):
+                helper = helpers[h]
+                helper_ready_turn = helper_ready[h]
+                # a helper that already threw it on the way here is still busy
+                previous = label
+                while previous != -1:
+                    _, previous, steps = labels[previous]
+                    for turn, actor, kind, _ in steps:
+                        if actor is helper and kind == 'throw':
+                            helper_ready_turn = max(helper_ready_turn,
+                                                    own_turn(turn + THROW_DELAY))
+                pickup = max(arrived, helper_ready_turn)
+                throw = own_turn(pickup + _HOLD_DELAY)
+                for slot, direction in enumerate(_DIRECTIONS):
+                    edge = map._throw_edge(helper_tiles[h], slot, start)
+                    if edge is None:
+                        continue
+                    landing, hit, dirt = edge
+                    hurt = damage
+                    if hit:
+                        hurt += THROW_ENTITY_RECOIL
+                    if dirt:
+                        hurt += THROW_ENTITY_DIRT
+                    if hurt >= entity.hp:
+                        continue
+                    push(landing, max(throw, ready), throw, hurt, label,
+                         ((pickup, helper, 'pickup', entity), (throw, helper, 'throw', direction)))
+        return None
+
+if 'BATTLECODE_IP' not in os.environ:
+    DEFAULT_SERVER = ('localhost', 6147)
+else:
+    print('Connecting to', (os.environ['BATTLECODE_IP'], 6147))
+    DEFAULT_SERVER = (os.environ['BATTLECODE_IP'], 6147)
+
+class _StreamingDecoder(object):
+    '''
+    Decodes one JSON message from the chunks of bytes it arrives in, so a big
+    start or keyframe message is decoded while the rest of it is still on
+    the wire, and the whole line is never held as bytes or str.
+
+    The outer levels of objects and arrays are walked here; everything
+    nested deeper than DEPTH (an entity, a sector) and every string (a row
+    of tiles) is decoded in one go by json's scanner once all its bytes are
+    in, so the buffer only ever holds a chunk and the value it ends in. The
+    complete elements of an array are scanned together where possible, which
+    is faster and shares their dicts' keys as json.loads does.
+    '''
+
+    DEPTH = 3
+
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+    _scan = _json.JSONDecoder().raw_decode
+
+    def __init__(self):
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        # open containers, innermost last: [container, key, expecting]
+        self._stack = []
+        self._done = False
+        self.value = None
+
+    def feed(self, data, final=False):
+        '''
+        Decode as much as the bytes so far allow.
+        Args:
+            data (bytes): the next chunk of the message
+            final (bool): whether this is the message's last chunk
+        Returns:
+            bool: whether the message is complete; its value is then in
+                  self.value
+        Raises:
+            ValueError: if the message isn't valid JSON
+        '''
+        text = self._text + self._utf8.decode(data, final)
+        pos = self._parse(text, final)
+        self._text = text[pos:]
+        if final and not self._done:
+            raise ValueError('truncated JSON message')
+        if self._done and self._text.strip():
+            raise ValueError('extra data after JSON message')
+        return self._done
+
+    def _parse(self, text, final):
+        '''Consume text from the start; returns how far it got.'''
+        stack = self._stack
+        skip = _StreamingDecoder._WHITESPACE.match
+        scan = _StreamingDecoder._scan
+        end = len(text)
+        pos = 0
+        batched = -1
+        while not self._done:
+            pos = skip(text, pos).end()
+            if pos == end:
+                return pos
+            char = text[pos]
+            top = stack[-1] if stack else None
+            expecting = top[2] if top else 'value'
+
+            if expecting == 'comma':
+                if char == ',':
+                    top[2] = 'key' if isinstance(top[0], dict) else 'value'
+                    pos += 1
+                    continue
+                if char != ('}' if isinstance(top[0], dict) else ']'):
+                    raise ValueError('expected , at character ' + str(pos))
+                self._close()
+                pos += 1
+                continue
+            if expecting == 'colon':
+                if char != ':':
+                    raise ValueError('expected : at character ' + str(pos))
+                top[2] = 'value'
+                pos += 1
+                continue
+            if expecting == 'first':
+                # just opened: either empty, or the first key or value
+                if char == ('}' if isinstance(top[0], dict) else ']'):
+                    self._close()
+                    pos += 1
+                    continue
+                expecting = 'key' if isinstance(top[0], dict) else 'value'
+
+            if char in '{[' and expecting == 'value' \
+                    and len(stack) < _StreamingDecoder.DEPTH:
+                container = {} if char == '{' else []
+                stack.append([container, None, 'first'])
+                pos += 1
+                continue
+            if expecting == 'key' and char != '"':
+                raise ValueError('expected a key at character ' + str(pos))
+            if top is not None and expecting == 'value' and pos > batched \
+                    and isinstance(top[0], list):
+                # scan every complete element in one go
+                cut = self._last_separator(text, pos, char)
+                if cut > pos:
+                    batch = '[' + text[pos:cut] + ']'
+                    try:
+                        values, after = scan(batch)
+                    except ValueError:
+                        after = -1
+                    if after == len(batch):
+                        top[0].extend(values)
+                        pos = cut + 1
+                        continue
+                    if after > 0:
+                        # the array ended before the separator, which was in
+                        # the next one: these are the rest of its elements
+                        top[0].extend(values)
+                        pos += after - 2
+                        top[2] = 'comma'
+                        continue
+                # there's no separator, or it was inside an element after all
+                batched = cut if cut > pos else end
+            try:
+                value, after = scan(text, pos)
+            except ValueError:
+                if final:
+                    raise
+                # wait for the rest of it
+                return pos
+            if not final and (after == end or end - after <= 2 and text[after] in '.eE'):
+                # a number might go on in the next chunk
+                return pos
+            pos = after
+            if expecting == 'key':
+                top[1] = value
+                top[2] = 'colon'
+            else:
+                self._add(value)
+        return pos
+
+    @staticmethod
+    def _last_separator(text, pos, first):
+        '''
+        The last comma after pos followed by first, the character the array
+        element at pos starts with; likely the end of the last complete
+        element. -1 if there's none.
+        '''
+        skip = _StreamingDecoder._WHITESPACE.match
+        cut = len(text)
+        while True:
+            cut = text.rfind(',', pos, cut)
+            if cut < 0 or text.startswith(first, skip(text, cut + 1).end()):
+                return cut
+
+    def _close(self):
+        container = self._stack.pop()[0]
+        self._add(container)
+
+    def _add(self, value):
+        stack = self._stack
+        if not stack:
+            self.value = value
+            self._done = True
+            return
+        top = stack[-1]
+        if isinstance(top[0], dict):
+            top[0][top[1]] = value
+        else:
+            top[0].append(value)
+        top[2] = 'comma'
+
+class _Ring(object):
+    '''
+    A byte queue in shared memory with one writer and one reader. The
+    writer only ever stores the count of bytes written and the reader the
+    count of bytes read, so neither needs a lock.
+    '''
+
+    _COUNT = struct.Struct('<Q')
+    # the two counts get a cache line each
+    _HEADER = 128
+
+    def __init__(self, buffer, offset, capacity):
+        self._buffer = buffer
+        self._written_at = offset
+        self._read_at = offset + 64
+        self._data = offset + _Ring._HEADER
+        self._capacity = capacity
+        self._written = _Ring._COUNT.unpack_from(buffer, self._written_at)[0]
+        self._read = _Ring._COUNT.unpack_from(buffer, self._read_at)[0]
+
+    def available(self):
+        '''
+        Returns:
+            int: how many bytes are waiting to be read
+        '''
+        return _Ring._COUNT.unpack_from(self._buffer, self._written_at)[0] - self._read
+
+    def put(self, data):
+        '''
+        Write as much of data as fits.
+        Returns:
+            int: how many bytes were written
+        '''
+        read = _Ring._COUNT.unpack_from(self._buffer, self._read_at)[0]
+        size = min(len(data), self._capacity - (self._written - read))
+        if size <= 0:
+            return 0
+        start = self._written % self._capacity
+        first = min(size, self._capacity - start)
+        begin = self._data + start
+        if first == len(data):
+            self._buffer[begin:begin + first] = data
+        else:
+            self._buffer[begin:begin + first] = data[:first]
+            self._buffer[self._data:self._data + size - first] = data[first:size]
+        self._written += size
+        _Ring._COUNT.pack_into(self._buffer, self._written_at, self._written)
+        return size
+
+    def get(self, size):
+        '''
+        Returns:
+            bytes: up to size bytes, or none if nothing is waiting
+        '''
+        size = min(size, self.available())
+        if size <= 0:
+            return b''
+        start = self._read % self._capacity
+        first = min(size, self._capacity - start)
+        begin = self._data + start
+        data = bytes(self._buffer[begin:begin + first])
+        if first < size:
+            data += bytes(self._buffer[self._data:self._data + size - first])
+        self._read += size
+        _Ring._COUNT.pack_into(self._buffer, self._read_at, self._read)
+        return data
+
+class _SharedMemoryStream(object):
+    '''
+    A message stream to a process on the same machine, through a pair of
+    _Rings in shared memory. It's used like the file Game gets from
+    socket.makefile(): write() and flush() send a message, and reading or
+    iterating yields one message at a time.
+
+    A unix socket carries the handshake and then serves as the doorbell:
+    every message is followed by a byte on it, so a reader with nothing to
+    do can block in recv(), and a closed socket means the other end hung
+    up. The message bodies never go through the kernel.
+    '''
+
+    # a length before each message
+    _LENGTH = struct.Struct('<I')
+
+    def __init__(self, conn, segment, capacity, owner):
+        self._conn = conn
+        self._segment = segment
+        self._owner = owner
+        # the owner (the server) writes the first ring and reads the second
+        rings = (_Ring(segment.buf, 0, capacity),
+                 _Ring(segment.buf, _Ring._HEADER + capacity, capacity))
+        self._send_ring, self._recv_ring = rings if owner else rings[::-1]
+        self._pending = []
+        # bytes left of a message readline() has returned part of
+        self._unread = 0
+
+    @staticmethod
+    def _size(capacity):
+        return 2 * (_Ring._HEADER + capacity)
+
+    @staticmethod
+    def connect(path):
+        '''
+        Ask the server listening on the unix socket at path for a shared
+        memory channel.
+        Returns:
+            _SharedMemoryStream: the client end
+        '''
+        if shared_memory is None or not hasattr(socket, 'AF_UNIX'):
+            raise BattlecodeError('shared memory needs python 3.8+ and unix sockets')
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(path)
+        conn.sendall(b'{"command": "sharedMemory"}\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = conn.recv(1)
+            if not data:
+                raise BattlecodeError('server hung up while setting up shared memory')
+            reply += data
+        reply = json.loads(reply.decode())
+        if reply.get('command') != 'sharedMemory':
+            raise BattlecodeError('server does not support shared memory: ' + str(reply))
+        return _SharedMemoryStream(conn, _attach_shared_memory(reply['name']),
+                                   reply['capacity'], False)
+
+    @staticmethod
+    def accept(conn, capacity=2**20):
+        '''
+        Set up the server end of a channel, once a client connected to conn
+        has asked for one.
+        Returns:
+            _SharedMemoryStream: the server end
+        '''
+        segment = shared_memory.SharedMemory(create=True,
+                                             size=_SharedMemoryStream._size(capacity))
+        reply = {'command': 'sharedMemory', 'name': segment.name, 'capacity': capacity}
+        conn.sendall(json.dumps(reply).encode() + b'\n')
+        return _SharedMemoryStream(conn, segment, capacity, True)
+
+    def write(self, data):
+        self._pending.append(data)
+
+    def flush(self):
+        if not self._pending:
+            return
+        message = b''.join(self._pending)
+        self._pending = []
+        self._put(_SharedMemoryStream._LENGTH.pack(len(message)))
+        self._put(message)
+        self._conn.send(b'\0')
+
+    def _put(self, data):
+        while data:
+            size = self._send_ring.put(data)
+            if size == len(data):
+                return
+            # full: wake the reader and wait for it to make room
+            data = data[size:]
+            self._conn.send(b'\0')
+            time.sleep(.0001)
+
+    def readline(self, size=-1):
+        '''
+        Args:
+            size (int): if not negative, return at most this many bytes and
+                        leave the rest of the message for the next calls
+        Returns:
+            bytes: the next message, or b'' if the other end hung up
+        '''
+        if not self._unread:
+            header = self._take(_SharedMemoryStream._LENGTH.size)
+            if header is None:
+                return b''
+            self._unread = _SharedMemoryStream._LENGTH.unpack(header)[0]
+        count = self._unread if size < 0 else min(size, self._unread)
+        message = self._take(count)
+        if message is None:
+            self._unread = 0
+            return b''
+        self._unread -= count
+        return message
+
+    def _take(self, size):
+        '''Exactly size bytes from the ring, or None if the other end hung up.'''
+        chunks = []
+        try:
+            while size:
+                chunk = self._recv_ring.get(size)
+                if chunk:
+                    chunks.append(chunk)
+                    size -= len(chunk)
+                    continue
+                try:
+                    rung = self._conn.recv(4096)
+                except socket.error:
+                    rung = b''
+                if not rung and not self._recv_ring.available():
+                    return None
+        except ValueError:
+            # closed under us
+            return None
+        return b''.join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        message = self.readline()
+        if not message:
+            raise StopIteration
+        return message
+
+    next = __next__
+
+    def close(self):
+        try:
+            self._conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._conn.close()
+        try:
+            self._segment.close()
+        except BufferError:
+            pass
+        if self._owner:
+            try:
+                self._segment.unlink()
+            except (OSError, IOError):
+                pass
+
+class ActionMasks(object):
+    '''
+    The legal actions of every unit on a team, from State.action_masks().
+
+    The masks are bytearrays with 8 entries per unit: entry unit*8 + d is 1
+    if units[unit] can act in Direction.directions()[d], else 0.
+    Attributes:
+        units ([Entity]): the team's units, in id order
+        move (bytearray): matches can_move
+        build (bytearray): matches can_build
+        throw (bytearray): matches can_throw
+        pickup ([Entity]): same layout; the entity units[unit] could pick up
+                           in that direction, or None. Matches can_pickup.
+    '''
+
+    def __init__(self, units, move, build, throw, pickup):
+        self.units = units
+        self.move = move
+        self.build = build
+        self.throw = throw
+        self.pickup = pickup
+
+    def directions(self, mask, unit):
+        '''
+        Args:
+            mask (bytearray): one of move, build or throw
+            unit (int): place of the unit in units
+        Returns:
+            [Direction]: the directions the mask allows for that unit
+        '''
+        directions = Direction.directions()
+        start = unit * 8
+        return [directions[slot] for slot in range(8) if mask[start + slot]]
+
+class Changes(object):
+    '''
+    What the server said happened since our last turn, covering every turn
+    in between, including any we skipped because we'd fallen behind. Use it
+    to keep your own caches up to date instead of rescanning every entity.
+    Get it from state.changes; it's empty on the first turn.
+    Attributes:
+        turns ([int]): the turns covered
+        new (set): ids of entities that appeared
+        moved ({int: (Location, Location)}): entity id to where it was and
+            where it is now, for entities that aren't new
+        hp ({int: (int, int)}): entity id to old and new hp, for entities
+            that aren't new
+        dead (set): ids of entities that died, except new ones
+        sectors ({Location: (Team, Team)}): top left of each sector that
+            changed hands to its old and new controlling team
+        failed ([(dict, str)]): our actions that failed, with the reasons
+    '''
+
+    def __init__(self):
+        self.turns = []
+        self.new = set()
+        self.moved = {}
+        self.hp = {}
+        self.dead = set()
+        self.sectors = {}
+        self.failed = []
+        # (x, y) of every tile whose occupant may have changed
+        self._tiles = set()
+
+    def __len__(self):
+        return (len(self.new) + len(self.moved) + len(self.hp) + len(self.dead) +
+                len(self.sectors) + len(self.failed))
+
+    def _record(self, state, message):
+        '''Add a nextTurn message; call it before the state applies it.'''
+        entities = state.entities
+        tallies = state._tallies
+        new = self.new
+        moved = self.moved
+        hp = self.hp
+        tiles = self._tiles
+        self.turns.append(message['turn'])
+
+        for data in message['changed']:
+            id = data['id']
+            location = data['location']
+            tiles.add((location['x'], location['y']))
+            entity = entities.get(id)
+            if entity is None:
+                new.add(id)
+                continue
+            x, y, _ = entity._position()
+            tiles.add((x, y))
+            if id in new:
+                continue
+            if x != location['x'] or y != location['y'] or id in moved:
+                Changes._merge(moved, id, Location(x, y),
+                               Location(location['x'], location['y']))
+            tally = tallies.get(id)
+            if tally is not None and (tally[4] != data['hp'] or id in hp):
+                Changes._merge(hp, id, tally[4], data['hp'])
+
+        for id in message['dead']:
+            if id not in entities:
+                continue
+            tiles.add(entities[id]._position()[:2])
+            if id in new:
+                new.discard(id)
+            else:
+                self.dead.add(id)
+            moved.pop(id, None)
+            hp.pop(id, None)
+
+        sectors = state.map._sectors
+        for data in message['changedSectors']:
+            top_left = Location(data['topLeft']['x'], data['topLeft']['y'])
+            Changes._merge(self.sectors, top_left, sectors[top_left].team,
+                           state.teams[data['controllingTeamID']])
+
+        if message['lastTeamID'] == state.my_team.id:
+            self.failed.extend(zip(message['failed'], message['reasons']))
+
+    @staticmethod
+    def _merge(changes, key, old, new):
+        if key in changes:
+            old = changes[key][0]
+        if old == new:
+            changes.pop(key, None)
+        else:
+            changes[key] = (old, new)
+
+class HistoryState(State):
+    '''
+    A past turn's State, from Game.history. It can be looked at like any
+    other State, but its entities can't queue actions.
+    '''
+
+    def _queue(self, action):
+        raise BattlecodeError('states from game.history are read-only')
+
+    _queue_all = _queue
+
+class History(object):
+    '''
+    The last few turns of a game as the server sent them. Get it from
+    game.history.
+
+    Entity records are kept in chunks shared between turns, so recording a
+    turn only copies the chunks that changed rather than the whole state.
+    history[-1] is the current turn, history[-2] the one before and so on;
+    each lookup builds a fresh HistoryState, so keep it if you need it twice.
+    Attributes:
+        size (int): the most turns kept
+    '''
+
+    # entity ids per shared chunk
+    _CHUNK = 32
+
+    def __init__(self, teams, my_team_id, initialState, size=16):
+        self.size = size
+        self._teams = teams
+        self._my_team_id = my_team_id
+        self._map = {
+            'width': initialState['width'],
+            'height': initialState['height'],
+            'tiles': initialState['tiles'],
+            'sectorSize': initialState['sectorSize'],
+        }
+
+        chunk_size = History._CHUNK
+        chunks = {}
+        for data in initialState['entities']:
+            chunk = chunks.get(data['id'] // chunk_size)
+            if chunk is None:
+                chunk = chunks[data['id'] // chunk_size] = {}
+            chunk[data['id']] = data
+        sectors = {}
+        for data in initialState['sectors']:
+            sectors[data['topLeft']['x'], data['topLeft']['y']] = data
+
+        # (turn, {chunk number: {entity id: data}}, {(x, y): sector data})
+        self._turns = collections.deque([(0, chunks, sectors)], maxlen=size)
+
+    def __len__(self):
+        return len(self._turns)
+
+    def __getitem__(self, index):
+        '''
+        Args:
+            index (int): which turn; negative counts back from the latest
+        Returns:
+            HistoryState: the state at the end of that turn
+        '''
+        turn, chunks, sectors = self._turns[index]
+        initialState = dict(self._map)
+        entities = []
+        for chunk in chunks.values():
+            entities.extend(chunk.values())
+        initialState['entities'] = entities
+        initialState['sectors'] = list(sectors.values())
+        state = HistoryState(None, self._teams, self._my_team_id, initialState)
+        state.turn = turn
+        state.speculate = False
+        return state
+
+    def records(self, entity_id):
+        '''
+        What the server said about an entity over the kept turns, e.g. to
+        follow an enemy's path or hp.
+        Args:
+            entity_id (int): the entity's id
+        Returns:
+            [(int, dict)]: (turn, the server's data for the entity, or None
+                           if it didn't exist then), oldest first
+        '''
+        number = entity_id // History._CHUNK
+        result = []
+        for turn, chunks, _ in self._turns:
+            chunk = chunks.get(number)
+            result.append((turn, None if chunk is None else chunk.get(entity_id)))
+        return result
+
+    def _record(self, turn, message):
+        _, chunks, sectors = self._turns[-1]
+        chunk_size = History._CHUNK
+        chunks = dict(chunks)
+        copied = set()
+
+        def writable(number):
+            if number not in copied:
+                copied.add(number)
+                chunks[number] = dict(chunks.get(number, ()))
+            return chunks[number]
+
+        for data in message['changed']:
+            writable(data['id'] // chunk_size)[data['id']] = data
+        for id in message['dead']:
+            number = id // chunk_size
+            if number in chunks and id in chunks[number]:
+                chunk = writable(number)
+                del chunk[id]
+                if not chunk:
+                    del chunks[number]
+                    copied.discard(number)
+
+        if message['changedSectors']:
+            sectors = dict(sectors)
+            for data in message['changedSectors']:
+                sectors[data['topLeft']['x'], data['topLeft']['y']] = data
+
+        self._turns.append((turn, chunks, sectors))
+
+class TurnStats(object):
+    '''
+    Wall-clock timings for every phase of the turns this bot has played.
+    Get it from game.stats.
+    The phases are:
+        recv: waiting for the server in _recv
+        decode: json decoding in the communication thread
+        apply: applying the server's deltas to the state
+        copy: copying the state for speculation
+        bot: your code in the body of the game.turns() loop
+        send: sending the turn's actions to the server
+    Attributes:
+        records ([dict]): one record per turn, mapping each phase to its
+                          time in seconds. Records also have 'turn' and
+                          'total' entries.
+        window (int): the number of recent turns the percentiles cover
+    '''
+
+    PHASES = ('recv', 'decode', 'apply', 'copy', 'bot', 'send')
+
+    def __init__(self, game, window=1000):
+        self._game = game
+        self.window = window
+        self.records = []
+        self._samples = {}
+        for phase in TurnStats.PHASES + ('total',):
+            self._samples[phase] = collections.deque(maxlen=window)
+        self._current = dict.fromkeys(TurnStats.PHASES, 0.0)
+        # decode time is added by the communication thread
+        self._decode = 0.0
+        self._lock = threading.Lock()
+
+    def _add(self, phase, seconds):
+        self._current[phase] += seconds
+
+    def _add_decode(self, seconds):
+        with self._lock:
+            self._decode += seconds
+
+    def _end_turn(self, turn):
+        with self._lock:
+            self._current['decode'] += self._decode
+            self._decode = 0.0
+
+        record = self._current
+        record['turn'] = turn
+        record['total'] = sum(record[phase] for phase in TurnStats.PHASES)
+        self.records.append(record)
+        for phase in self._samples:
+            self._samples[phase].append(record[phase])
+
+        self._current = dict.fromkeys(TurnStats.PHASES, 0.0)
+
+    def percentiles(self, phase):
+        '''
+        Percentiles for one phase over the last window turns.
+        Args:
+            phase (string): one of TurnStats.PHASES, or 'total'
+        Returns:
+            dict: seconds at 'p50', 'p95', 'p99' and 'max'. Empty if no turns
+                  have been played yet.
+        '''
+        samples = sorted(self._samples[phase])
+        if not samples:
+            return {}
+        last = len(samples) - 1
+        return {
+            'p50': samples[int(last * .50)],
+            'p95': samples[int(last * .95)],
+            'p99': samples[int(last * .99)],
+            'max': samples[last],
+        }
+
+    def summary(self):
+        '''
+        Returns:
+            dict: the percentiles of every phase, and 'total', by name
+        '''
+        result = {}
+        for phase in TurnStats.PHASES + ('total',):
+            result[phase] = self.percentiles(phase)
+        return result
+
+    def missed(self):
+        '''
+        The records of the turns the server told us we missed, with the phase
+        that took the longest under 'slowest'.
+        Returns:
+            [dict]: records of missed turns
+        '''
+        missed = []
+        for record in self.records:
+            if record['turn'] in self._game._missed_turns:
+                record = dict(record)
+                record['slowest'] = max(TurnStats.PHASES, key=record.get)
+                missed.append(record)
+        return missed
+
+    def dump(self, path):
+        '''
+        Write every turn's record to a file. Paths ending in .csv are written
+        as CSV, anything else as JSON.
+        Args:
+            path (string): the file to write
+        '''
+        columns = ('turn',) + TurnStats.PHASES + ('total', 'missed')
+        rows = []
+        for record in self.records:
+            row = dict(record)
+            row['missed'] = record['turn'] in self._game._missed_turns
+            rows.append(row)
+
+        with open(path, 'w') as f:
+            if path.endswith('.csv'):
+                f.write(','.join(columns) + '\n')
+                for row in rows:
+                    f.write(','.join(str(row[column]) for column in columns) + '\n')
+            else:
+                f.write(json.dumps({'turns': rows, 'summary': self.summary()}))
+
+    def __str__(self):
+        lines = []
+        for phase, result in sorted(self.summary().items()):
+            if result:
+                lines.append('{:>6}: p50 {:.2f}ms p95 {:.2f}ms p99 {:.2f}ms max {:.2f}ms'.format(
+                    phase, result['p50']*1000, result['p95']*1000,
+                    result['p99']*1000, result['max']*1000))
+        return '\n'.join(lines)
+
+# filename: sorted (first line, last line, function name) of its functions,
+# see _function_at
+_line_functions = {}
+
+def _function_at(filename, lineno):
+    '''The name of the innermost function in filename around lineno, or None.'''
+    functions = _line_functions.get(filename)
+    if functions is None:
+        functions = []
+        try:
+            with open(filename) as f:
+                code = compile(f.read(), filename, 'exec')
+        except (IOError, OSError, SyntaxError, ValueError):
+            code = None
+        stack = [code] if code is not None else []
+        while stack:
+            code = stack.pop()
+            for const in code.co_consts:
+                if hasattr(const, 'co_code'):
+                    stack.append(const)
+            if code.co_name == '<module>':
+                continue
+            if hasattr(code, 'co_lines'):
+                lines = [line for _, _, line in code.co_lines() if line is not None]
+            else:
+                import dis
+                lines = [line for _, line in dis.findlinestarts(code)]
+            functions.append((code.co_firstlineno, max(lines + [code.co_firstlineno]),
+                              getattr(code, 'co_qualname', code.co_name)))
+        functions.sort()
+        _line_functions[filename] = functions
+
+    best = None
+    for first, last, name in functions:
+        if first > lineno:
+            break
+        if lineno <= last and (best is None or first >= best[0]):
+            best = (first, name)
+    return best[1] if best is not None else None
+
+class MemoryStats(object):
+    '''
+    Where the client's memory goes, turn by turn, measured with tracemalloc.
+    Get it from game.memory after game.turns(trace_memory=True). Tracing
+    makes everything several times slower, so game.stats timings taken at
+    the same time are inflated.
+
+    Memory is put down to the innermost function of battlecode.py that
+    allocated it, like 'battlecode:State.get_entities', or else to the
+    innermost function of whatever file did, like 'mybot:choose_move'.
+    Attributes:
+        records ([dict]): one record per turn, with:
+            turn: the turn number
+            bytes, count: memory allocated during the turn and still in
+                use at its end, net of what was freed
+            peak: the most memory in use during the turn, above where it
+                  started; None before python 3.9
+            traced: memory in use at the end of the turn, leaving out
+                    MemoryStats itself
+            rss: the process's peak resident size so far, or None if the
+                 platform can't tell
+            entities: the number of entities in the state
+            sites: {site: [bytes, count]} for the top sites of the turn
+        window (int): how many turns the trend warning looks at
+    '''
+
+    def __init__(self, game, frames=16, top=10, window=50):
+        if tracemalloc is None:
+            raise BattlecodeError('tracing memory needs the tracemalloc module (python 3.4+)')
+        self._game = game
+        self._frames = frames
+        self._top = top
+        self.window = window
+        self.records = []
+        self._sites = None
+        self._site_names = {}
+        self._base = None
+        self._started = False
+        self._warned_at = 0
+        self._client = os.path.abspath(__file__).rsplit('.', 1)[0]
+        self._tracemalloc = tracemalloc.__file__.rsplit('.', 1)[0]
+
+    def _start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self._frames)
+            self._started = True
+        # our own bookkeeping isn't the bot's memory
+        client = os.path.abspath(__file__)
+        _function_at(client, 0)
+        self._own_lines = [(first, last) for first, last, name in _line_functions[client]
+                           if name.startswith(('MemoryStats.', '_function_at'))]
+        self._sites = self._take_snapshot()
+        self._reset_peak()
+
+    def _reset_peak(self):
+        self._base = None
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            self._base = tracemalloc.get_traced_memory()[0]
+
+    def _stop(self):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+        self._sites = None
+        self._site_names = {}
+
+    def _take_snapshot(self):
+        '''{site: [bytes, count]} of the memory in use now.'''
+        # cycles left over from the last turn's copy would look like growth
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot()
+        # grouping each snapshot once and diffing the sums is much faster than
+        # Snapshot.compare_to, which groups both snapshots every time; and
+        # Snapshot.filter_traces is slower still, so _site leaves things out
+        names = self._site_names
+        sites = {}
+        for stat in snapshot.statistics('traceback'):
+            try:
+                name = names[stat.traceback]
+            except KeyError:
+                name = names[stat.traceback] = self._site(stat.traceback)
+            if name is None:
+                continue
+            site = sites.get(name)
+            if site is None:
+                sites[name] = [stat.size, stat.count]
+            else:
+                site[0] += stat.size
+                site[1] += stat.count
+        return sites
+
+    def _site(self, traceback):
+        '''The site to put the memory allocated at traceback down to, or
+        None if it's our own.'''
+        innermost = site = None
+        for frame in reversed(traceback):
+            path = frame.filename.rsplit('.', 1)[0]
+            if path == self._tracemalloc:
+                return None
+            if path == self._client:
+                for first, last in self._own_lines:
+                    if first <= frame.lineno <= last:
+                        return None
+                if site is None:
+                    name = _function_at(frame.filename, frame.lineno)
+                    site = 'battlecode:' + (name or str(frame.lineno))
+            if innermost is None:
+                innermost = frame
+        if site is not None:
+            return site
+        if innermost is None:
+            return '<unknown>'
+        module = os.path.basename(innermost.filename).rsplit('.', 1)[0]
+        name = _function_at(innermost.filename, innermost.lineno)
+        return '{}:{}'.format(module, name or innermost.lineno)
+
+    def _end_turn(self, turn):
+        if self._sites is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        previous = self._sites
+        current_sites = self._take_snapshot()
+
+        sites = {}
+        for name in set(current_sites) | set(previous):
+            size, count = current_sites.get(name, (0, 0))
+            old_size, old_count = previous.get(name, (0, 0))
+            if size != old_size or count != old_count:
+                sites[name] = [size - old_size, count - old_count]
+        total_bytes = sum(site[0] for site in sites.values())
+        total_count = sum(site[1] for site in sites.values())
+        top = sorted(sites.items(), key=lambda item: -abs(item[1][0]))[:self._top]
+
+        rss = None
+        if resource is not None:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes, except on macs
+            if sys.platform != 'darwin':
+                rss *= 1024
+        state = self._game.state
+        self.records.append({
+            'turn': turn,
+            'bytes': total_bytes,
+            'count': total_count,
+            'peak': peak - self._base if self._base is not None else None,
+            'traced': sum(site[0] for site in current_sites.values()),
+            'rss': rss,
+            'entities': len(state.entities) if state is not None else 0,
+            'sites': dict(top),
+        })
+
+        self._sites = current_sites
+        self._reset_peak()
+        self._check_trend()
+
+    def _check_trend(self):
+        '''Warn if memory in use kept going up over the last window turns.'''
+        records = self.records
+        window = self.window
+        # the first window is warming up: caches and history filling in
+        if len(records) < 2 * window or len(records) - self._warned_at < window:
+            return
+        recent = records[-window:]
+        # least squares slope of the traced memory
+        mean_x = (window - 1) / 2.
+        mean_y = sum(record['traced'] for record in recent) / float(window)
+        slope = sum((i - mean_x) * (record['traced'] - mean_y)
+                    for i, record in enumerate(recent)) / \
+            sum((i - mean_x) ** 2 for i in range(window))
+        growth = slope * window
+        if growth < max(64 * 1024, .05 * recent[0]['traced']):
+            return
+
+        self._warned_at = len(records)
+        growers = {}
+        for record in recent:
+            for site, (size, _) in record['sites'].items():
+                growers[site] = growers.get(site, 0) + size
+        growers = sorted((size, site) for site, size in growers.items() if size > 0)[::-1][:3]
+        sys.stderr.write(
+            'Battlecode warning: memory in use grew by {:.0f}KB per turn over the last {} '
+            'turns (entities: {} -> {}); growing most: {}\n'.format(
+                slope / 1024., window, recent[0]['entities'], recent[-1]['entities'],
+                ', '.join('{} {:+.0f}KB'.format(site, size / 1024.) for size, site in growers)))
+
+    def top(self, turns=None):
+        '''
+        The sites that allocated the most over some turns.
+        Args:
+            turns (int): how many of the latest turns to count; all if None
+        Returns:
+            [(str, int, int)]: (site, bytes, count), most bytes first
+        '''
+        records = self.records if turns is None else self.records[-turns:]
+        totals = {}
+        for record in records:
+            for site, (size, count) in record['sites'].items():
+                total = totals.setdefault(site, [0, 0])
+                total[0] += size
+                total[1] += count
+        return sorted(((site, size, count) for site, (size, count) in totals.items()),
+                      key=lambda item: -item[1])
+
+    def __str__(self):
+        lines = []
+        if self.records:
+            last = self.records[-1]
+            lines.append('traced {:.0f}KB, peak rss {}'.format(
+                last['traced'] / 1024.,
+                '{:.0f}KB'.format(last['rss'] / 1024.) if last['rss'] is not None else 'unknown'))
+        for site, size, count in self.top()[:self._top]:
+            lines.append('{:>10.1f}KB {:>8} {}'.format(size / 1024., count, site))
+        return '\n'.join(lines)
+
+class TurnProfiler(object):
+    '''
+    Samples the bot's stack during its part of each turn, from being given
+    the state to asking for the next one, and keeps the samples of turns
+    that took longer than threshold or that the server says we missed.
+    Get it from game.profiler after game.turns(profile=threshold).
+
+    The samples are taken by a thread, so the bot can run anywhere and keep
+    its signal handlers. But while the bot is running python the thread only
+    gets a look in every sys.getswitchinterval() (5ms by default), however
+    small interval is.
+    Attributes:
+        records ([dict]): one per kept turn, in turn order, with:
+            turn: the turn number
+            seconds: how long the bot took
+            samples: {stack: count}, where a stack is 'module:function'
+                     frames joined by ';', outermost first
+        threshold (float): seconds the bot can take before a turn is kept
+        interval (float): seconds between samples
+    '''
+
+    def __init__(self, game, threshold, interval=.001, pending=4):
+        if not hasattr(sys, '_current_frames'):
+            raise BattlecodeError('profiling needs sys._current_frames (CPython)')
+        self._game = game
+        self.threshold = threshold
+        self.interval = interval
+        self.records = []
+        # the missedTurn message can come after we've moved on, so the last
+        # few turns are kept around in case
+        self._pending = collections.deque(maxlen=pending)
+        self._samples = None
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_id = None
+
+    def _start(self):
+        self._thread_id = threading.current_thread().ident
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='Battlecode Profiler Thread')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stop(self):
+        self._stopped.set()
+        with self._lock:
+            self._samples = None
+        self._keep_missed()
+
+    def _begin(self):
+        with self._lock:
+            self._samples = {}
+
+    def _end(self, turn, seconds):
+        with self._lock:
+            samples = self._samples
+            self._samples = None
+        if samples is None:
+            return
+        if seconds >= self.threshold or turn in self._game._missed_turns:
+            self._keep(turn, seconds, samples)
+        else:
+            self._pending.append((turn, seconds, samples))
+        self._keep_missed()
+
+    def _keep_missed(self):
+        missed = self._game._missed_turns
+        for pending in [pending for pending in self._pending if pending[0] in missed]:
+            self._pending.remove(pending)
+            self._keep(*pending)
+
+    def _keep(self, turn, seconds, samples):
+        stacks = {}
+        for codes, count in samples.items():
+            stack = ';'.join(self._label(code) for code in reversed(codes))
+            stacks[stack] = stacks.get(stack, 0) + count
+        self.records.append({'turn': turn, 'seconds': seconds, 'samples': stacks})
+        if len(self.records) > 1 and self.records[-2]['turn'] > turn:
+            self.records.sort(key=lambda record: record['turn'])
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.basename(code.co_filename).rsplit('.', 1)[0]
+            label = self._labels[code] = '{}:{}'.format(
+                module, getattr(code, 'co_qualname', code.co_name))
+        return label
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            samples = self._samples
+            if samples is None:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            codes = tuple(codes)
+            with self._lock:
+                # the turn might have ended while we looked
+                if self._samples is samples:
+                    samples[codes] = samples.get(codes, 0) + 1
+
+    def collapsed(self, by_turn=False):
+        '''
+        The kept samples as collapsed stacks, the input format of
+        flamegraph.pl and most other flame graph tools.
+        Args:
+            by_turn (bool): start every stack with a 'turn N' frame (marked
+                            'missed' if it was), to tell the turns apart
+        Returns:
+            [str]: lines of 'frame;frame;... count'
+        '''
+        missed = self._game._missed_turns
+        totals = {}
+        for record in self.records:
+            prefix = ''
+            if by_turn:
+                prefix = 'turn {}{};'.format(record['turn'],
+                                             ' missed' if record['turn'] in missed else '')
+            for stack, count in record['samples'].items():
+                stack = prefix + stack
+                totals[stack] = totals.get(stack, 0) + count
+        return ['{} {}'.format(stack, count) for stack, count in sorted(totals.items())]
+
+    def dump(self, path, by_turn=False):
+        '''
+        Write the collapsed stacks to a file, see collapsed().
+        Args:
+            path (string): the file to write
+            by_turn (bool): split the stacks up by turn
+        '''
+        with open(path, 'w') as f:
+            for line in self.collapsed(by_turn):
+                f.write(line + '\n')
+
+    def __str__(self):
+        missed = self._game._missed_turns
+        leaves = {}
+        total = 0
+        for record in self.records:
+            for stack, count in record['samples'].items():
+                leaf = stack.rsplit(';', 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+                total += count
+        lines = ['{} turns kept ({} missed), {} samples'.format(
+            len(self.records), sum(1 for record in self.records if record['turn'] in missed),
+            total)]
+        for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:10]:
+            lines.append('{:>6.1f}% {}'.format(100. * count / total, leaf))
+        return '\n'.join(lines)
+
+class Game(object):
+    '''
+    This is the game that is being played.
+    Running the init connects your code to the engine to play the game
+    Create a for loop which iterates through game.turns to play the game. It
+    will give a state for each turn with which you can see and perform
+    actions.
+    '''
 
-        # setup connection
+    # messages longer than this are decoded as they arrive; see _StreamingDecoder
+    _CHUNK = 2**16
+
+    def __init__(self, name, server=DEFAULT_SERVER, stats_path=None, history_size=16,
+                 reconnect=3):
+        '''Connect to the server and wait for the first turn.
+        name is the name this bot would like to be called; it will be ignored on the
+        scrimmage server.
+        Server is the address to connect to. Leave it as None to connect to a default local
+        server; you shouldn't need to mess with it unless you're making custom matchmaking stuff.
+        'shm:' followed by the path of the server's unix socket talks to a server on the same
+        machine through shared memory instead, which localserver.py supports.
+        stats_path is a file to dump the turn timings in game.stats to when the game
+        ends, as CSV if it ends with .csv and JSON otherwise. It defaults to the
+        BATTLECODE_STATS environment variable.
+        history_size is how many past turns game.history keeps; 0 turns it off.
+        reconnect is how many times to try logging in again if the connection
+        drops mid-game; the state is then brought up to date from the server's
+        next keyframe, keeping the same Entity objects. game.reconnects lists
+        how long each took, in seconds.'''
+
+        conn, stream = Game._open(server)
+        self._setup(name, stream, stats_path, history_size)
+        self._conn = conn
+        self._server = server
+        self._reconnect_attempts = reconnect
+        self._start_recv_thread()
+
+        self._handle_login(self._recv())
+        self._handle_start(self._recv())
+
+        # wait for our first turn
+        self._await_turn()
+
+    @staticmethod
+    def _open(server):
+        '''Open a stream of messages to server.
+        Returns:
+            (socket, stream): the connection, and the stream over it
+        '''
+        if isinstance(server, str) and server.startswith('shm:'):
+            stream = _SharedMemoryStream.connect(server[len('shm:'):])
+            return stream._conn, stream
+        conn = Game._connect(server)
+        return conn, conn.makefile('rwb', 2**16)
+
+    @staticmethod
+    def _connect(server):
+        '''Open a connected socket to server.'''
         if isinstance(server, str) and server.startswith('/') and os.name != 'nt':
             # unix domain socket
             conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM);
@@ -1173,8 +4432,18 @@ class Game(object):
             conn = socket.socket()
         # connect to the server
         conn.connect(server)
+        return conn
 
-        self._socket = conn.makefile('rwb', 2**16)
+    def _setup(self, name, stream, stats_path, history_size):
+        '''Log in over stream, a file-like object connected to the server.'''
+        assert isinstance(name, str) \
+               and len(name) > 5 and len(name) < 100, \
+               'invalid team name: '+unicode(name)
+
+        self._socket = stream
+        # set by Game() itself, which reads on a thread of its own
+        self._conn = None
+        self._comm_thread = None
 
         # send login command
         login = {
@@ -1187,23 +4456,35 @@ class Game(object):
             login['key'] = key
 
         self._send(login)
+        self._login = login
+        self._reconnect_attempts = 0
+        self.reconnects = []
 
         self._recv_queue = Queue()
 
         self._missed_turns = set()
 
-        commThread = threading.Thread(target=self._recv_thread, name='Battlecode Communication Thread')
-        commThread.daemon = True
-        commThread.start()
+        self.stats = TurnStats(self)
+        self.memory = None
+        self.profiler = None
+        self._profile_path = os.environ.get('BATTLECODE_PROFILE')
+        if stats_path is None:
+            stats_path = os.environ.get('BATTLECODE_STATS')
+        self._stats_path = stats_path
+
+        self._history_size = history_size
+        self.history = None
+
+        self.state = None
+        self.winner = None
+        self._next_team = None
 
-        # handle login response
-        resp = self._recv()
+    def _handle_login(self, resp):
         assert resp['command'] == 'loginConfirm'
 
         self.my_team_id = resp['teamID']
 
-        # wait for the start command
-        start = self._recv()
+    def _handle_start(self, start):
         assert start['command'] == 'start'
 
         teams = {}
@@ -1217,11 +4498,9 @@ class Game(object):
 
         self.state = State(self, teams, self.my_team_id, initialState)
 
-        self.winner = None
-
-        # wait for our first turn
-        self._next_team = None
-        self._await_turn()
+        if self._history_size:
+            self.history = History(teams, self.my_team_id, initialState,
+                                   self._history_size)
 
     def _send(self, message):
         '''Send a dictionary as JSON to the server.
@@ -1233,34 +4512,90 @@ class Game(object):
         self._socket.write(b'\n')
         self._socket.flush()
 
-    def _recv_thread(self):
+    def _start_recv_thread(self):
+        commThread = threading.Thread(target=self._recv_thread, args=(self._socket,),
+                                      name='Battlecode Communication Thread')
+        commThread.daemon = True
+        commThread.start()
+        self._comm_thread = commThread
+
+    def _recv_thread(self, stream):
         '''Loop, receiving '\n'-delimited JSON messages from the server.
         See server/src/schema.ts for valid messages.'''
         while True:
-            # next() reads lines from a file object
             try:
-                message = next(self._socket)
+                message = stream.readline(Game._CHUNK)
+                if message and not message.endswith(b'\n'):
+                    # too big for one read: decode it as the rest arrives
+                    message = self._decode_stream(message, stream)
             except:
                 self._recv_queue.put(None)
                 return
-
-            message = message.decode()
-            result = json.loads(message)
-
-            if "command" not in result:
+            if not message:
                 self._recv_queue.put(None)
-                raise BattlecodeError("Unknown result: "+str(result))
-            elif result['command'] == 'error':
-                if result['reason'].startswith('wrong turn'):
-                    sys.stderr.write('Battlecode warning: missed turn, speed up your code!\n')
+                return
+
+            try:
+                if isinstance(message, dict):
+                    result = self._dispatch(message)
                 else:
-                    raise BattlecodeError(result['reason'])
-            elif result['command'] == 'missedTurn':
-                sys.stderr.write('Battlecode warning: missed turn {}, speed up your code!\n'.format(result['turn']))
-                self._missed_turns.add(result['turn'])
-            else:
+                    result = self._decode(message)
+            except BattlecodeError:
+                self._recv_queue.put(None)
+                raise
+
+            if result is not None:
                 self._recv_queue.put(result)
 
+    def _decode(self, message):
+        '''Decode a line from the server. Errors and missed turns are handled
+        here; anything else is returned for _await_turn.'''
+        start = _clock()
+        message = message.decode()
+        result = json.loads(message)
+        self.stats._add_decode(_clock() - start)
+        return self._dispatch(result)
+
+    def _decode_stream(self, data, stream):
+        '''
+        Decode a message that didn't fit in one read, reading the rest of it.
+        Args:
+            data (bytes): its first chunk
+            stream: where to read the rest from
+        Returns:
+            dict: the message, or None if the server hung up partway through
+        '''
+        decoder = _StreamingDecoder()
+        seconds = 0.
+        while True:
+            final = data.endswith(b'\n')
+            start = _clock()
+            decoder.feed(data, final)
+            seconds += _clock() - start
+            if final:
+                break
+            data = stream.readline(Game._CHUNK)
+            if not data:
+                return None
+        self.stats._add_decode(seconds)
+        return decoder.value
+
+    def _dispatch(self, result):
+        '''Handle a decoded message; see _decode.'''
+        if "command" not in result:
+            raise BattlecodeError("Unknown result: "+str(result))
+        elif result['command'] == 'error':
+            if result['reason'].startswith('wrong turn'):
+                sys.stderr.write('Battlecode warning: missed turn, speed up your code!\n')
+            else:
+                raise BattlecodeError(result['reason'])
+        elif result['command'] == 'missedTurn':
+            sys.stderr.write('Battlecode warning: missed turn {}, speed up your code!\n'.format(result['turn']))
+            self._missed_turns.add(result['turn'])
+        else:
+            return result
+        return None
+
     def _recv(self):
         '''Pull a message from our queue; blocking.'''
         while True:
@@ -1279,6 +4614,8 @@ class Game(object):
         if self._socket is not None:
             self._socket = None
         self.winner = self.state.teams[winner_id]
+        if self._stats_path is not None:
+            self.stats.dump(self._stats_path)
 
     def next_turn(self):
         '''Submit queued actions, and wait for our next turn.'''
@@ -1287,82 +4624,1117 @@ class Game(object):
 
     def _await_turn(self):
         while True:
+            start = _clock()
             turn = self._recv()
+            self.stats._add('recv', _clock() - start)
 
             if turn is None:
+                if self.winner is None and self._reconnect():
+                    continue
                 self._finish(0)
                 return
 
-            if turn['command'] == 'keyframe':
-                self.state._validate_keyframe(turn)
-                continue
+            if self._handle_turn(turn) and \
+                    (self.winner is not None or not self._can_recv_more()):
+                return
 
-            assert turn['command'] == 'nextTurn'
+    def _handle_turn(self, turn):
+        '''
+        Apply a keyframe or nextTurn message to the state.
+        Returns:
+            bool: True if it's our turn or the game is over, None for
+                  keyframes
+        '''
+        if turn['command'] == 'keyframe':
+            self.state._validate_keyframe(turn)
+            return None
 
-            self.state._update_entities(turn['changed'])
-            self.state._kill_entities(turn['dead'])
-            self.state.map._update_sectors(turn['changedSectors'])
+        assert turn['command'] == 'nextTurn'
 
-            self.state.turn = turn['turn'] + 1
+        self._apply(turn)
 
-            if 'winnerID' in turn:
-                self._finish(turn['winnerID'])
-                return
+        if 'winnerID' in turn:
+            self._finish(turn['winnerID'])
+            return True
 
-            if __debug__:
-                if turn['lastTeamID'] == self.state.my_team.id:
-                    # handle what happened last turn
-                    for action, reason in zip(turn['failed'], turn['reasons']):
-                        print('failed: {}:{} reason: {}'.format(
-                            action['id'],
-                            action['action'],
-                            self.state.turn,
-                            reason,
-                        ))
-
-            if turn['nextTeamID'] == self.state.my_team.id and not self._can_recv_more():
-                return
+        if __debug__:
+            if turn['lastTeamID'] == self.state.my_team.id:
+                # handle what happened last turn
+                for action, reason in zip(turn['failed'], turn['reasons']):
+                    print('failed: {}:{} reason: {}'.format(
+                        action['id'],
+                        action['action'],
+                        self.state.turn,
+                        reason,
+                    ))
+
+        return turn['nextTeamID'] == self.state.my_team.id
+
+    def _apply(self, turn):
+        '''Apply the deltas of a nextTurn message to the state.'''
+        start = _clock()
+        self.state._memo.clear()
+        self.state.changes._record(self.state, turn)
+        self.state._update_entities(turn['changed'])
+        self.state._kill_entities(turn['dead'])
+        self.state.map._update_sectors(turn['changedSectors'])
+        if self.history is not None:
+            self.history._record(turn['turn'] + 1, turn)
+        self.state.turn = turn['turn'] + 1
+        for field in self.state._distance_fields.values():
+            field._refresh()
+        # so the copies made for the bot start out with only this turn's
+        # changes to sort out
+        for team_id in self.state._influence_cache:
+            self.state._influence(team_id)
+        self.state._drain_ready(self.state.turn)
+        self.stats._add('apply', _clock() - start)
+
+    def _reconnect(self):
+        '''
+        Log in again after the connection dropped, and bring the state up to
+        date from the first keyframe the server sends.
+        Returns:
+            bool: False if we couldn't get back into the game
+        '''
+        start = _clock()
+        self._close_socket()
 
-    def _submit_turn(self):
-        if self.state.turn in self._missed_turns:
-            self.state._action_queue = []
-            return
-        if self._socket is None:
-            return
-        self._send({
-            'command': 'makeTurn',
-            'turn': self.state.turn,
-            'actions': self.state._action_queue
+        for attempt in range(self._reconnect_attempts):
+            if attempt:
+                self._close_socket()
+                time.sleep(.05 * 2 ** attempt)
+            try:
+                self._conn, self._socket = Game._open(self._server)
+                self._send(self._login)
+            except (socket.error, IOError, BattlecodeError):
+                continue
+            self._start_recv_thread()
+
+            message = self._recv()
+            if message is None or message['command'] != 'loginConfirm':
+                continue
+            if message['teamID'] != self.my_team_id:
+                raise BattlecodeError('reconnected as team {} instead of {}'.format(
+                    message['teamID'], self.my_team_id))
+
+            # turns before the keyframe can't be applied; it covers them
+            while True:
+                message = self._recv()
+                if message is None:
+                    break
+                if message['command'] == 'nextTurn' and 'winnerID' in message:
+                    self._finish(message['winnerID'])
+                    return True
+                if message['command'] in ('keyframe', 'start'):
+                    self._resync(message.get('state') or message['initialState'])
+                    self.reconnects.append(_clock() - start)
+                    return True
+        self._close_socket()
+        return False
+
+    def _close_socket(self):
+        '''
+        Hang up, wait for the thread reading from the connection to stop, and
+        drop whatever it left in the queue.
+        '''
+        conn, stream, thread = self._conn, self._socket, self._comm_thread
+        self._conn = self._socket = self._comm_thread = None
+        if conn is not None:
+            # wakes the thread if it's blocked reading; closing the stream
+            # first would wait for it
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass
+        if thread is not None:
+            thread.join()
+        for closable in (stream, conn):
+            if closable is not None:
+                try:
+                    closable.close()
+                except (socket.error, IOError, ValueError):
+                    pass
+        while not self._recv_queue.empty():
+            self._recv_queue.get()
+
+    def _resync(self, keyframe_state):
+        '''Bring the state in line with a keyframe's state by applying the difference.'''
+        delta = self.state._keyframe_delta(keyframe_state)
+        delta.update({
+            'command': 'nextTurn',
+            'turn': self.state.turn - 1,
+            'lastTeamID': None,
+            'nextTeamID': None,
+            'failed': [],
+            'reasons': [],
         })
+        self._apply(delta)
+
+    def _submit_turn(self):
+        # the bot has seen these now
+        self.state.changes = Changes()
+        # a missed turn isn't sent, and neither is anything once the
+        # connection is gone, but the turn still ends in the stats
+        if self.state.turn not in self._missed_turns and self._socket is not None:
+            start = _clock()
+            try:
+                self._send({
+                    'command': 'makeTurn',
+                    'turn': self.state.turn,
+                    'actions': self.state._action_queue
+                })
+            except (socket.error, IOError, ValueError):
+                # the connection dropped; _await_turn will find out and reconnect
+                pass
+            self.stats._add('send', _clock() - start)
         self.state._action_queue = []
+        self.stats._end_turn(self.state.turn)
+        if self.memory is not None:
+            self.memory._end_turn(self.state.turn)
 
     def _queue(self, action):
         self.state._action_queue.append(action)
 
-    def turns(self, copy=True, speculate=True):
+    def _queue_all(self, actions):
+        self.state._action_queue.extend(actions)
+
+    def turns(self, copy=True, speculate=True, memoize=False, trace_memory=False,
+              profile=None):
         '''
         Returns an iterator. You should for loop over this function to get a
         copy of state for each turn.
+        memoize sets state.memoize on every state.
+        trace_memory records where memory is allocated every turn in
+        game.memory; see MemoryStats. It's slow, so only use it to look
+        into memory use.
+        profile samples what the bot is doing every turn, and keeps the
+        samples in game.profiler for turns where it takes longer than this
+        many seconds, or that it misses; see TurnProfiler. 0 keeps every
+        turn. They're written to the file in the BATTLECODE_PROFILE
+        environment variable, if it's set, as collapsed stacks for flame
+        graphs.
         Returns:
             State: a state that you can play on
         '''
 
         if speculate:
             copy = True
-        while True:
-            self.next_turn()
-            if self.winner:
+        if trace_memory:
+            self.memory = MemoryStats(self)
+            self.memory._start()
+        if profile is not None:
+            self.profiler = TurnProfiler(self, profile)
+            self.profiler._start()
+        try:
+            while True:
+                self.next_turn()
+                if self.winner:
+                    return
+                else:
+                    state = self._playable_state(copy, speculate, memoize)
+                    start = _clock()
+                    if self.profiler is not None:
+                        self.profiler._begin()
+                    yield state
+                    seconds = _clock() - start
+                    self.stats._add('bot', seconds)
+                    if self.profiler is not None:
+                        self.profiler._end(state.turn, seconds)
+        finally:
+            if self.memory is not None:
+                self.memory._stop()
+            if self.profiler is not None:
+                self.profiler._stop()
+                if self._profile_path is not None:
+                    self.profiler.dump(self._profile_path, by_turn=True)
+
+    def _playable_state(self, copy, speculate, memoize):
+        '''The state to give the bot this turn, see turns()'''
+        self.state.speculate = speculate
+        self.state.memoize = memoize
+        if not copy:
+            return self.state
+        start = _clock()
+        self.state._game = None
+        speculative = _deepcopy(self.state)
+        speculative._game = self
+        self.state._game = self
+        self.stats._add('copy', _clock() - start)
+        return speculative
+
+class GameHub(object):
+    '''
+    Plays many games at once from a single thread.
+
+    Every connection is watched with one selector; messages are applied to
+    the State of the game they belong to, and bot(game, state) is called
+    only when it's that game's turn. Use this instead of one Game (and one
+    process) per match when running lots of matches, e.g. for training.
+
+    Usage:
+        def bot(game, state):
+            for entity in state.get_entities(team=state.my_team):
+                ...
+
+        hub = battlecode.GameHub(bot)
+        for i in range(32):
+            hub.connect('trainer{}'.format(i))
+        hub.run()
+
+    Args:
+        bot: called as bot(game, state) on each of our turns
+        copy, speculate, memoize: as for Game.turns()
+        on_finish: called as on_finish(game) when a game ends
+    '''
+
+    def __init__(self, bot, copy=True, speculate=True, memoize=False, on_finish=None):
+        if selectors is None:
+            raise BattlecodeError('GameHub needs the selectors module (python 3.4+)')
+        self._bot = bot
+        self._copy = copy or speculate
+        self._speculate = speculate
+        self._memoize = memoize
+        self._on_finish = on_finish
+        self._selector = selectors.DefaultSelector()
+        # game -> [when it dropped, attempts so far] while logging in again
+        self._rejoining = {}
+        self.games = []
+        self.finished = []
+
+    def connect(self, name, server=DEFAULT_SERVER, stats_path=None, history_size=16,
+                reconnect=3):
+        '''
+        Log into a new game. Nothing is read until poll() or run(). The
+        arguments are as for Game(); a dropped connection is logged into
+        again between polls, and the game carries on from the next keyframe.
+        Returns:
+            Game: the game; its state is None until the server starts it.
+        '''
+        if isinstance(server, str) and server.startswith('shm:'):
+            raise BattlecodeError('GameHub only connects over sockets')
+        conn = Game._connect(server)
+        stream = conn.makefile('wb', 2**16)
+        game = Game.__new__(Game)
+        game._setup(name, stream, stats_path, history_size)
+        game._server = server
+        game._reconnect_attempts = reconnect
+        # data: game, socket, its write stream, chunks of the unfinished line
+        self._selector.register(conn, selectors.EVENT_READ, (game, conn, stream, []))
+        self.games.append(game)
+        return game
+
+    def run(self, timeout=None):
+        '''Plays until every game has finished.'''
+        while self.games:
+            self.poll(timeout)
+
+    def poll(self, timeout=0):
+        '''
+        Handle whatever the server has sent, playing a turn in every game
+        that's waiting on us.
+        Args:
+            timeout: seconds to wait for messages; None blocks
+        Returns:
+            int: the number of games still running
+        '''
+        for key, _ in self._selector.select(timeout):
+            self._read(*key.data)
+        return len(self.games)
+
+    def close(self):
+        '''Disconnect from every game that's still running.'''
+        for key in list(self._selector.get_map().values()):
+            self._close(*key.data[:3])
+        self._selector.close()
+
+    def _read(self, game, conn, stream, pending):
+        try:
+            data = conn.recv(2**16)
+        except socket.error:
+            data = b''
+        if not data:
+            if game.state is None or not self._rejoin(game, conn, stream):
+                if game.state is not None:
+                    game._finish(0)
+                self._close(game, conn, stream)
+            return
+
+        if b'\n' not in data:
+            pending.append(data)
+            return
+        pending.append(data)
+        lines = b''.join(pending).split(b'\n')
+        del pending[:]
+        if lines[-1]:
+            pending.append(lines[-1])
+
+        ours = False
+        for line in lines[:-1]:
+            message = game._decode(line)
+            if message is None:
+                continue
+            if game.state is None:
+                if message['command'] == 'loginConfirm':
+                    game._handle_login(message)
+                else:
+                    game._handle_start(message)
+                continue
+            if game in self._rejoining:
+                self._handle_rejoin(game, message)
+                if game.winner is not None:
+                    self._close(game, conn, stream)
+                    return
+                continue
+            result = game._handle_turn(message)
+            if game.winner is not None:
+                self._close(game, conn, stream)
                 return
+            if result is not None:
+                ours = result
+
+        # like Game, only play the latest turn if we've fallen behind
+        if ours:
+            state = game._playable_state(self._copy, self._speculate, self._memoize)
+            start = _clock()
+            self._bot(game, state)
+            game.stats._add('bot', _clock() - start)
+            game._submit_turn()
+
+    def _rejoin(self, game, conn, stream):
+        '''
+        Log game in again over a new connection, like Game._reconnect(), but
+        leave the replies to _read().
+        Returns:
+            bool: False once every attempt has failed
+        '''
+        self._hang_up(game, conn, stream)
+        # dropping again before the keyframe uses up another attempt
+        rejoin = self._rejoining.setdefault(game, [_clock(), 0])
+        while rejoin[1] < game._reconnect_attempts:
+            if rejoin[1]:
+                time.sleep(.05 * 2 ** rejoin[1])
+            rejoin[1] += 1
+            conn = stream = None
+            try:
+                conn = Game._connect(game._server)
+                stream = conn.makefile('wb', 2**16)
+                game._socket = stream
+                game._send(game._login)
+            except (socket.error, IOError, BattlecodeError):
+                self._hang_up(game, conn, stream)
+                continue
+            self._selector.register(conn, selectors.EVENT_READ, (game, conn, stream, []))
+            return True
+        del self._rejoining[game]
+        return False
+
+    def _handle_rejoin(self, game, message):
+        '''Skip messages until the keyframe game can be brought up to date from.'''
+        if message['command'] == 'loginConfirm':
+            if message['teamID'] != game.my_team_id:
+                raise BattlecodeError('reconnected as team {} instead of {}'.format(
+                    message['teamID'], game.my_team_id))
+        elif message['command'] == 'nextTurn' and 'winnerID' in message:
+            del self._rejoining[game]
+            game._finish(message['winnerID'])
+        elif message['command'] in ('keyframe', 'start'):
+            start, _ = self._rejoining.pop(game)
+            game._resync(message.get('state') or message['initialState'])
+            game.reconnects.append(_clock() - start)
+
+    def _hang_up(self, game, conn, stream):
+        game._socket = None
+        if conn is None:
+            return
+        try:
+            self._selector.unregister(conn)
+        except (KeyError, ValueError):
+            # never registered, or already hung up
+            pass
+        for closable in (stream, conn):
+            if closable is not None:
+                try:
+                    closable.close()
+                except (socket.error, IOError, ValueError):
+                    pass
+
+    def _close(self, game, conn, stream):
+        self._hang_up(game, conn, stream)
+        self._rejoining.pop(game, None)
+        self.games.remove(game)
+        self.finished.append(game)
+        if self._on_finish is not None:
+            self._on_finish(game)
+
+class SharedStateView(object):
+    '''
+    A read-only view of a State, as published to WorkerPool processes. It
+    is laid out in columns: the entity with slot index i has id ids[i],
+    type SharedStateView.TYPES[types[i]], and so on. Missing values, like
+    the cooldown_end of an entity without a cooldown or the held_by of an
+    entity that isn't held, are -1. held_by and holding are slot indices.
+    Attributes:
+        turn (int): the turn number
+        my_team_id (int): the id of my team
+        width (int): the width of the map
+        height (int): the height of the map
+        count (int): the number of entities
+        ids, types, teams, xs, ys, hps, cooldown_ends, holding_ends,
+        held_by, holding (memoryview): the entity columns, indexed by slot
+    '''
+
+    COLUMNS = ('ids', 'types', 'teams', 'xs', 'ys', 'hps', 'cooldown_ends',
+               'holding_ends', 'held_by', 'holding')
+    TYPES = (Entity.THROWER, Entity.STATUE, Entity.HEDGE)
+
+    # header: turn, my team id, width, height, count, capacity
+    _HEADER = 6
+
+    def __init__(self, buffer):
+        self._views = [memoryview(buffer).cast('i')]
+        ints = self._views[0]
+        self.width = ints[2]
+        self.height = ints[3]
+        capacity = ints[5]
+
+        offset = SharedStateView._HEADER
+        for column in SharedStateView.COLUMNS:
+            self._slice(column, offset, capacity)
+            offset += capacity
+        area = self.width * self.height
+        self._slice('_dirt', offset, area)
+        self._slice('_occupant', offset + area, area)
+
+    @staticmethod
+    def _size(capacity, width, height):
+        '''Bytes needed to hold capacity entities on a width by height map'''
+        ints = SharedStateView._HEADER + \
+            len(SharedStateView.COLUMNS) * capacity + 2 * width * height
+        return 4 * ints
+
+    def _slice(self, name, offset, length):
+        view = self._views[0][offset:offset + length]
+        self._views.append(view)
+        setattr(self, name, view)
+
+    def _release(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+
+    @property
+    def turn(self):
+        return self._views[0][0]
+
+    @property
+    def my_team_id(self):
+        return self._views[0][1]
+
+    @property
+    def count(self):
+        return self._views[0][4]
+
+    def on_map(self, x, y):
+        '''
+        Returns:
+            bool: True if x, y is on the map
+        '''
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def occupant(self, x, y):
+        '''
+        Returns:
+            int: the slot of the entity standing on x, y, or -1 if the tile
+                 is empty or off the map
+        '''
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return -1
+        return self._occupant[y * self.width + x]
+
+    def is_dirt(self, x, y):
+        '''
+        Returns:
+            bool: True if the tile at x, y is dirt
+        '''
+        return self._dirt[y * self.width + x] == 1
+
+    def can_act(self, slot):
+        '''
+        Returns:
+            bool: True if the entity in slot is a thrower that can act this
+                  turn, like Entity.can_act
+        '''
+        return self.types[slot] == 0 and self.held_by[slot] == -1 and \
+            self.cooldown_ends[slot] <= self.turn
+
+def _attach_shared_memory(name):
+    '''Open a shared memory segment that another process created and owns.'''
+    # don't let this process's resource tracker clean it up (python 3.13
+    # has track=False for this)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+# the policy and shared state views of a WorkerPool worker process
+_worker_policy = None
+_worker_views = {}
+
+def _worker_init(policy):
+    global _worker_policy
+    _worker_policy = policy
+
+def _worker_attach(name):
+    if name not in _worker_views:
+        for old in list(_worker_views):
+            view, segment = _worker_views.pop(old)
+            view._release()
+            segment.close()
+        segment = _attach_shared_memory(name)
+        _worker_views[name] = (SharedStateView(segment.buf), segment)
+    return _worker_views[name][0]
+
+def _worker_run(task):
+    name, slots = task
+    view = _worker_attach(name)
+    results = []
+    for slot in slots:
+        actions = _worker_policy(view, slot)
+        if actions:
+            results.append((slot, list(actions)))
+    return results
+
+class WorkerPool(object):
+    '''
+    Decide what every unit does in parallel, in worker processes.
+
+    Each call to run() publishes the state into shared memory, where the
+    workers read it through a SharedStateView, and asks policy(view, slot)
+    what the unit in each slot should do. The policy returns a list of
+    actions:
+        ('move', dx, dy)
+        ('build', dx, dy)
+        ('throw', dx, dy)
+        ('pickup', slot of the entity to pick up)
+        ('disintegrate',)
+    The actions are then checked with the can_* methods and queued in this
+    process, one unit at a time, so actions that conflict with ones queued
+    before them are rejected.
+
+    The policy has to be a top-level function so the workers can find it.
+    This needs python 3.8 or later. Use it as a context manager, or call
+    close() when you're done:
+
+        with battlecode.WorkerPool(my_policy) as pool:
+            for state in game.turns():
+                pool.run(state)
+    '''
+
+    def __init__(self, policy, processes=None, chunk_size=64):
+        '''
+        Args:
+            policy (function): policy(view, slot) -> [action]
+            processes (int): the number of worker processes; defaults to
+                             the number of cores
+            chunk_size (int): units sent to a worker at a time
+        '''
+        if shared_memory is None:
+            raise BattlecodeError('WorkerPool needs python 3.8 or later')
+        self.chunk_size = chunk_size
+        self._pool = multiprocessing.Pool(processes, initializer=_worker_init,
+                                          initargs=(policy,))
+        self._segment = None
+        self._view = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Stop the workers and free the shared memory.'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._free()
+
+    def _free(self):
+        if self._segment is not None:
+            self._view._release()
+            self._segment.close()
+            self._segment.unlink()
+            self._segment = None
+            self._view = None
+
+    def _publish(self, state):
+        '''
+        Write state into shared memory, growing it if needed.
+        Returns:
+            [Entity]: the entities, indexed by slot
+        '''
+        map = state.map
+        entities = list(state.entities.values())
+        count = len(entities)
+
+        view = self._view
+        if view is None or view.width != map.width or \
+                view.height != map.height or len(view.ids) < count:
+            self._free()
+            capacity = max(64, 2 * count)
+            self._segment = shared_memory.SharedMemory(
+                create=True, size=SharedStateView._size(capacity, map.width, map.height))
+            header = memoryview(self._segment.buf).cast('i')
+            header[2] = map.width
+            header[3] = map.height
+            header[5] = capacity
+            header.release()
+            view = self._view = SharedStateView(self._segment.buf)
+
+            dirt = [0] * (map.width * map.height)
+            for y, row in enumerate(reversed(map.tiles)):
+                for x, tile in enumerate(row):
+                    if tile == DIRT:
+                        dirt[y * map.width + x] = 1
+            view._dirt[:] = array.array('i', dirt)
+
+        header = view._views[0]
+        header[0] = state.turn
+        header[1] = state.my_team.id
+        header[4] = count
+
+        slots = {}
+        for slot, entity in enumerate(entities):
+            slots[entity.id] = slot
+
+        types = {Entity.THROWER: 0, Entity.STATUE: 1, Entity.HEDGE: 2}
+        columns = [[] for _ in SharedStateView.COLUMNS]
+        (ids, type_column, teams, xs, ys, hps, cooldown_ends, holding_ends,
+         held_by, holding) = columns
+        occupant = [-1] * (map.width * map.height)
+        for slot, entity in enumerate(entities):
+            location = entity.location
+            ids.append(entity.id)
+            type_column.append(types[entity.type])
+            teams.append(entity.team.id)
+            xs.append(location[0])
+            ys.append(location[1])
+            hps.append(entity.hp)
+            cooldown_ends.append(-1 if entity.cooldown_end is None else entity.cooldown_end)
+            holding_ends.append(-1 if entity.holding_end is None else entity.holding_end)
+            if entity.held_by is None:
+                held_by.append(-1)
+                occupant[location[1] * map.width + location[0]] = slot
+            else:
+                held_by.append(slots.get(entity.held_by.id, -1))
+            holding.append(-1 if entity.holding is None else slots.get(entity.holding.id, -1))
+
+        for name, values in zip(SharedStateView.COLUMNS, columns):
+            getattr(view, name)[:count] = array.array('i', values)
+        view._occupant[:] = array.array('i', occupant)
+
+        return entities
+
+    def run(self, state, units=None):
+        '''
+        Ask the workers what each unit should do, and queue the actions that
+        are still valid.
+        Args:
+            state (State): the state to play on
+            units ([Entity]): the units to decide for. Defaults to all of my
+                              units that can act.
+        Returns:
+            [(Entity, tuple, string)]: every rejected action, with the unit
+                                       and the reason it was rejected
+        '''
+        entities = self._publish(state)
+        if units is None:
+            units = [entity for entity in entities
+                     if entity.team == state.my_team and entity.can_act]
+
+        slot_of = {}
+        for slot, entity in enumerate(entities):
+            slot_of[entity.id] = slot
+        slots = [slot_of[unit.id] for unit in units]
+
+        tasks = []
+        for start in range(0, len(slots), self.chunk_size):
+            tasks.append((self._segment.name, slots[start:start + self.chunk_size]))
+
+        rejected = []
+        for results in self._pool.map(_worker_run, tasks):
+            for slot, actions in results:
+                entity = entities[slot]
+                for action in actions:
+                    reason = self._apply(state, entity, entities, action)
+                    if reason is not None:
+                        rejected.append((entity, action, reason))
+        return rejected
+
+    @staticmethod
+    def _apply(state, entity, entities, action):
+        '''Queue action for entity; returns why it can't be, or None'''
+        if entity.team != state.my_team:
+            return 'not my unit'
+        if entity._disintegrated:
+            return 'disintegrated'
+
+        kind = action[0]
+        if kind in ('move', 'build', 'throw'):
+            direction = Direction(action[1], action[2])
+            if not getattr(entity, 'can_' + kind)(direction):
+                return 'cannot ' + kind
+            getattr(entity, 'queue_' + kind)(direction)
+        elif kind == 'pickup':
+            if not 0 <= action[1] < len(entities):
+                return 'no such entity'
+            target = entities[action[1]]
+            if target is entity or not entity.can_pickup(target):
+                return 'cannot pickup'
+            entity.queue_pickup(target)
+        elif kind == 'disintegrate':
+            entity.queue_disintegrate()
+        else:
+            return 'unknown action'
+        return None
+
+# entity type codes used by BatchSimulator
+_SIM_TYPES = (Entity.THROWER, Entity.STATUE, Entity.HEDGE)
+_SIM_THROWER, _SIM_STATUE, _SIM_HEDGE = range(3)
+
+class _SimGame(object):
+    '''
+    One game of a BatchSimulator. Entity columns are indexed by entity id;
+    -1 stands for None.
+    '''
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.dirt = bytearray(width * height)
+        self.occupant = array.array('i', [-1]) * (width * height)
+        self.alive = bytearray()
+        self.types = bytearray()
+        self.teams = bytearray()
+        self.hp = array.array('i')
+        self.xs = array.array('i')
+        self.ys = array.array('i')
+        self.cooldown_end = array.array('i')
+        self.holding_end = array.array('i')
+        self.held_by = array.array('i')
+        self.holding = array.array('i')
+        self.sectors = []
+        # living throwers per team id
+        self.throwers = [0, 0, 0]
+        self.max_id = -1
+
+    def copy(self):
+        result = _SimGame.__new__(_SimGame)
+        for name, value in self.__dict__.items():
+            setattr(result, name, value[:] if hasattr(value, '__getitem__') else value)
+        return result
+
+    def grow(self, size):
+        '''Make room for entity ids below size.'''
+        extra = size - len(self.alive)
+        if extra <= 0:
+            return
+        self.alive.extend(bytearray(extra))
+        self.types.extend(bytearray(extra))
+        self.teams.extend(bytearray(extra))
+        for column in (self.hp, self.xs, self.ys):
+            column.extend(array.array('i', [0]) * extra)
+        for column in (self.cooldown_end, self.holding_end, self.held_by, self.holding):
+            column.extend(array.array('i', [-1]) * extra)
+
+    def add(self, id, type, team, hp, x, y):
+        self.grow(id + 1)
+        self.alive[id] = 1
+        self.types[id] = type
+        self.teams[id] = team
+        self.hp[id] = hp
+        self.xs[id] = x
+        self.ys[id] = y
+        self.cooldown_end[id] = -1
+        self.holding_end[id] = -1
+        self.held_by[id] = -1
+        self.holding[id] = -1
+        if type == _SIM_THROWER:
+            self.throwers[team] += 1
+        if id > self.max_id:
+            self.max_id = id
+
+    def damage(self, id, amount):
+        '''Entity._deal_damage'''
+        if not self.alive[id]:
+            return
+        self.hp[id] -= amount
+        if self.hp[id] > 0:
+            return
+        index = self.ys[id] * self.width + self.xs[id]
+        if self.held_by[id] == -1:
+            self.occupant[index] = -1
+        held = self.holding[id]
+        if held != -1 and self.alive[held]:
+            self.held_by[held] = -1
+            self.occupant[index] = held
+        self.alive[id] = 0
+        if self.types[id] == _SIM_THROWER:
+            self.throwers[self.teams[id]] -= 1
+
+    def can_act(self, id, turn):
+        '''Entity.can_act'''
+        return self.types[id] == _SIM_THROWER and self.cooldown_end[id] <= turn and \
+            self.held_by[id] == -1 and self.alive[id] == 1
+
+    def free(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height and \
+            self.occupant[y * self.width + x] == -1
+
+class BatchSimulator(object):
+    '''
+    Steps many independent games at once, for training bots. Entities are
+    kept as columns of flat arrays per game instead of Entity objects, and
+    actions follow the same rules as speculation with the queue_* methods:
+    moves, builds, throws (with their damage), pickups and disintegrations.
+    Nothing else the server does, like spawning or sector control, is
+    simulated.
+
+    Teams 1 and 2 take turns, starting with 1. A game is over when a team
+    has no throwers left or after max_turns turns, and is then reset to its
+    initial state.
+
+    Args:
+        initial_states ([dict]): the initialState of each game, as in the
+            server's start message. Entities may also have holding and heldBy.
+        max_turns (int): turns before a game is a draw
+    Attributes:
+        turns ([int]): each game's turn
+        teams ([int]): the id of the team to move next in each game
+        winners ([int]): the winner of each game's last finished match, or
+            None for a draw or if none has finished
+        rejected ([[dict]]): the actions of the last step that had no effect
+    '''
+
+    def __init__(self, initial_states, max_turns=1000):
+        self.max_turns = max_turns
+        self._initial = [BatchSimulator._load(s) for s in initial_states]
+        self._games = [game.copy() for game in self._initial]
+        count = len(self._games)
+        self.turns = [0] * count
+        self.teams = [1] * count
+        self.winners = [None] * count
+        self.rejected = [[] for _ in range(count)]
+
+    def __len__(self):
+        return len(self._games)
+
+    @staticmethod
+    def _load(initial_state):
+        width = initial_state['width']
+        height = initial_state['height']
+        game = _SimGame(width, height)
+        for row, line in enumerate(initial_state['tiles']):
+            base = (height - row - 1) * width
+            for x, tile in enumerate(line):
+                if tile == DIRT:
+                    game.dirt[base + x] = 1
+
+        entities = initial_state['entities']
+        for data in entities:
+            location = data['location']
+            game.add(data['id'], _SIM_TYPES.index(data['type']), data['teamID'],
+                     data['hp'], location['x'], location['y'])
+            if data.get('cooldownEnd') is not None:
+                game.cooldown_end[data['id']] = data['cooldownEnd']
+            if data.get('holdingEnd') is not None:
+                game.holding_end[data['id']] = data['holdingEnd']
+        for data in entities:
+            if data.get('holding') is not None:
+                game.holding[data['id']] = data['holding']
+            if data.get('heldBy') is not None:
+                game.held_by[data['id']] = data['heldBy']
             else:
-                self.state.speculate = speculate
-                if copy:
-                    self.state._game = None
-                    speculative = _deepcopy(self.state)
-                    speculative._game = self
-                    self.state._game = self
-                    yield speculative
+                location = data['location']
+                game.occupant[location['y'] * width + location['x']] = data['id']
+
+        game.sectors = [(s['topLeft']['x'], s['topLeft']['y'], s['controllingTeamID'])
+                        for s in initial_state['sectors']]
+        return game
+
+    def reset(self, game):
+        '''Put a game back to its initial state.'''
+        self._games[game] = self._initial[game].copy()
+        self.turns[game] = 0
+        self.teams[game] = 1
+
+    def step(self, actions):
+        '''
+        Play one turn in every game.
+        Args:
+            actions ([[dict]]): for each game, the actions of the team to
+                move, in the format of State's action queue. None is no
+                actions.
+        Returns:
+            [bool]: whether each game finished on this step. Finished games
+                    have already been reset.
+        '''
+        finished = []
+        for index, game in enumerate(self._games):
+            team = self.teams[index]
+            turn = self.turns[index]
+            rejected = self.rejected[index] = []
+            for action in actions[index] or ():
+                if not BatchSimulator._apply(game, team, turn, action):
+                    rejected.append(action)
+
+            turn += 1
+            self.turns[index] = turn
+            self.teams[index] = 3 - team
+
+            throwers = game.throwers
+            done = turn >= self.max_turns or not throwers[1] or not throwers[2]
+            if done:
+                if throwers[1] and not throwers[2]:
+                    self.winners[index] = 1
+                elif throwers[2] and not throwers[1]:
+                    self.winners[index] = 2
                 else:
-                    yield self.state
+                    self.winners[index] = None
+                self.reset(index)
+            finished.append(done)
+        return finished
+
+    @staticmethod
+    def _apply(game, team, turn, action):
+        '''Apply an action like the queue_* methods; False if it did nothing.'''
+        id = action.get('id', -1)
+        if not 0 <= id < len(game.alive) or not game.alive[id] or game.teams[id] != team:
+            return False
+        kind = action.get('action')
+
+        if kind == 'disintegrate':
+            game.damage(id, game.hp[id] + 1)
+            return True
+
+        if not game.can_act(id, turn):
+            return False
+        x = game.xs[id]
+        y = game.ys[id]
+        width = game.width
+        occupant = game.occupant
+
+        if kind == 'pickup':
+            other = action.get('pickupID', -1)
+            if game.holding[id] != -1 or other == id or \
+                    not 0 <= other < len(game.alive) or not game.alive[other] or \
+                    game.types[other] != _SIM_THROWER or game.holding[other] != -1 or \
+                    game.held_by[other] != -1 or \
+                    (game.xs[other] - x) ** 2 + (game.ys[other] - y) ** 2 > 2:
+                return False
+            occupant[game.ys[other] * width + game.xs[other]] = -1
+            game.holding[id] = other
+            game.held_by[other] = id
+            game.xs[other] = x
+            game.ys[other] = y
+            game.holding_end[id] = turn + _HOLD_DELAY
+            game.cooldown_end[id] = turn + _HOLD_DELAY
+            return True
+
+        dx = action.get('dx')
+        dy = action.get('dy')
+        if dx not in (-1, 0, 1) or dy not in (-1, 0, 1) or dx == dy == 0 or \
+                not game.free(x + dx, y + dy):
+            return False
+
+        if kind == 'move':
+            occupant[y * width + x] = -1
+            x += dx
+            y += dy
+            game.xs[id] = x
+            game.ys[id] = y
+            held = game.holding[id]
+            if held != -1:
+                game.xs[held] = x
+                game.ys[held] = y
+            occupant[y * width + x] = id
+            game.cooldown_end[id] = turn + MOVEMENT_DELAY
+            return True
+
+        if kind == 'build':
+            game.cooldown_end[id] = turn + BUILD_DELAY
+            new = game.max_id + 1
+            game.add(new, _SIM_STATUE, team, 1, x + dx, y + dy)
+            occupant[(y + dy) * width + x + dx] = new
+            return True
+
+        if kind == 'throw':
+            held = game.holding[id]
+            if held == -1:
+                return False
+            game.holding[id] = -1
+            game.holding_end[id] = -1
+            tx = x + dx
+            ty = y + dy
+            for _ in range(THROW_RANGE + 1):
+                if not game.free(tx, ty):
+                    break
+                tx += dx
+                ty += dy
+            if 0 <= tx < width and 0 <= ty < game.height:
+                target = occupant[ty * width + tx]
+                if target != -1:
+                    if game.types[target] == _SIM_HEDGE:
+                        game.damage(target, THROW_HEDGE_DAMAGE)
+                    else:
+                        game.damage(target, THROW_ENTITY_DAMAGE)
+                    game.damage(held, THROW_ENTITY_RECOIL)
+            tx -= dx
+            ty -= dy
+            game.xs[held] = tx
+            game.ys[held] = ty
+            if game.dirt[ty * width + tx]:
+                game.damage(held, THROW_ENTITY_DIRT)
+            if game.alive[held]:
+                occupant[ty * width + tx] = held
+            game.held_by[held] = -1
+            game.cooldown_end[id] = turn + THROW_DELAY
+            return True
+
+        return False
+
+    def entities(self, game):
+        '''
+        Args:
+            game (int): which game
+        Returns:
+            [dict]: its living entities in the server's format, by id
+        '''
+        game = self._games[game]
+        result = []
+        for id in range(len(game.alive)):
+            if not game.alive[id]:
+                continue
+            data = {
+                'id': id,
+                'type': _SIM_TYPES[game.types[id]],
+                'teamID': game.teams[id],
+                'hp': game.hp[id],
+                'location': {'x': game.xs[id], 'y': game.ys[id]},
+            }
+            for key, column in (('cooldownEnd', game.cooldown_end),
+                                ('holdingEnd', game.holding_end),
+                                ('heldBy', game.held_by),
+                                ('holding', game.holding)):
+                if column[id] != -1:
+                    data[key] = column[id]
+            result.append(data)
+        return result
 
 class BattlecodeError(Exception):
     def __init__(self, *args, **kwargs):
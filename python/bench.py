@@ -0,0 +1,975 @@
+from __future__ import print_function
+
+'''
+Microbenchmarks for the hot paths of the battlecode client.
+
+Run `python bench.py` to time everything and print the results as JSON.
+Use --save to keep the results as a baseline, and --baseline to compare a
+later run against it; the exit status is 1 if anything got slower than the
+tolerance allows.
+
+--transport times message round trips to another process instead, over a
+unix socket and over shared memory.
+
+--verify plays random games through the fast paths and checks them against
+a straightforward version of the same thing, like BatchSimulator against a
+State, and exits with 1 on any difference. It also plays LocalServer
+matches on a GameHub, cutting one bot's connection partway through. It
+skips the large scenario unless it's asked for with --scenario.
+'''
+
+import argparse
+import atexit
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import battlecode
+from battlecode import Direction, Entity, Location, State, Team
+
+# name: (width, height, sector_size, entities)
+SCENARIOS = [
+    ('small', 20, 20, 5, 40),
+    ('medium', 50, 50, 10, 400),
+    ('large', 100, 100, 10, 1500),
+]
+
+
+class BenchGame(object):
+    '''Stands in for a Game; collects queued actions instead of sending them.'''
+
+    def __init__(self):
+        self.actions = []
+        self._missed_turns = set()
+
+    def _queue(self, action):
+        self.actions.append(action)
+
+    def _queue_all(self, actions):
+        self.actions.extend(actions)
+
+
+def make_teams():
+    return {
+        0: Team(0, 'neutral'),
+        1: Team(1, 'red'),
+        2: Team(2, 'blue'),
+    }
+
+
+def make_initial_state(width, height, sector_size, entities, seed=0):
+    '''
+    Build a random initialState dict like the one in the server's start
+    message. Roughly half of the entities are throwers.
+    '''
+    rnd = random.Random(seed)
+    tiles = [''.join(rnd.choice('GGGD') for _ in range(width))
+             for _ in range(height)]
+
+    free = [(x, y) for x in range(width) for y in range(height)]
+    rnd.shuffle(free)
+
+    result = []
+    for id in range(min(entities, len(free))):
+        x, y = free.pop()
+        kind = rnd.random()
+        if kind < .5:
+            type, team = Entity.THROWER, rnd.choice([1, 2])
+        elif kind < .7:
+            type, team = Entity.STATUE, rnd.choice([1, 2])
+        else:
+            type, team = Entity.HEDGE, 0
+        data = {
+            'id': id,
+            'type': type,
+            'teamID': team,
+            'hp': 10 if type != Entity.HEDGE else 5,
+            'location': {'x': x, 'y': y},
+        }
+        if type == Entity.THROWER and rnd.random() < .3:
+            data['cooldownEnd'] = rnd.randint(1, 10)
+        result.append(data)
+
+    sectors = []
+    for x in range(0, width, sector_size):
+        for y in range(0, height, sector_size):
+            sectors.append({
+                'topLeft': {'x': x, 'y': y},
+                'controllingTeamID': rnd.choice([0, 1, 2]),
+            })
+
+    return {
+        'width': width,
+        'height': height,
+        'tiles': tiles,
+        'sectorSize': sector_size,
+        'entities': result,
+        'sectors': sectors,
+    }
+
+
+def make_pickups(initial_state, seed=0, fraction=.2):
+    '''
+    Build the 'changed' list of a nextTurn message where some throwers picked
+    up an adjacent thrower. The start message can't hold these, since holder
+    and held refer to each other.
+    '''
+    rnd = random.Random(seed)
+    throwers = {}
+    for data in initial_state['entities']:
+        if data['type'] == Entity.THROWER:
+            throwers[data['location']['x'], data['location']['y']] = data
+
+    changed = []
+    busy = set()
+    for (x, y), holder in sorted(throwers.items()):
+        if holder['id'] in busy or rnd.random() > fraction:
+            continue
+        for dx, dy in ((1, 0), (0, 1), (-1, 0), (0, -1)):
+            other = throwers.get((x + dx, y + dy))
+            if other is None or other['id'] in busy:
+                continue
+            holder = dict(holder, holding=other['id'], holdingEnd=10)
+            other = dict(other, heldBy=holder['id'], location=dict(holder['location']))
+            changed.extend([holder, other])
+            busy.update([holder['id'], other['id']])
+            break
+    return changed
+
+
+def make_state(initial_state, my_team_id=1, pickups=True):
+    '''Build a State from an initialState dict, with some units held.'''
+    state = State(BenchGame(), make_teams(), my_team_id, initial_state)
+    if pickups:
+        state._update_entities(make_pickups(initial_state))
+    return state
+
+
+def make_delta(state, seed=0, fraction=.3):
+    '''
+    Build the 'changed' list of a plausible nextTurn message: every free
+    thrower is sent again with a new cooldown, a fraction of them step onto
+    an adjacent empty tile and some take damage.
+    '''
+    rnd = random.Random(seed)
+    occupied = set(state.map._occupied)
+    changed = []
+    for entity in state.get_entities(entity_type=Entity.THROWER):
+        if entity.is_held or entity.is_holding:
+            continue
+        location = entity.location
+        if rnd.random() < fraction:
+            direction = rnd.choice(Direction.directions())
+            moved = location.adjacent_location_in_direction(direction)
+            if state.map.location_on_map(moved) and moved not in occupied:
+                occupied.discard(location)
+                occupied.add(moved)
+                location = moved
+        changed.append({
+            'id': entity.id,
+            'type': entity.type,
+            'teamID': entity.team.id,
+            'hp': entity.hp - rnd.choice([0, 0, 1]),
+            'location': {'x': location.x, 'y': location.y},
+            'cooldownEnd': state.turn + 1,
+        })
+    return changed
+
+
+def timed(body, setup=None, repeat=5):
+    '''
+    Run body(setup()) repeat times and return the fastest run in seconds.
+    setup isn't timed.
+    '''
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup is not None else None
+        start = battlecode._clock()
+        body(args)
+        elapsed = battlecode._clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmarks(state, initial_state):
+    '''
+    Yields (name, body, setup, ops) for every benchmark on this state. ops is
+    how many operations one run of body performs.
+    '''
+    team = state.my_team
+    mine = [e for e in state.get_entities(team=team)]
+    throwers = [e for e in mine if e.is_thrower and not e.is_held]
+    holders = [e for e in throwers if e.is_holding]
+    all_entities = list(state.get_entities())
+    sectors = list(state.map._sectors.values())
+    directions = Direction.directions()
+
+    def drain(iterator):
+        for _ in iterator:
+            pass
+
+    yield ('get_entities[all]', lambda _: drain(state.get_entities()), None, 1)
+    yield ('get_entities[team]', lambda _: drain(state.get_entities(team=team)), None, 1)
+    yield ('get_entities[entity_type]',
+           lambda _: drain(state.get_entities(entity_type=Entity.STATUE)), None, 1)
+    yield ('get_entities[entity_id]',
+           lambda _: drain(state.get_entities(entity_id=state._max_id)), None, 1)
+    yield ('get_entities[location]',
+           lambda _: drain(state.get_entities(location=all_entities[0].location)), None, 1)
+
+    def within(kind):
+        def body(_):
+            for entity in throwers:
+                drain(getattr(entity, kind)(2))
+        return body
+    yield ('entities_within_adjacent_distance',
+           within('entities_within_adjacent_distance'), None, len(throwers))
+    yield ('entities_within_euclidean_distance',
+           within('entities_within_euclidean_distance'), None, len(throwers))
+
+    def can_direction(kind):
+        def body(_):
+            for entity in throwers:
+                check = getattr(entity, kind)
+                for direction in directions:
+                    check(direction)
+        return body
+    yield ('can_move', can_direction('can_move'), None, 8 * len(throwers))
+    yield ('can_throw', can_direction('can_throw'), None, 8 * len(throwers))
+
+    yield ('action_masks', lambda _: state.action_masks(team), None, len(mine))
+
+    map = state.map
+    yield ('Map.free_neighbours', lambda _: map.free_neighbours(), None, 1)
+    yield ('Map.sector_counts', lambda _: map.sector_counts(team, Entity.THROWER), None,
+           len(sectors))
+
+    yield ('can_act[filter]', lambda _: [e for e in state.get_entities(team=team) if e.can_act],
+           None, 1)
+    yield ('ready_units', lambda _: state.ready_units(team), None, 1)
+
+    def can_pickup(_):
+        for entity in throwers:
+            for other in throwers:
+                if other is not entity:
+                    entity.can_pickup(other)
+    yield ('can_pickup', can_pickup, None, max(1, len(throwers) * (len(throwers) - 1)))
+
+    def speculative():
+        copy = battlecode._deepcopy(state)
+        copy.speculate = True
+        return copy
+
+    def queue_all(kind):
+        def body(copy):
+            for entity in copy.get_entities(team=copy.my_team):
+                for direction in directions:
+                    if kind == 'throw':
+                        if entity.can_throw(direction):
+                            entity.queue_throw(direction)
+                            break
+                    elif entity.can_move(direction):
+                        getattr(entity, 'queue_' + kind)(direction)
+                        break
+        return body
+    yield ('queue_move', queue_all('move'), speculative, len(throwers))
+    yield ('queue_build', queue_all('build'), speculative, len(throwers))
+    yield ('queue_throw', queue_all('throw'), speculative, max(1, len(holders)))
+
+    def planned_moves():
+        copy = speculative()
+        moves = []
+        for entity in copy.get_entities(team=copy.my_team):
+            for direction in directions:
+                if entity.can_move(direction):
+                    moves.append((entity, 'move', direction))
+                    break
+        return copy, moves
+
+    def queue_planned(args):
+        copy, moves = args
+        for entity, _, direction in moves:
+            entity.queue_move(direction)
+    yield ('queue_move[planned]', queue_planned, planned_moves, len(throwers))
+    yield ('queue_actions', lambda args: args[0].queue_actions(args[1]), planned_moves,
+           len(throwers))
+
+    def queue_pickup(copy):
+        for entity in copy.get_entities(team=copy.my_team):
+            if not entity.can_act or entity.is_holding:
+                continue
+            for other in entity.entities_within_adjacent_distance(1):
+                if entity.can_pickup(other):
+                    entity.queue_pickup(other)
+                    break
+    yield ('queue_pickup', queue_pickup, speculative, len(throwers))
+
+    def queue_disintegrate(copy):
+        for entity in list(copy.get_entities(team=copy.my_team)):
+            entity.queue_disintegrate()
+    yield ('queue_disintegrate', queue_disintegrate, speculative, len(mine))
+
+    def memoizing():
+        copy = speculative()
+        copy.memoize = True
+        drain(copy.get_entities(team=copy.my_team))
+        return copy
+    yield ('get_entities[team, memoized]',
+           lambda copy: drain(copy.get_entities(team=copy.my_team)), memoizing, 1)
+
+    tensor = state.to_tensor()
+    yield ('to_tensor', lambda _: state.to_tensor(tensor), None, 1)
+    yield ('to_tensor[incremental]',
+           lambda _: state.to_tensor(tensor, incremental=True), None, 1)
+
+    def moved_sources():
+        copy = speculative()
+        field = copy.distance_field(team=copy.other_team)
+        field.distances
+        copy._update_entities(make_delta(copy, fraction=.1))
+        return field
+    yield ('DistanceField[refresh]', lambda field: field.distances, moved_sources, 1)
+
+    # from one corner to the far one, where relaying pays
+    travellers = [e for e in throwers if not e.is_holding]
+    corners = [Location(x, y) for x in (0, state.map.width - 1)
+               for y in (0, state.map.height - 1)
+               if Location(x, y) not in state.map._occupied]
+    if travellers and corners:
+        traveller = travellers[0]
+        target = max(corners, key=traveller.location.distance_to_squared)
+        yield ('plan_relay', lambda _: state.plan_relay(traveller, target), None, 1)
+
+    def in_sector(_):
+        for sector in sectors:
+            drain(sector.entities_in_sector())
+    yield ('Sector.entities_in_sector', in_sector, None, len(sectors))
+
+    def threat_map(copy):
+        copy.turn = 10
+        copy.threat_map(copy.my_team)
+    yield ('threat_map', threat_map, speculative, 1)
+
+    def forget_analyses():
+        battlecode._map_analyses.clear()
+    yield ('Map.analysis[build]', lambda _: state.map.analysis(cache_dir=False),
+           forget_analyses, 1)
+    cache_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, cache_dir, True)
+    state.map.analysis(cache_dir)
+    yield ('Map.analysis[load]', lambda _: state.map.analysis(cache_dir),
+           forget_analyses, 1)
+
+    delta = make_delta(state)
+    yield ('_update_entities', lambda copy: copy._update_entities(delta),
+           speculative, max(1, len(delta)))
+
+    moves = speculative()
+    moves._game = BenchGame()
+    queue_all('move')(moves)
+    # the simulator can start with units held, unlike a start message
+    entities = dict((data['id'], data) for data in initial_state['entities'])
+    entities.update((data['id'], data) for data in make_pickups(initial_state))
+    simulated = dict(initial_state, entities=list(entities.values()))
+    yield ('BatchSimulator.step',
+           lambda simulator: simulator.step([moves._game.actions]),
+           lambda: battlecode.BatchSimulator([simulated]),
+           max(1, len(moves._game.actions)))
+
+    message = {'changed': delta, 'dead': [], 'changedSectors': []}
+    yield ('History._record', lambda history: history._record(1, message),
+           lambda: battlecode.History(state.teams, state.my_team_id, initial_state),
+           max(1, len(delta)))
+
+    # keyframes must match the state, so validate one without held units
+    unheld = make_state(initial_state, pickups=False)
+    keyframe = {'command': 'keyframe', 'state': initial_state}
+    yield ('_validate_keyframe', lambda _: unheld._validate_keyframe(keyframe), None, 1)
+
+    # resyncing after a reconnect: a state a turn ahead of the keyframe
+    unheld._update_entities(make_delta(unheld))
+    yield ('_keyframe_delta', lambda _: unheld._keyframe_delta(initial_state), None,
+           len(initial_state['entities']))
+
+    start = json.dumps({'command': 'start', 'teams': [], 'initialState': initial_state})
+    start = start.encode() + b'\n'
+    yield ('decode[start]', lambda _: json.loads(start.decode()), None, 1)
+
+    def stream(_):
+        decoder = battlecode._StreamingDecoder()
+        chunk = battlecode.Game._CHUNK
+        for offset in range(0, len(start), chunk):
+            decoder.feed(start[offset:offset + chunk], offset + chunk >= len(start))
+    yield ('decode[start, streamed]', stream, None, 1)
+
+    def deepcopy(_):
+        # Game.turns() detaches the game before copying, too
+        game = state._game
+        state._game = None
+        battlecode._deepcopy(state)
+        state._game = game
+    yield ('_deepcopy', deepcopy, None, 1)
+
+
+# message sizes for --transport, in bytes: about a turn of a small game, and
+# about a start message of a large one
+MESSAGE_SIZES = [256, 2**18]
+
+
+def echo(path):
+    '''Send every message received on the unix socket at path back, like a
+    server would answer, for --transport.'''
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    conn, _ = listener.accept()
+    stream = conn.makefile('rwb', 2**16)
+    first = stream.readline()
+    if json.loads(first.decode()).get('command') == 'sharedMemory':
+        stream = battlecode._SharedMemoryStream.accept(conn)
+    else:
+        stream.write(first)
+        stream.flush()
+    for message in stream:
+        stream.write(message)
+        stream.flush()
+    stream.close()
+
+
+def transport(repeat, round_trips=200):
+    '''
+    Time round trips of each of MESSAGE_SIZES to an echo process, the way
+    Game talks to the server.
+    '''
+    results = {}
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    for name, prefix in (('unix', ''), ('shm', 'shm:')):
+        path = os.path.join(directory, name)
+        peer = multiprocessing.Process(target=echo, args=(path,))
+        peer.daemon = True
+        peer.start()
+        while not os.path.exists(path):
+            time.sleep(.01)
+        _, stream = battlecode.Game._open(prefix + path)
+        stream.write(b'{"command": "hello"}\n')
+        stream.flush()
+        next(stream)
+
+        for size in MESSAGE_SIZES:
+            message = b'{"command": "ping", "padding": "' + b'x' * (size - 36) + b'"}\n'
+
+            def body(_):
+                for _ in range(round_trips):
+                    stream.write(message)
+                    stream.flush()
+                    next(stream)
+            seconds = timed(body, repeat=repeat)
+            results['transport/{}[{}B]'.format(name, size)] = {
+                'seconds': seconds,
+                'ops': round_trips,
+                'us_per_op': seconds / round_trips * 1e6,
+            }
+        stream.close()
+        peer.join(5)
+    return results
+
+
+def entity_data(entity):
+    '''An Entity as the server would send it.'''
+    data = {
+        'id': entity.id,
+        'type': entity.type,
+        'teamID': entity.team.id,
+        'hp': entity.hp,
+        'location': {'x': entity.location.x, 'y': entity.location.y},
+    }
+    for key, value in (('cooldownEnd', entity.cooldown_end),
+                       ('holdingEnd', entity.holding_end),
+                       ('heldBy', entity.held_by and entity.held_by.id),
+                       ('holding', entity.holding and entity.holding.id)):
+        if value is not None:
+            data[key] = value
+    return data
+
+
+def random_actions(state, team, rnd):
+    '''
+    Random actions for team's throwers, as (entity, action dict) pairs. Many
+    of them are invalid, to check that they are turned down too.
+    '''
+    entities = list(state.entities.values())
+    result = []
+    for entity in sorted(entities, key=lambda e: e.id):
+        if entity.team != team or not entity.is_thrower or rnd.random() < .2:
+            continue
+        direction = rnd.choice(Direction.directions())
+        kind = rnd.choice(['move', 'move', 'build', 'throw', 'pickup', 'pickup']
+                          + ['disintegrate'] * (rnd.random() < .05))
+        if kind == 'pickup':
+            x, y = entity.location
+            near = [state.map.occupant_at(x + d.dx, y + d.dy) for d in Direction.directions()]
+            near = [e for e in near if e is not None]
+            other = rnd.choice(near) if near and rnd.random() < .9 else rnd.choice(entities)
+            action = {'action': kind, 'id': entity.id, 'pickupID': other.id}
+        elif kind == 'disintegrate':
+            action = {'action': kind, 'id': entity.id}
+        else:
+            action = {'action': kind, 'id': entity.id, 'dx': direction.dx, 'dy': direction.dy}
+        result.append((entity, action))
+    return result
+
+
+def queue_checked(state, entity, action):
+    '''
+    Queue action on state with the queue_* methods, if the matching can_*
+    method allows it. Returns whether it was queued.
+    '''
+    kind = action['action']
+    if entity._disintegrated:
+        return False
+    if kind == 'disintegrate':
+        entity.queue_disintegrate()
+        return True
+    if kind == 'pickup':
+        target = state.entities.get(action['pickupID'])
+        if target is None or target is entity or not entity.can_pickup(target):
+            return False
+        entity.queue_pickup(target)
+        return True
+    direction = Direction(action['dx'], action['dy'])
+    if not getattr(entity, 'can_' + kind)(direction):
+        return False
+    getattr(entity, 'queue_' + kind)(direction)
+    return True
+
+
+def verify_batch(initial_state, rnd, steps):
+    '''
+    Play random actions in a BatchSimulator and in a State speculating the
+    same actions, and compare what they accept and the entities after every
+    turn. Returns the number of actions compared.
+    '''
+    initial_state = dict(initial_state)
+    initial_state['entities'] = list(dict(
+        (data['id'], data) for data in initial_state['entities'] +
+        make_pickups(initial_state, rnd.random())).values())
+    simulator = battlecode.BatchSimulator([initial_state], max_turns=steps // 2 + 1)
+    state = None
+    checked = 0
+    for _ in range(steps):
+        if state is None:
+            state = make_state(initial_state, pickups=False)
+        team = simulator.teams[0]
+        state.turn = simulator.turns[0]
+        state.my_team = state.teams[team]
+        state.my_team_id = team
+
+        actions = random_actions(state, state.my_team, rnd)
+        accepted = [queue_checked(state, entity, action) for entity, action in actions]
+        finished = simulator.step([[action for _, action in actions]])[0]
+        rejected = simulator.rejected[0]
+        for (_, action), ok in zip(actions, accepted):
+            assert ok == (action not in rejected), \
+                'turn {}: {} accepted by State: {}'.format(state.turn, action, ok)
+        checked += len(actions)
+
+        if finished:
+            # the simulator has reset it
+            state = None
+            continue
+        expected = sorted((entity_data(e) for e in state.entities.values()),
+                          key=lambda data: data['id'])
+        assert simulator.entities(0) == expected, 'turn {}: entities differ'.format(state.turn)
+    return checked
+
+
+def copy_state(state, speculate=True):
+    '''A copy of state with a BenchGame of its own, like Game.turns() makes.'''
+    game = state._game
+    state._game = None
+    result = battlecode._deepcopy(state)
+    state._game = game
+    result._game = BenchGame()
+    result.speculate = speculate
+    return result
+
+
+def all_entity_data(state):
+    return sorted((entity_data(e) for e in state.entities.values()),
+                  key=lambda data: data['id'])
+
+
+def verify_queue_actions(initial_state, rnd, steps):
+    '''
+    Queue random batches with State.queue_actions and one at a time with the
+    queue_* methods, and compare what they accept, what they queue and the
+    entities after. The batches are also checked without speculation, where
+    queue_actions has to keep track of what the batch did itself, leaving
+    out throws, whose damage it doesn't take into account then. Returns the
+    number of actions compared.
+    '''
+    state = make_state(initial_state)
+    checked = 0
+    for turn in range(1, steps + 1):
+        team = state.teams[2 - turn % 2]
+        state.turn = turn
+        state.my_team = team
+        state.my_team_id = team.id
+        actions = [(entity.id, action) for entity, action in
+                   random_actions(state, team, rnd)]
+
+        for speculate in (True, False):
+            if not speculate:
+                actions = [(id, action) for id, action in actions
+                           if action['action'] != 'throw']
+            reference = copy_state(state)
+            # fetched first, like a bot would, as earlier actions may kill them
+            entities = [reference.entities[id] for id, _ in actions]
+            accepted = [queue_checked(reference, entity, action)
+                        for entity, (_, action) in zip(entities, actions)]
+            if speculate:
+                following = reference
+
+            fast = copy_state(state, speculate)
+            entities = fast.entities
+            reasons = fast.queue_actions([
+                (entities[id], action['action'],
+                 entities.get(action['pickupID']) if action['action'] == 'pickup' else
+                 None if action['action'] == 'disintegrate' else
+                 Direction(action['dx'], action['dy']))
+                for id, action in actions])
+            for (_, action), ok, reason in zip(actions, accepted, reasons):
+                assert ok == (reason is None), 'turn {}: {} speculate={}: {} but {}'.format(
+                    turn, action, speculate, ok, reason)
+            assert fast._game.actions == reference._game.actions, \
+                'turn {} speculate={}: queued actions differ'.format(turn, speculate)
+            expected = all_entity_data(reference if speculate else state)
+            assert all_entity_data(fast) == expected, \
+                'turn {} speculate={}: entities differ'.format(turn, speculate)
+            checked += len(actions)
+        state = following
+    return checked
+
+
+def distances_from_scratch(state, team_id, entity_type, sector_team_id):
+    '''What a DistanceField should hold, by a breadth-first search from every source.'''
+    map = state.map
+    width = map.width
+    height = map.height
+    sources = set()
+    if sector_team_id is not None:
+        for location in map._sectors:
+            if map._sectors[location].team.id != sector_team_id:
+                continue
+            for y in range(location.y, min(location.y + map.sector_size, height)):
+                for x in range(location.x, min(location.x + map.sector_size, width)):
+                    sources.add((x, y))
+    else:
+        for entity in state.entities.values():
+            if entity.held_by is None and \
+                    (team_id is None or entity.team.id == team_id) and \
+                    (entity_type is None or entity.type == entity_type):
+                sources.add(tuple(entity.location))
+    distances = [battlecode.DistanceField.FAR] * (width * height)
+    for x, y in sources:
+        distances[y * width + x] = 0
+    frontier = list(sources)
+    distance = 0
+    while frontier:
+        distance += 1
+        next_frontier = []
+        for x, y in frontier:
+            for direction in Direction.directions():
+                nx = x + direction.dx
+                ny = y + direction.dy
+                if 0 <= nx < width and 0 <= ny < height and \
+                        distances[ny * width + nx] > distance:
+                    distances[ny * width + nx] = distance
+                    next_frontier.append((nx, ny))
+        frontier = next_frontier
+    return distances
+
+
+def verify_distance_fields(initial_state, rnd, steps):
+    '''
+    Keep distance fields up to date through random turns, some played with
+    speculation and some as server deltas, with sectors changing hands, and
+    compare them with ones computed from scratch after every turn. Returns
+    the number of fields compared.
+    '''
+    state = make_state(initial_state)
+    teams = state.teams
+    keys = [(None, None, None), (teams[1], None, None), (teams[2], Entity.THROWER, None),
+            (None, Entity.STATUE, None), (None, None, teams[1])]
+    fields = [state.distance_field(*key) for key in keys]
+    checked = 0
+    for turn in range(1, steps + 1):
+        team = teams[2 - turn % 2]
+        state.turn = turn
+        state.my_team = team
+        state.my_team_id = team.id
+        if rnd.random() < .5:
+            for entity, action in random_actions(state, team, rnd):
+                queue_checked(state, entity, action)
+        else:
+            state._update_entities(make_delta(state, rnd.random()))
+        state.map._update_sectors([
+            {'topLeft': {'x': top_left.x, 'y': top_left.y},
+             'controllingTeamID': rnd.choice([0, 1, 2])}
+            for top_left in state.map._sectors if rnd.random() < .1])
+
+        for (team_key, entity_type, sector_team), field in zip(keys, fields):
+            expected = distances_from_scratch(
+                state, team_key and team_key.id, entity_type, sector_team and sector_team.id)
+            assert list(field.distances) == expected, \
+                'turn {}: distances to {} differ'.format(turn, (team_key, entity_type, sector_team))
+            checked += 1
+    return checked
+
+
+def ready_from_scratch(state, team, turn):
+    '''The ids of team's throwers that can act on turn, found by looking at every unit.'''
+    ids = []
+    for entity in state.entities.values():
+        if entity.team != team or not entity.is_thrower:
+            continue
+        ready = entity.cooldown_end or 0
+        if entity.held_by is not None:
+            holding_end = entity.held_by.holding_end
+            ready = max(ready, holding_end if holding_end is not None else float('inf'))
+        if ready <= turn:
+            ids.append(entity.id)
+    return sorted(ids)
+
+
+def verify_ready_units(initial_state, rnd, steps):
+    '''
+    Play random turns, some with speculation and some as server deltas, and
+    compare ready_units and units_ready_at with every unit's can_act and
+    cooldowns, on the state and on a copy of it like the bot gets. Returns
+    the number of queries compared.
+    '''
+    state = make_state(initial_state)
+    checked = 0
+    for turn in range(1, steps + 1):
+        team = state.teams[2 - turn % 2]
+        state.turn = turn
+        state.my_team = team
+        state.my_team_id = team.id
+        if rnd.random() < .5:
+            for entity, action in random_actions(state, team, rnd):
+                queue_checked(state, entity, action)
+        else:
+            state._update_entities(make_delta(state, rnd.random()))
+
+        for checked_state in (state, copy_state(state)):
+            # asked before anything reads the units, which fills them in
+            sides = (state.teams[1], state.teams[2])
+            ready = [[e.id for e in checked_state.ready_units(side)] for side in sides]
+            later = [(offset, [e.id for e in checked_state.units_ready_at(turn + offset)])
+                     for offset in (0, 1, 5, 12)]
+            for side, ids in zip(sides, ready):
+                expected = sorted(e.id for e in checked_state.entities.values()
+                                  if e.team == side and e.can_act)
+                assert ids == expected, 'turn {}: ready units of {} differ'.format(turn, side)
+            for offset, ids in later:
+                assert ids == ready_from_scratch(checked_state, state.my_team, turn + offset), \
+                    'turn {}: units ready {} turns later differ'.format(turn, offset)
+            checked += 2 + len(later)
+    return checked
+
+
+def verify_hub_reconnect(initial_state, rnd, steps):
+    '''
+    Play both teams of a LocalServer match on one GameHub, cutting one
+    team's connection at a random turn, and check that it logs in again and
+    ends the match with the same state and winner as the team that stayed
+    connected. Returns the number of entities compared.
+    '''
+    # localserver imports this module
+    import localserver
+
+    directory = tempfile.mkdtemp()
+    server = localserver.LocalServer(os.path.join(directory, 'server'), initial_state,
+                                     turns=steps, turn_timeout=1)
+    result = {}
+    serving = threading.Thread(target=lambda: result.update(winner=server.serve()),
+                               name='LocalServer')
+    serving.daemon = True
+    serving.start()
+
+    drop_turn = rnd.randrange(2, steps)
+    dropped = []
+
+    def bot(game, state):
+        for entity, action in random_actions(state, state.my_team, rnd):
+            queue_checked(state, entity, action)
+        if game is games[0] and state.turn >= drop_turn and not dropped:
+            dropped.append(state.turn)
+            server.drop(state.my_team_id)
+
+    hub = battlecode.GameHub(bot)
+    # Game prints the random actions the server turns down
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        games = [hub.connect(name, server.address) for name in ('dropped_bot', 'stayed_bot')]
+        hub.run(timeout=30)
+        serving.join(30)
+    finally:
+        hub.close()
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(directory, True)
+
+    assert dropped, 'never reached turn {} to drop the connection'.format(drop_turn)
+    assert len(games[0].reconnects) == 1, 'logged in again {} times after dropping at turn {}'\
+        .format(len(games[0].reconnects), dropped[0])
+    winners = [game.winner and game.winner.id for game in games]
+    assert winners == [result.get('winner')] * 2, 'winners {} instead of {}'.format(
+        winners, result.get('winner'))
+    assert games[0].state.turn == games[1].state.turn, 'ended on turns {} and {}'.format(
+        games[0].state.turn, games[1].state.turn)
+    entities = all_entity_data(games[0].state)
+    assert entities == all_entity_data(games[1].state), \
+        'entities differ at the end after dropping at turn {}'.format(dropped[0])
+    return len(entities)
+
+
+# name: check(initial_state, rnd, steps) returning the number of things
+# compared, for --verify
+VERIFIERS = [
+    ('BatchSimulator', verify_batch),
+    ('queue_actions', verify_queue_actions),
+    ('DistanceField', verify_distance_fields),
+    ('ready_units', verify_ready_units),
+    ('GameHub reconnect', verify_hub_reconnect),
+]
+
+
+def verify(scenarios, seeds, steps):
+    '''
+    Check the fast paths against the straightforward ones on random games,
+    printing a line for each check. Returns False if any found a difference.
+    '''
+    ok = True
+    for name, check in VERIFIERS:
+        checked = 0
+        try:
+            for scenario, width, height, sector_size, count in scenarios:
+                for seed in range(seeds):
+                    initial_state = make_initial_state(width, height, sector_size, count, seed)
+                    checked += check(initial_state, random.Random(seed), steps)
+        except AssertionError as e:
+            sys.stderr.write('{}: {} seed {}: {}\n'.format(name, scenario, seed, e))
+            ok = False
+            continue
+        sys.stderr.write('{}: {} compared, all the same\n'.format(name, checked))
+    return ok
+
+
+def run(scenarios, repeat, only=None):
+    results = {}
+    for name, width, height, sector_size, count in scenarios:
+        initial_state = make_initial_state(width, height, sector_size, count)
+        state = make_state(initial_state)
+        for bench, body, setup, ops in benchmarks(state, initial_state):
+            key = '{}/{}'.format(name, bench)
+            if only is not None and only not in key:
+                continue
+            seconds = timed(body, setup, repeat)
+            results[key] = {
+                'seconds': seconds,
+                'ops': ops,
+                'us_per_op': seconds / ops * 1e6,
+            }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the names of the benchmarks that got more than tolerance slower
+    than the baseline, printing a line for each benchmark in both.
+    '''
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old = baseline[key]['seconds']
+        new = results[key]['seconds']
+        ratio = new / old if old > 0 else 1.
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        sys.stderr.write('{:<50} {:>10.1f}us {:>10.1f}us {:>6.2f}x{}\n'.format(
+            key, old * 1e6, new * 1e6, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each benchmark; the fastest is reported')
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--scenario', action='append',
+                        help='only run these scenarios (small, medium, large)')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=.25,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--transport', action='store_true',
+                        help='time round trips over unix sockets and shared memory instead')
+    parser.add_argument('--verify', action='store_true',
+                        help='check the fast paths against straightforward ones instead')
+    parser.add_argument('--seeds', type=int, default=3,
+                        help='random games per scenario for --verify')
+    parser.add_argument('--steps', type=int, default=200,
+                        help='turns per game for --verify')
+    args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS
+    if args.scenario:
+        scenarios = [s for s in SCENARIOS if s[0] in args.scenario]
+
+    if args.verify:
+        if not args.scenario:
+            # the large one takes minutes
+            scenarios = SCENARIOS[:2]
+        return 0 if verify(scenarios, args.seeds, args.steps) else 1
+
+    if args.transport:
+        results = transport(args.repeat)
+    else:
+        results = run(scenarios, args.repeat, args.only)
+    output = {
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
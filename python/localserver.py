@@ -0,0 +1,326 @@
+from __future__ import print_function
+
+'''
+A stand-in for the battlecode server, for testing and timing bots on one
+machine without the real engine.
+
+It plays a single match using the rules of battlecode.BatchSimulator, so
+there's no spawning or sector control, and speaks the same protocol as the
+server: login, start, nextTurn, makeTurn, missedTurn and keyframe. A bot
+whose connection drops can log in again with the same key (or name) and is
+sent a keyframe of the current state.
+
+Bots on a unix socket can also ask for shared memory instead, by
+connecting to 'shm:' followed by the socket's path.
+
+Run `python localserver.py` and start your bots as usual. With --players 1
+team 2 passes every turn, so one bot can play alone.
+'''
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+try:
+    from queue import Queue, Empty
+except:
+    from Queue import Queue, Empty
+
+import battlecode
+import bench
+
+
+class _Player(object):
+    def __init__(self, team_id, name, key):
+        self.team_id = team_id
+        self.name = name
+        self.key = key
+        self.conn = None
+        self.stream = None
+        self.joined = False
+
+
+class LocalServer(object):
+    '''
+    Args:
+        address: a (host, port) pair, or a path for a unix domain socket
+        initial_state (dict): the map and units, as in the start message
+        players (int): 2, or 1 to have team 2 pass every turn
+        turns (int): turns to play before the match is a draw
+        turn_timeout (float): seconds a bot has to send its turn before the
+            turn is missed
+        keyframe_interval (int): send a keyframe every this many turns;
+            0 only sends them to bots that reconnect
+    '''
+
+    def __init__(self, address, initial_state, players=2, turns=1000,
+                 turn_timeout=1., keyframe_interval=0):
+        self.address = address
+        self.players = players
+        self.turn_timeout = turn_timeout
+        self.keyframe_interval = keyframe_interval
+        self._initial_state = initial_state
+        self._simulator = battlecode.BatchSimulator([initial_state], max_turns=turns + 1)
+        # the first nextTurn is for turn 0, and bots then play turn 1
+        self._simulator.turns[0] = 1
+        self._players = {}
+        self._events = Queue()
+        self._lock = threading.Lock()
+        self._pending = None
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._listener = socket.socket()
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(address)
+        self._listener.listen(8)
+
+    def serve(self):
+        '''
+        Play the match, returning once it's over.
+        Returns:
+            int: the winning team's id, or 0 for a draw
+        '''
+        accepter = threading.Thread(target=self._accept, name='LocalServer accept')
+        accepter.daemon = True
+        accepter.start()
+
+        while len(self._players) < self.players or not all(
+                player.joined for player in self._players.values()):
+            self._handle(self._events.get())
+
+        teams = [{'teamID': 0, 'name': 'neutral'}]
+        for team_id in (1, 2):
+            player = self._players.get(team_id)
+            teams.append({'teamID': team_id, 'name': player.name if player else 'passer'})
+        self._broadcast({
+            'command': 'start',
+            'teams': teams,
+            'initialState': self._initial_state,
+        })
+
+        simulator = self._simulator
+        entities = dict((data['id'], data) for data in simulator.entities(0))
+        message = {
+            'command': 'nextTurn',
+            'turn': 0,
+            'changed': [],
+            'dead': [],
+            'changedSectors': [],
+            'lastTeamID': 0,
+            'nextTeamID': simulator.teams[0],
+            'failed': [],
+            'reasons': [],
+        }
+        while True:
+            self._pending = message
+            self._broadcast(message)
+            if self.keyframe_interval and message['turn'] % self.keyframe_interval == 0:
+                self._broadcast(self._keyframe())
+
+            team_id = simulator.teams[0]
+            actions = self._await_actions(team_id, simulator.turns[0])
+            finished = simulator.step([actions])[0]
+
+            if finished:
+                winner = simulator.winners[0] or 0
+                self._broadcast(dict(message, turn=message['turn'] + 1, changed=[], dead=[],
+                                     failed=[], reasons=[], lastTeamID=team_id,
+                                     winnerID=winner))
+                self.close()
+                return winner
+
+            current = dict((data['id'], data) for data in simulator.entities(0))
+            rejected = simulator.rejected[0]
+            message = {
+                'command': 'nextTurn',
+                'turn': message['turn'] + 1,
+                'changed': [data for id, data in current.items() if entities.get(id) != data],
+                'dead': [id for id in entities if id not in current],
+                'changedSectors': [],
+                'lastTeamID': team_id,
+                'nextTeamID': simulator.teams[0],
+                'failed': rejected,
+                'reasons': ['invalid action'] * len(rejected),
+            }
+            entities = current
+
+    def drop(self, team_id):
+        '''Cut a bot's connection, e.g. to test reconnecting.'''
+        with self._lock:
+            player = self._players.get(team_id)
+            conn = player and player.stream is not None and player.conn
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        with self._lock:
+            conns = [player.conn for player in self._players.values()
+                     if player.stream is not None]
+            for player in self._players.values():
+                player.stream = None
+        # closing a stream here would wait on the reader thread blocked in
+        # it, so hang up and let _read close it, as drop() does
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self._listener.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _keyframe(self):
+        state = dict(self._initial_state)
+        state['entities'] = self._simulator.entities(0)
+        return {'command': 'keyframe', 'state': state}
+
+    def _await_actions(self, team_id, turn):
+        '''The actions team_id sends for turn, or none if it misses it.'''
+        player = self._players.get(team_id)
+        if player is None:
+            return []
+        deadline = time.time() + self.turn_timeout
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                self._send(player, {'command': 'missedTurn', 'turn': turn})
+                return []
+            try:
+                event = self._events.get(timeout=timeout)
+            except Empty:
+                continue
+            result = self._handle(event)
+            if result is not None and result[0] == team_id and result[1].get('turn') == turn:
+                return result[1].get('actions', [])
+
+    def _handle(self, event):
+        '''Deal with a join; returns (team id, makeTurn message) for turns.'''
+        kind, player, conn, stream, message = event
+        if kind == 'join':
+            with self._lock:
+                rejoined = player.joined
+                player.conn = conn
+                player.stream = stream
+                player.joined = True
+            self._send(player, {'command': 'loginConfirm', 'teamID': player.team_id})
+            if rejoined and self._pending is not None:
+                self._send(player, self._keyframe())
+                # prompt it again if it's waiting on this bot
+                self._send(player, dict(self._pending, changed=[], dead=[], changedSectors=[]))
+        elif message.get('command') == 'makeTurn':
+            return player.team_id, message
+        return None
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except socket.error:
+                return
+            reader = threading.Thread(target=self._read, args=(conn,), name='LocalServer player')
+            reader.daemon = True
+            reader.start()
+
+    def _read(self, conn):
+        stream = conn.makefile('rwb', 2**16)
+        try:
+            login = json.loads(stream.readline().decode())
+            if login.get('command') == 'sharedMemory':
+                stream = battlecode._SharedMemoryStream.accept(conn)
+                login = json.loads(stream.readline().decode())
+        except (ValueError, socket.error):
+            stream.close()
+            return
+        player = self._login(login)
+        if player is None:
+            stream.write(b'{"command": "error", "reason": "game is full"}\n')
+            stream.flush()
+            stream.close()
+            return
+        self._events.put(('join', player, conn, stream, None))
+        try:
+            for line in stream:
+                self._events.put(('message', player, conn, stream, json.loads(line.decode())))
+        except (socket.error, IOError, ValueError):
+            pass
+        # clear it here rather than queueing it, so the bot can log straight back in
+        with self._lock:
+            if player.stream is stream:
+                player.stream = None
+        try:
+            stream.close()
+        except (socket.error, IOError):
+            # it was hung up on with a reply still unflushed
+            pass
+        conn.close()
+
+    def _login(self, login):
+        '''The player logging in: one that dropped, matched by key or name, or a new one.'''
+        with self._lock:
+            key = login.get('key')
+            for player in self._players.values():
+                if player.joined and player.stream is None and (
+                        player.key == key if key else player.name == login['name']):
+                    return player
+            for team_id in (1, 2)[:self.players]:
+                if team_id not in self._players:
+                    player = self._players[team_id] = _Player(team_id, login['name'], key)
+                    return player
+        return None
+
+    def _send(self, player, message):
+        stream = player.stream
+        if stream is None:
+            return
+        try:
+            stream.write(json.dumps(message).encode() + b'\n')
+            stream.flush()
+        except (socket.error, IOError, ValueError):
+            with self._lock:
+                if player.stream is stream:
+                    player.stream = None
+
+    def _broadcast(self, message):
+        for player in list(self._players.values()):
+            self._send(player, message)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=6147)
+    parser.add_argument('--unix', help='listen on this unix socket path instead')
+    parser.add_argument('--scenario', default='small',
+                        help='map size from bench.py (small, medium, large)')
+    parser.add_argument('--players', type=int, default=2, choices=[1, 2])
+    parser.add_argument('--turns', type=int, default=1000)
+    parser.add_argument('--turn-timeout', type=float, default=1.)
+    parser.add_argument('--keyframe-interval', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for name, width, height, sector_size, count in bench.SCENARIOS:
+        if name == args.scenario:
+            initial_state = bench.make_initial_state(width, height, sector_size, count)
+            break
+    else:
+        parser.error('unknown scenario: ' + args.scenario)
+
+    address = args.unix or ('localhost', args.port)
+    server = LocalServer(address, initial_state, args.players, args.turns,
+                         args.turn_timeout, args.keyframe_interval)
+    print('winner:', server.serve())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,6 +23,8 @@ def nearest_glass_state(state, entity):
 
 for state in game.turns():
     # Your Code will run within this loop
+    # units that would like to move this turn, and where
+    moves = []
     for entity in state.get_entities(team=state.my_team): 
         # This line gets all the bots on your team
 
@@ -46,9 +48,10 @@ for state in game.turns():
             if entity.can_throw(direction):
                 entity.queue_throw(direction)
 
-        for direction in battlecode.Direction.directions():
-            if entity.can_move(direction):
-                entity.queue_move(direction)
+        moves.append((entity, battlecode.Direction.directions()))
+
+    # move everyone at once so units don't block each other
+    state.plan_moves(moves)
 
 end = time.clock()
 print('clock time: '+str(end - start))